@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""benchmarks.py: Suíte de benchmarks de regressão sobre todas as instâncias de Solomon"""
+
+__copyright__ = "Copyright (c) 2021 Isabella Freitas & José Fonseca. MIT. See attached LICENSE.txt file"
+
+
+import sys
+import json
+import glob
+import argparse
+from time import perf_counter
+from collections import defaultdict
+
+from numpy import random, median, percentile
+
+from two_step_vrptw.utils import Frota, Parametros, Mapa
+from two_step_vrptw.instancias import le_instancia, matriz_de_distancias
+from two_step_vrptw import algorithms, busca_local
+
+
+PARAMETROS = Parametros(
+    peso_distancia    = 5.0,
+    peso_urgencia     = 0.165,
+    peso_recursoes    = 2.0,
+    limite_recursoes  = 3,
+    clientes_recursao = 4,
+    limite_iteracoes  = 1000
+)
+FASES_CONSTRUCAO = ('rota_independente', 'rota_coletiva', 'rota_coletiva_lote')
+
+
+def cronometra(funcao, qtd_chamadas=1) -> float:
+    # Tempo médio (ms) por chamada, em uma amostra de qtd_chamadas
+    inicio = perf_counter()
+    for _ in range(qtd_chamadas):
+        funcao()
+    return (perf_counter() - inicio) / qtd_chamadas * 1000
+
+
+def mede_instancia(arquivo: str, repeticoes: int, semente: int) -> dict:
+    amostras = defaultdict(list)
+    mapa = Mapa(arquivo)
+    _, _, _, valores = le_instancia(arquivo)
+
+    for rep in range(repeticoes):
+        # A carga segue o caminho de Mapa.__init__ (carrega_instancia e cria_provedor, sem cache binário): leitura
+        # vetorizada, matriz de distâncias e o mapa completo
+        amostras['parse'].append(cronometra(lambda: le_instancia(arquivo), 10))
+        amostras['matriz'].append(cronometra(lambda: matriz_de_distancias(valores[:, 1:3]), 10))
+        amostras['mapa'].append(cronometra(lambda: Mapa(arquivo), 10))
+
+        frota = Frota(mapa, 1)
+        carro = frota.novo_carro()
+        clientes_viaveis = algorithms.identifica_clientes_viaveis(frota, carro)
+        amostras['viabilidade'].append(cronometra(lambda: algorithms.identifica_clientes_viaveis(frota, carro), 50))
+        amostras['atratividade'].append(
+            cronometra(lambda: algorithms.calcula_atratividade(PARAMETROS, frota, clientes_viaveis, carro), 5)
+        )
+
+        # As construções usam sementes fixas, para que cada repetição percorra sempre o mesmo caminho
+        for tipo in FASES_CONSTRUCAO:
+            random.seed(semente + rep)
+            frota = Frota(mapa, 1)
+            amostras[tipo].append(cronometra(lambda: algorithms.gera_solucao(PARAMETROS, frota, tipo=tipo)))
+            if tipo == 'rota_independente' and frota.qtd_clientes_faltantes == 0:
+                amostras['otimizacao'].append(cronometra(lambda: algorithms.otimizacao_termino_mais_cedo(frota)))
+                amostras['busca_local'].append(cronometra(lambda: busca_local.busca_local(frota)))
+
+    return amostras
+
+
+def estatisticas(amostras: list, fase: str) -> dict:
+    resultado = {'mediana_ms': float(median(amostras)), 'p95_ms': float(percentile(amostras, 95)),
+                 'amostras': len(amostras)}
+    if fase in FASES_CONSTRUCAO:
+        resultado['construcoes_por_s'] = float(1000.0 / median(amostras))
+    return resultado
+
+
+def executa(padrao_instancias: str, repeticoes: int, semente: int) -> dict:
+    por_classe = defaultdict(lambda: defaultdict(list))
+    for arquivo in sorted(glob.glob(padrao_instancias)):
+        try:
+            amostras = mede_instancia(arquivo, repeticoes, semente)
+        except AssertionError:
+            continue  # Instância com cliente de janela de serviço inválida
+        classe = arquivo.split('/')[-2]
+        for fase, valores in amostras.items():
+            por_classe[fase][classe] += valores
+            por_classe[fase]['todas'] += valores
+    return {fase: {classe: estatisticas(valores, fase) for classe, valores in sorted(classes.items())}
+            for fase, classes in por_classe.items()}
+
+
+def compara(atual: dict, base: dict, limite: float) -> list:
+    # Uma fase regride quando a sua mediana, em alguma classe, supera a da base em mais do que o limite relativo
+    regressoes = []
+    for fase, classes in base.items():
+        for classe, estat in classes.items():
+            if fase not in atual or classe not in atual[fase]: continue
+            razao = atual[fase][classe]['mediana_ms'] / estat['mediana_ms']
+            if razao > (1.0 + limite):
+                regressoes.append((fase, classe, round(estat['mediana_ms'], 3),
+                                   round(atual[fase][classe]['mediana_ms'], 3), round(razao, 2)))
+    return regressoes
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Benchmarks de regressao do algoritmo')
+    parser.add_argument('instancias', nargs='?', default='data/solomon_1987/*/*.txt')
+    parser.add_argument('--repeticoes', type=int, default=5)
+    parser.add_argument('--semente', type=int, default=0)
+    parser.add_argument('--salva', default=None, help='Grava o resultado como base (JSON)')
+    parser.add_argument('--compara', default=None, help='Base (JSON) contra a qual verificar regressoes')
+    parser.add_argument('--limite', type=float, default=0.25, help='Regressao relativa tolerada na mediana')
+    args = parser.parse_args()
+
+    resultado = executa(args.instancias, args.repeticoes, args.semente)
+    for fase, classes in resultado.items():
+        for classe, estat in classes.items():
+            print(fase, '\t', classe, '\t', round(estat['mediana_ms'], 3), '(ms, mediana)',
+                  '\t', round(estat['p95_ms'], 3), '(ms, p95)',
+                  '' if 'construcoes_por_s' not in estat else f"\t {round(estat['construcoes_por_s'], 2)} (construcoes/s)",
+                  f"|{estat['amostras']}|")
+
+    if args.salva is not None:
+        with open(args.salva, 'w') as fout:
+            json.dump(resultado, fout, indent=2)
+
+    if args.compara is not None:
+        with open(args.compara, 'r') as fin:
+            regressoes = compara(resultado, json.load(fin), args.limite)
+        for fase, classe, base, atual, razao in regressoes:
+            print('REGRESSAO', '\t', fase, '\t', classe, '\t', base, '>>', atual, f'(ms, {razao}x)')
+        if len(regressoes) > 0: sys.exit(1)
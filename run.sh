@@ -1,3 +1,3 @@
 #!/bin/bash
 
-cat run_args.txt | xargs -I CMD --max-procs=6 bash -c CMD
+python3 run_campanha.py "data/solomon_1987/*/*.txt" --processos 6 "$@"
@@ -0,0 +1,34 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""run_campanha.py: Executa uma campanha de experimentos em paralelo, retomando a partir do indice de conclusão"""
+
+__copyright__ = "Copyright (c) 2021 Isabella Freitas & José Fonseca. MIT. See attached LICENSE.txt file"
+
+
+import json
+import argparse
+from two_step_vrptw import campanha
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Campanha de experimentos do algoritmo')
+    parser.add_argument('instancias', nargs='?', default='data/solomon_1987/*/*.txt',
+                        help='Padrao (glob) dos arquivos de instancia')
+    parser.add_argument('--grade', default=None,
+                        help='Arquivo JSON com a lista de combinacoes de pesos (peso_distancia, peso_urgencia, peso_recursoes)')
+    parser.add_argument('--repeticoes', type=int, default=campanha.REPETICOES_PADRAO)
+    parser.add_argument('--processos', type=int, default=6)
+    parser.add_argument('--destino', default='results')
+    parser.add_argument('--cache', default=None, help='Diretorio do cache binario de instancias')
+    args = parser.parse_args()
+
+    grade = None
+    if args.grade is not None:
+        with open(args.grade, 'r') as fin:
+            grade = json.load(fin)
+
+    for _ in campanha.executa_campanha(args.instancias, grade=grade, repeticoes=args.repeticoes,
+                                       destino=args.destino, processos=args.processos, diretorio_cache=args.cache):
+        pass
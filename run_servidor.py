@@ -0,0 +1,25 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""run_servidor.py: Executa o serviço local de soluções (linhas JSON sobre TCP)"""
+
+__copyright__ = "Copyright (c) 2021 Isabella Freitas & José Fonseca. MIT. See attached LICENSE.txt file"
+
+
+import argparse
+from two_step_vrptw import servidor
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Servico local de solucoes do algoritmo')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--porta', type=int, default=servidor.PORTA_PADRAO)
+    parser.add_argument('--processos', type=int, default=None)
+    parser.add_argument('--cache', default=None, help='Diretorio do cache binario de instancias')
+    parser.add_argument('--tamanho-cache', type=int, default=servidor.TAMANHO_CACHE_PADRAO,
+                        help='Numero maximo de mapas mantidos em memoria')
+    args = parser.parse_args()
+
+    servidor.executa_servidor(host=args.host, porta=args.porta, processos=args.processos,
+                              diretorio_cache=args.cache, tamanho_cache=args.tamanho_cache)
@@ -6,74 +6,232 @@
 __copyright__ = "Copyright (c) 2021 Isabella Freitas & José Fonseca. MIT. See attached LICENSE.txt file"
 
 
-from typing import List, Tuple
+from heapq import heappush, heappop
+from time import perf_counter
+from typing import List, Tuple, Union
 
-from numpy import random
-from pandas import DataFrame
+from numpy import ndarray, array, arange, full, where, maximum, minimum, argpartition, take_along_axis, lexsort, \
+    concatenate, column_stack, random, inf, float64, int64
 
-from two_step_vrptw.utils import Deposito, Cliente, Carro, Frota, Parametros, copia_carro, unifica_agendas_carros
+from two_step_vrptw.utils import Deposito, Cliente, Carro, CarroSimulado, Frota, Parametros, TabelaTransposicao, \
+    simula_atendimento, encadeia_carros
+from two_step_vrptw.instrumentacao import Instrumentacao
+
+
+# ######################################################################################################################
+# RESULTADO
+
+
+class Resultado(tuple):
+    """Par (validade, iteracoes) retornado por gera_solucao, com as estatísticas da execução como atributo"""
+
+    def __new__(cls, validade: bool, iteracoes: int, estatisticas: dict = None):
+        resultado = super().__new__(cls, (validade, iteracoes))
+        resultado.estatisticas = estatisticas
+        return resultado
+
+    @property
+    def validade(self) -> bool: return self[0]
+
+    @property
+    def iteracoes(self) -> int: return self[1]
 
 
 # ######################################################################################################################
 # PAYLOAD
 
 
-def identifica_clientes_viaveis(frota: Frota, carro: Carro) -> dict:
+def _filtra_viaveis(frota: Frota, carro: Union[Carro, CarroSimulado], indices: ndarray) -> (ndarray, ndarray):
+    # Mesma expressão de identifica_clientes_viaveis, avaliada apenas sobre um subconjunto de indices de clientes
+    mapa = frota.mapa
+    folgas = mapa.distancias.tempos_para(carro.posicao.indice, indices, carro.velocidade) + mapa.folgas[indices]
+    mascara = (
+        ~frota.atendidos_em(indices, carro)
+      & (mapa.demandas[indices] <= carro.carga)
+      & (mapa.fins[indices] > carro.fim)
+      & (folgas <= 0)
+    )
+    return indices[mascara], folgas[mascara]
+
+
+def _exclui_visitados(frota: Frota, carro: Union[Carro, CarroSimulado], mascara: ndarray, posicoes: ndarray,
+                      primeiro: int):
+    # Clientes ainda não registrados na frota (carros simulados), pelas suas posições em um dos indices do mapa
+    if carro.frota is frota: return
+    for visitado in carro.indices_visitados:
+        posicao = posicoes[visitado] - primeiro
+        if 0 <= posicao < len(mascara): mascara[posicao] = False
+
+
+def _viaveis_no_sufixo(frota: Frota, carro: Union[Carro, CarroSimulado], cursor: int) -> (ndarray, ndarray):
+    # Avaliamos apenas os clientes de janela ainda aberta para o carro: um sufixo do indice de janelas
+    # Os atributos dos clientes e a mascara de atendidos da frota já estão nessa ordem (fatias, sem cópia)
+    mapa = frota.mapa
+    folgas = mapa.linha_tempos_por_fim(carro.posicao.indice, carro.velocidade)[cursor:] + mapa.folgas_por_fim[cursor:]
+    mascara = (
+        ~frota.atendidos_por_fim[cursor:]
+      & (mapa.demandas_por_fim[cursor:] <= carro.carga)
+      & (folgas <= 0)
+    )
+    _exclui_visitados(frota, carro, mascara, mapa.posicoes_por_fim, cursor)
+    return mapa.ordem_fins[cursor:][mascara], folgas[mascara]
+
+
+def _viaveis_no_horizonte(frota: Frota, carro: Union[Carro, CarroSimulado]) -> (ndarray, ndarray):
+    # Clientes de janela aberta que abrem até (fim do carro + horizonte). Como a janela de um cliente aberto fecha
+    # depois do fim do carro, ela abre depois de (fim - maior largura de janela): esses clientes são um trecho do
+    # indice por inicio, e apenas esse trecho é avaliado (fatias, e tempos apenas para os clientes do trecho)
+    mapa = frota.mapa
+    primeiro = int(mapa.inicios_por_inicio.searchsorted(carro.fim - mapa.largura_janelas, side='right'))
+    ultimo = int(mapa.inicios_por_inicio.searchsorted(carro.fim + frota.horizonte, side='right'))
+    indices = mapa.ordem_inicios[primeiro:ultimo]
+    folgas = (mapa.distancias.tempos_para(carro.posicao.indice, indices, carro.velocidade)
+              + mapa.folgas_por_inicio[primeiro:ultimo])
+    mascara = (
+        ~frota.atendidos_por_inicio[primeiro:ultimo]
+      & (mapa.demandas_por_inicio[primeiro:ultimo] <= carro.carga)
+      & (mapa.fins_por_inicio[primeiro:ultimo] > carro.fim)
+      & (folgas <= 0)
+    )
+    _exclui_visitados(frota, carro, mascara, mapa.posicoes_por_inicio, primeiro)
+    if frota.instrumentacao is not None: frota.instrumentacao.conta('janelas.avaliados_no_horizonte', len(indices))
+    return indices[mascara], folgas[mascara]
+
+
+def _viaveis_por_janelas(frota: Frota, carro: Union[Carro, CarroSimulado]) -> (ndarray, ndarray):
+    instrumentacao = frota.instrumentacao
+    anterior = carro.cursor_janelas
+    cursor = frota.cursor_em_aberto(carro)
+    if instrumentacao is not None and carro.frota is frota:
+        # Apenas os clientes descartados agora pelo cursor de um carro real (os simulados herdam o cursor do pai)
+        instrumentacao.conta('janelas.clientes_descartados', cursor - anterior)
+
+    # Com um horizonte, os clientes adiados (janela abrindo depois de fim do carro + horizonte) nem chegam a ser
+    # avaliados, a menos que nenhum cliente dentro do horizonte seja viável: então avaliamos o sufixo inteiro
+    viaveis = None
+    if frota.horizonte is not None:
+        viaveis, folgas = _viaveis_no_horizonte(frota, carro)
+    if viaveis is None or len(viaveis) == 0:
+        viaveis, folgas = _viaveis_no_sufixo(frota, carro, cursor)
+        if instrumentacao is not None and frota.horizonte is not None and len(viaveis) > 0:
+            instrumentacao.conta('janelas.adiados_reavaliados')
+
+    # Devolvemos os viáveis em ordem de indice, como na avaliação completa
+    ordem = viaveis.argsort(kind='stable')
+    return viaveis[ordem], folgas[ordem]
+
+
+def identifica_clientes_viaveis(frota: Frota, carro: Union[Carro, CarroSimulado]) -> dict:
 
     # Identificamos a viabilidade de clientes (ainda não atendidos) pela demanda e a carga atual do veiculo
     # Consideramos também se o fim da janela do cliente já passou (para o veículo) - aceleração trivial de seleção
-    # Se não existem, retornamos imediatamente
-    carga_atual, momento_atual, clientes_atendidos = carro.carga, carro.fim, frota.clientes_atendidos  # SpeedUp Var
-    clientes_viaveis = {c: frota[c] for c in frota.clientes_faltantes.difference(carro.clientes_atendidos)}
-    clientes_viaveis = {c: v for c, v in clientes_viaveis.items() if v.demanda<=carga_atual and v.fim>momento_atual}
-    if len(clientes_viaveis) == 0: return {}
-
-    # Computamos a viabilidade de cada cliente selecionado na etapa anterior
-    # Calculamos o de tempo de deslocamento do veiculo para cada cliente
-    # Somamos com o tempo de servico em cada cliente
-    # Somamos com a hora de inicio da janela de atendimento em cada cliente
-    # Subtraimos a hora de fim da janela de atendimento em cada cliente
-    # Queremos apenas os resultados que não sejam negativos
-    # Desses, identificamos a atratividade
-    str_clientes_viaveis = list(clientes_viaveis.keys())  # Speedup de acesso de variável
-    posicao_atual, velocidade = str(carro.agenda[-1]), carro.velocidade  # SpeedUp de acesso de variável
-    clientes_viaveis = (
-        (frota.mapa.matriz_de_distancias[str_clientes_viaveis].loc[posicao_atual] / velocidade).astype(int) + 1
-      + DataFrame([[frota[c].inicio + frota[c].servico - frota[c].fim for c in str_clientes_viaveis]],
-                  columns=str_clientes_viaveis, index=[posicao_atual])
-    ).iloc[0].to_dict()
-    return {c: v for c, v in clientes_viaveis.items() if v <= 0}
-
-
-def calcula_atratividade(parametros: Parametros, frota: Frota, clientes_viaveis: dict, carro: Carro, numero_recursao=0) -> List[Tuple]:
+    # Somamos o tempo de deslocamento do veiculo para cada cliente à folga (inicio + servico - fim) do cliente
+    # Queremos apenas os resultados que não sejam positivos. Tudo em uma única expressão de mascara booleana
+    instrumentacao = frota.instrumentacao
+    if instrumentacao is not None: inicio = perf_counter()
+    mapa = frota.mapa
+    origem = carro.posicao.indice
+    viaveis = None
+
+    # Com listas de candidatos, avaliamos primeiro apenas os k clientes mais próximos da posição atual, em O(k)
+    # Só recorremos ao conjunto completo de clientes se nenhum dos candidatos for viável
+    if frota.candidatos is not None:
+        viaveis, folgas = _filtra_viaveis(frota, carro, frota.candidatos[origem])
+        if instrumentacao is not None:
+            instrumentacao.conta('candidatos.consultas')
+            if len(viaveis) == 0: instrumentacao.conta('candidatos.buscas_completas')
+
+    # Com o indice de janelas, os clientes de janela já fechada para o carro nem chegam a ser avaliados
+    if (viaveis is None or len(viaveis) == 0) and frota.indice_janelas:
+        viaveis, folgas = _viaveis_por_janelas(frota, carro)
+
+    elif viaveis is None or len(viaveis) == 0:
+        linha_tempos = mapa.linha_tempos(origem, carro.velocidade)  # SpeedUp Var
+        folgas = linha_tempos + mapa.folgas
+        viaveis = (
+            ~frota.mascara_atendidos(carro)
+          & (mapa.demandas <= carro.carga)
+          & (mapa.fins > carro.fim)
+          & (folgas <= 0)
+        ).nonzero()[0]
+        folgas = folgas[viaveis]
+
+    if instrumentacao is not None:
+        instrumentacao.conta('viabilidade.chamadas')
+        instrumentacao.conta('viabilidade.clientes_viaveis', len(viaveis))
+        instrumentacao.cronometra('viabilidade', inicio)
+
+    # Retornamos os indices dos clientes viáveis, associados a sua folga
+    return dict(zip(viaveis.tolist(), folgas.tolist()))
+
+
+def atratividade_imediata(parametros: Parametros, frota: Frota, clientes_viaveis: dict,
+                          carro: Union[Carro, CarroSimulado]) -> List[Tuple]:
 
     # Calculamos a atratividade imediata de cada cliente viável
-    posicao_atual = str(carro.agenda[-1])
-    linha_distancias = frota.mapa.matriz_de_distancias.loc[posicao_atual].to_dict()
+    # Distâncias nulas (pontos coincidentes) valem 0.001, como na atratividade em lote e na busca em feixe
+    mapa = frota.mapa
+    linha_distancias = mapa.linha_distancias(carro.posicao.indice).tolist()
     atratividade = {c: sum([
-        parametros.peso_distancia * (1.0/linha_distancias[c]),
-        (parametros.peso_urgencia * ((frota[c].fim - frota[c].inicio) / abs(v))) if v > 0 else 0.0
+        parametros.peso_distancia * (1.0/max([linha_distancias[c], 0.001])),
+        (parametros.peso_urgencia * ((mapa.fins[c] - mapa.inicios[c]) / abs(v))) if v > 0 else 0.0
     ]) for c, v in clientes_viaveis.items()}
 
     # Selecionamos apenas os clientes viáveis de maior atratividade
-    atratividade = sorted(atratividade.items(), key=lambda par: -1*par[1])[:parametros.clientes_recursao]
+    return sorted(atratividade.items(), key=lambda par: -1*par[1])[:parametros.clientes_recursao]
+
+
+def calcula_atratividade(parametros: Parametros, frota: Frota, clientes_viaveis: dict,
+                         carro: Union[Carro, CarroSimulado], numero_recursao=0,
+                         tabela: TabelaTransposicao = None) -> List[Tuple]:
+
+    # Com uma largura de feixe na frota, o lookahead é a busca em feixe, e não a recursão em profundidade
+    if frota.largura_feixe is not None and numero_recursao == 0:
+        return calcula_atratividade_feixe(parametros, frota, clientes_viaveis, carro)
+
+    # Contabilizamos o nó da recursão. O tempo é medido apenas na raiz, para não ser contado mais de uma vez
+    instrumentacao = frota.instrumentacao
+    if instrumentacao is not None:
+        instrumentacao.conta('lookahead.nos')
+        if numero_recursao == 0: inicio = perf_counter()
+
+    # Se temos uma tabela de transposição, verificamos se o estado do carro já foi avaliado nessa profundidade
+    # Se não, reaproveitamos ao menos a atratividade imediata do estado, que independe da profundidade
+    profundidade = parametros.limite_recursoes - numero_recursao
+    atratividade = None
+    if tabela is not None:
+        estado = tabela.estado(frota, carro)
+        atratividade = tabela.busca(estado, profundidade)
+        if atratividade is not None:
+            if instrumentacao is not None and numero_recursao == 0: instrumentacao.cronometra('atratividade', inicio)
+            return atratividade
+        if profundidade > 0: atratividade = tabela.busca_imediata(estado)
+
+    if atratividade is None:
+
+        # Identificamos os clientes viáveis, caso não tenham sido informados, e a sua atratividade imediata
+        if clientes_viaveis is None: clientes_viaveis = identifica_clientes_viaveis(frota, carro)
+        atratividade = atratividade_imediata(parametros, frota, clientes_viaveis, carro)
+        if tabela is not None: tabela.armazena(estado, 0, atratividade)
 
     # Se não temos mais recursões, retornamos imediatamente
-    if numero_recursao >= parametros.limite_recursoes: return atratividade
+    if numero_recursao >= parametros.limite_recursoes:
+        if instrumentacao is not None and numero_recursao == 0: instrumentacao.cronometra('atratividade', inicio)
+        return atratividade
 
     # Se chegamos até aqui, temos pelo menos mais um nivel de recursão
     atratividade = dict(atratividade)
     for cliente, atratividade_cliente in atratividade.items():
 
         # Geramos um carro simulado para a recursão e calculamos a atratividade dos clientes depois do atual
-        carro_recursao = copia_carro(carro)
-        carro_recursao.atendimento(frota[cliente])
-        sub_clientes_viaveis = identifica_clientes_viaveis(frota, carro_recursao)
-        if len(sub_clientes_viaveis) == 0: continue
+        # O carro simulado apenas referencia o estado anterior, sem copiar a agenda
+        carro_recursao = simula_atendimento(frota.mapa, carro, frota[cliente])
+        if instrumentacao is not None: instrumentacao.conta('lookahead.carros_simulados')
         sub_atratividade = calcula_atratividade(
             parametros, frota,
-            sub_clientes_viaveis, carro_recursao,
-            numero_recursao=numero_recursao+1
+            None, carro_recursao,  # Os clientes viáveis só são identificados se o estado não estiver na tabela
+            numero_recursao=numero_recursao+1,
+            tabela=tabela
         )
         if len(sub_atratividade) == 0: continue
 
@@ -83,10 +241,107 @@ def calcula_atratividade(parametros: Parametros, frota: Frota, clientes_viaveis:
         )
 
     # Retornamos a atratividade compensada
-    return sorted(atratividade.items(), key=lambda par: -1*par[1])[:parametros.clientes_recursao]
-
-
-def _rota_independente(parametros: Parametros, frota: Frota, offset_iteracao: int) -> int:
+    atratividade = sorted(atratividade.items(), key=lambda par: -1*par[1])[:parametros.clientes_recursao]
+    if tabela is not None: tabela.armazena(estado, profundidade, atratividade)
+    if instrumentacao is not None and numero_recursao == 0: instrumentacao.cronometra('atratividade', inicio)
+    return atratividade
+
+
+def calcula_atratividade_feixe(parametros: Parametros, frota: Frota, clientes_viaveis: dict,
+                               carro: Union[Carro, CarroSimulado]) -> List[Tuple]:
+    """Lookahead por busca em feixe, alternativa à recursão de calcula_atratividade. Os clientes_recursao clientes
+    mais atrativos são as raízes. A cada nível (até limite_recursoes), cada estado do feixe é expandido nos seus
+    clientes_recursao clientes mais atrativos, todos os estados de uma vez (estados x clientes pendentes), e apenas os
+    largura_feixe estados de maior valor seguem para o próximo nível. O valor de uma sequência é a soma das
+    atratividades imediatas, a do nível n ponderada por peso_recursoes ** n, como na recursão. Cada raiz recebe o
+    valor do seu melhor estado no nível mais profundo que alcançou. O custo é linear na profundidade"""
+    instrumentacao = frota.instrumentacao
+    if instrumentacao is not None: inicio = perf_counter()
+    if clientes_viaveis is None: clientes_viaveis = identifica_clientes_viaveis(frota, carro)
+    raizes = atratividade_imediata(parametros, frota, clientes_viaveis, carro)
+    if parametros.limite_recursoes == 0 or len(raizes) == 0:
+        if instrumentacao is not None: instrumentacao.cronometra('atratividade', inicio)
+        return raizes
+
+    # Atributos dos clientes ainda não visitados (pela frota ou pelo carro), na ordem das colunas do feixe
+    mapa = frota.mapa
+    velocidade = carro.velocidade
+    pendentes = (~frota.mascara_atendidos(carro)).nonzero()[0]
+    demandas, inicios, fins = mapa.demandas[pendentes], mapa.inicios[pendentes], mapa.fins[pendentes]
+    servicos, folgas = mapa.servicos[pendentes], mapa.folgas[pendentes]
+
+    # Estados iniciais: o carro após atender cada raiz, pelas regras de CarroSimulado
+    clientes = array([cliente for cliente, _ in raizes], dtype=int64)
+    melhores = array([valor for _, valor in raizes], dtype=float64)
+    estados_raizes = arange(len(raizes))
+    valores = melhores.copy()
+    tempos = mapa.linhas_tempos(array([carro.posicao.indice]), velocidade, clientes)[0]
+    cargas = carro.carga - mapa.demandas[clientes]
+    terminos = maximum(carro.fim + tempos + mapa.servicos[clientes], mapa.inicios[clientes] + mapa.servicos[clientes])
+    caminhos = clientes[:, None]
+
+    for nivel in range(1, parametros.limite_recursoes + 1):
+
+        # Viabilidade e atratividade imediata de todos os pendentes para todos os estados, como em atratividade_em_lote
+        tempos = mapa.linhas_tempos(clientes, velocidade, pendentes)
+        viaveis = (
+            (demandas[None, :] <= cargas[:, None])
+          & (fins[None, :] > terminos[:, None])
+          & ((tempos + folgas[None, :]) <= 0)
+        )
+        for visitados in caminhos.T:
+            viaveis &= pendentes[None, :] != visitados[:, None]
+        distancias = maximum(mapa.linhas_distancias(clientes, pendentes), 0.001)
+        imediatas = where(viaveis, parametros.peso_distancia / distancias, 0.0)
+
+        # Expandimos cada estado nos seus clientes mais atrativos e mantemos apenas os melhores estados do nível
+        qtd = min([parametros.clientes_recursao, len(pendentes)])
+        filhos = argpartition(-imediatas, qtd - 1, axis=1)[:, :qtd]
+        ganhos = take_along_axis(imediatas, filhos, axis=1)
+        estados, colunas = (ganhos > 0).nonzero()
+        if len(estados) == 0: break
+        novos_valores = valores[estados] + (parametros.peso_recursoes ** nivel) * ganhos[estados, colunas]
+        if len(novos_valores) > frota.largura_feixe:
+            mantidos = argpartition(-novos_valores, frota.largura_feixe - 1)[:frota.largura_feixe]
+            estados, colunas, novos_valores = estados[mantidos], colunas[mantidos], novos_valores[mantidos]
+        posicoes = filhos[estados, colunas]
+        terminos = maximum(terminos[estados] + tempos[estados, posicoes] + servicos[posicoes],
+                           inicios[posicoes] + servicos[posicoes])
+        cargas = cargas[estados] - demandas[posicoes]
+        clientes = pendentes[posicoes]
+        caminhos = column_stack([caminhos[estados], clientes])
+        estados_raizes = estados_raizes[estados]
+        valores = novos_valores
+
+        # As raízes ainda presentes no feixe recebem o valor do seu melhor estado neste nível
+        do_nivel = full(len(raizes), -inf)
+        maximum.at(do_nivel, estados_raizes, valores)
+        melhores = where(do_nivel > -inf, do_nivel, melhores)
+        if instrumentacao is not None:
+            instrumentacao.conta('feixe.niveis')
+            instrumentacao.conta('feixe.estados', len(valores))
+
+    atratividade = sorted(zip([cliente for cliente, _ in raizes], melhores.tolist()), key=lambda par: -1*par[1])
+    if instrumentacao is not None: instrumentacao.cronometra('atratividade', inicio)
+    return atratividade
+
+
+def seleciona_por_roleta(frota: Frota, atratividade: List[Tuple]):
+
+    # Selecionamos randomicamente um cliente viável por roleta, proporcionalmente à sua atratividade
+    instrumentacao = frota.instrumentacao
+    if instrumentacao is not None: inicio = perf_counter()
+    valor_atratividade = [cli[1] for cli in atratividade]
+    valor_atratividade_total = sum(valor_atratividade)
+    sorteio = random if frota.gerador is None else frota.gerador
+    cliente = sorteio.choice([cli[0] for cli in atratividade], p=[v/valor_atratividade_total for v in valor_atratividade])
+    if instrumentacao is not None:
+        instrumentacao.conta('roleta.selecoes')
+        instrumentacao.cronometra('roleta', inicio)
+    return cliente
+
+
+def _rota_independente(parametros: Parametros, frota: Frota, offset_iteracao: int, tabela: TabelaTransposicao = None) -> int:
 
     # Inicializamos um carro com um deposito qualquer
     carro = frota.novo_carro()
@@ -94,6 +349,7 @@ def _rota_independente(parametros: Parametros, frota: Frota, offset_iteracao: in
 
     # Loop principal de execucao:
     for iteracao in range(offset_iteracao, parametros.limite_iteracoes):
+        if frota.prazo_esgotado: return parametros.limite_iteracoes
 
         # Identificamos clientes viáveis
         clientes_viaveis = identifica_clientes_viaveis(frota, carro)
@@ -103,7 +359,7 @@ def _rota_independente(parametros: Parametros, frota: Frota, offset_iteracao: in
             if iteracao < 2: return parametros.limite_iteracoes
 
             # Se estamos em um cliente, vamos até o depósito e avançamos no loop
-            if carro.agenda[-1].tipo == 'Cliente':
+            if carro.posicao.tipo == 'Cliente':
                 carro.reabastecimento(frota.deposito)
                 continue
 
@@ -112,12 +368,10 @@ def _rota_independente(parametros: Parametros, frota: Frota, offset_iteracao: in
                 return iteracao + 1
 
         # Se chegamos até aqui, temos clientes viáveis e podemos continuar. Calculamos a atratividade dos clientes
-        atratividade = calcula_atratividade(parametros, frota, clientes_viaveis, carro)
+        atratividade = calcula_atratividade(parametros, frota, clientes_viaveis, carro, tabela=tabela)
 
         # Selecionamos randomicamente um cliente viável por roleta
-        valor_atratividade = [cli[1] for cli in atratividade]
-        valor_atratividade_total = sum(valor_atratividade)
-        cliente = random.choice([cli[0] for cli in atratividade], p=[v/valor_atratividade_total for v in valor_atratividade])
+        cliente = seleciona_por_roleta(frota, atratividade)
 
         # Avançamos no caminho para o cliente
         carro.atendimento(frota[cliente])
@@ -126,10 +380,10 @@ def _rota_independente(parametros: Parametros, frota: Frota, offset_iteracao: in
     return iteracao + 1
 
 
-def rota_independente(parametros: Parametros, frota: Frota):
+def rota_independente(parametros: Parametros, frota: Frota, tabela: TabelaTransposicao = None):
     offset_iteracao = 0
-    while len(frota.clientes_faltantes) > 0:
-        offset_iteracao = _rota_independente(parametros, frota, offset_iteracao)
+    while frota.qtd_clientes_faltantes > 0:
+        offset_iteracao = _rota_independente(parametros, frota, offset_iteracao, tabela=tabela)
         if offset_iteracao >= (parametros.limite_iteracoes - 1):
             frota.limpa_carros_sem_agenda()
             return False, parametros.limite_iteracoes
@@ -137,7 +391,7 @@ def rota_independente(parametros: Parametros, frota: Frota):
     return True, offset_iteracao
 
 
-def rota_coletiva(parametros: Parametros, frota: Frota) -> (bool, int):
+def rota_coletiva(parametros: Parametros, frota: Frota, tabela: TabelaTransposicao = None) -> (bool, int):
 
     # Inicializamos alguns novos carros
     for _ in range(parametros.qtd_novos_carros_por_rodada):
@@ -146,6 +400,9 @@ def rota_coletiva(parametros: Parametros, frota: Frota) -> (bool, int):
     # Loop principal de execucao:
     for iteracao in range(parametros.limite_iteracoes):
         if ((iteracao+1) % 100) == 0: print(frota)
+        if frota.prazo_esgotado:
+            frota.limpa_carros_sem_agenda()
+            return False, iteracao
 
         # Sinalizamos que nessa iteração ainda não houve novo atendimento
         houve_novo_atendimento = False
@@ -161,19 +418,17 @@ def rota_coletiva(parametros: Parametros, frota: Frota) -> (bool, int):
                 if iteracao < 2: return False, parametros.limite_iteracoes
 
                 # Se estamos em um cliente, vamos até o depósito e avançamos no loop
-                if carro.agenda[-1].tipo == 'Cliente':
+                if carro.posicao.tipo == 'Cliente':
                     carro.reabastecimento(frota.deposito)
 
                 # Aqui, o carro tem de estar em um depósito. Assim, finalizamos a iteração
                 continue
 
             # Se chegamos até aqui, temos clientes viáveis e podemos continuar. Calculamos a atratividade dos clientes
-            atratividade = calcula_atratividade(parametros, frota, clientes_viaveis, carro)
+            atratividade = calcula_atratividade(parametros, frota, clientes_viaveis, carro, tabela=tabela)
 
             # Selecionamos randomicamente um cliente viável por roleta
-            valor_atratividade = [cli[1] for cli in atratividade]
-            valor_atratividade_total = sum(valor_atratividade)
-            cliente = random.choice([cli[0] for cli in atratividade], p=[v/valor_atratividade_total for v in valor_atratividade])
+            cliente = seleciona_por_roleta(frota, atratividade)
 
             # Avançamos no caminho para o cliente
             carro.atendimento(frota[cliente])
@@ -182,7 +437,7 @@ def rota_coletiva(parametros: Parametros, frota: Frota) -> (bool, int):
             houve_novo_atendimento = True
 
         # Se todos os clientes foram atendidos, retornamos o sucesso
-        if len(frota.clientes_faltantes) == 0:
+        if frota.qtd_clientes_faltantes == 0:
             frota.limpa_carros_sem_agenda()
             return True, iteracao
 
@@ -197,36 +452,160 @@ def rota_coletiva(parametros: Parametros, frota: Frota) -> (bool, int):
     return False, iteracao
 
 
-def gera_solucao(parametros:Parametros, frota:Frota, tipo='rota_independente') -> (bool, int):
+def atratividade_em_lote(parametros: Parametros, frota: Frota, carros: List[Carro]) -> (ndarray, ndarray):
+
+    # Viabilidade e atratividade imediata de todos os clientes pendentes para todos os carros, em uma única matriz
+    # (carros x clientes pendentes), pelas mesmas regras de identifica_clientes_viaveis e de calcula_atratividade
+    # Clientes viáveis sempre têm folga não positiva, então o termo de urgência (apenas para folga positiva) é nulo
+    # Clientes inviáveis recebem atratividade 0. Distâncias nulas (pontos coincidentes) valem 0.001, a menor distância
+    mapa = frota.mapa
+    pendentes = (~frota.atendidos).nonzero()[0]
+    posicoes = array([carro.posicao.indice for carro in carros], dtype=int64)
+    fins_carros = array([carro.fim for carro in carros], dtype=int64)
+    cargas = array([carro.carga for carro in carros], dtype=float64)
+    viaveis = (
+        (mapa.demandas[pendentes][None, :] <= cargas[:, None])
+      & (mapa.fins[pendentes][None, :] > fins_carros[:, None])
+      & ((mapa.linhas_tempos(posicoes, frota.velocidade_carro, pendentes) + mapa.folgas[pendentes][None, :]) <= 0)
+    )
+    distancias = maximum(mapa.linhas_distancias(posicoes, pendentes), 0.001)
+    return pendentes, where(viaveis, parametros.peso_distancia / distancias, 0.0)
+
+
+def seleciona_em_lote(parametros: Parametros, atratividade: ndarray, gerador=None) -> (ndarray, ndarray):
+
+    # Para cada carro (linha), mantemos os clientes_recursao clientes mais atrativos e sorteamos um deles por roleta
+    # Retorna o cliente sorteado por carro (-1 se o carro não tem clientes viáveis) e a sua atratividade
+    qtd = min([parametros.clientes_recursao, atratividade.shape[1]])
+    melhores = argpartition(-atratividade, qtd - 1, axis=1)[:, :qtd]
+    pesos = take_along_axis(atratividade, melhores, axis=1)
+    totais = pesos.sum(axis=1)
+    acumulados = pesos.cumsum(axis=1)
+    sorteios = (random if gerador is None else gerador).random(len(atratividade)) * totais
+    escolhas = minimum((acumulados <= sorteios[:, None]).sum(axis=1), qtd - 1)
+    clientes = take_along_axis(melhores, escolhas[:, None], axis=1)[:, 0]
+    valores = take_along_axis(pesos, escolhas[:, None], axis=1)[:, 0]
+    return where(totais > 0, clientes, -1), valores
+
+
+def rota_coletiva_em_lote(parametros: Parametros, frota: Frota) -> (bool, int):
+    """Variante de rota_coletiva em que cada iteração avalia todos os carros contra todos os clientes em uma única
+    operação matricial, considerando apenas a atratividade imediata (sem recursão). Quando mais de um carro sorteia o
+    mesmo cliente, ele fica com o carro para o qual é mais atrativo, e os demais aguardam a próxima iteração"""
+    instrumentacao = frota.instrumentacao
+
+    # Inicializamos alguns novos carros
+    for _ in range(parametros.qtd_novos_carros_por_rodada):
+        frota.novo_carro()
+
+    # Loop principal de execucao:
+    for iteracao in range(parametros.limite_iteracoes):
+        if ((iteracao+1) % 100) == 0: print(frota)
+        if frota.prazo_esgotado:
+            frota.limpa_carros_sem_agenda()
+            return False, iteracao
+        if instrumentacao is not None: inicio = perf_counter()
+
+        # Sorteamos um cliente para cada carro, todos de uma vez
+        carros = list(frota)
+        pendentes, atratividade = atratividade_em_lote(parametros, frota, carros)
+        clientes, valores = seleciona_em_lote(parametros, atratividade, frota.gerador)
+        clientes = where(clientes >= 0, pendentes[maximum(clientes, 0)], -1)
+
+        # Carros sem clientes viáveis voltam ao depósito (se estiverem em um cliente)
+        sem_clientes = (clientes < 0).nonzero()[0]
+        if len(sem_clientes) > 0 and iteracao < 2: return False, parametros.limite_iteracoes
+        for posicao in sem_clientes.tolist():
+            if carros[posicao].posicao.tipo == 'Cliente':
+                carros[posicao].reabastecimento(frota.deposito)
+
+        # Resolvemos os conflitos: cada cliente sorteado fica com o carro de maior atratividade por ele
+        com_clientes = (clientes >= 0).nonzero()[0]
+        ordem = com_clientes[lexsort((-valores[com_clientes], clientes[com_clientes]))]
+        vencedores = ordem[concatenate([[True], clientes[ordem][1:] != clientes[ordem][:-1]])] if len(ordem) > 0 else ordem
+        for posicao in vencedores.tolist():
+            carros[posicao].atendimento(frota[int(clientes[posicao])])
+
+        if instrumentacao is not None:
+            instrumentacao.conta('lote.iteracoes')
+            instrumentacao.conta('lote.conflitos', len(com_clientes) - len(vencedores))
+            instrumentacao.cronometra('lote', inicio)
+
+        # Se todos os clientes foram atendidos, retornamos o sucesso
+        if frota.qtd_clientes_faltantes == 0:
+            frota.limpa_carros_sem_agenda()
+            return True, iteracao
+
+        # Se, após iterar todos os carros, não tivemos nenhum atendimento, acrescentamos novos carros
+        if len(vencedores) == 0:
+            for _ in range(parametros.qtd_novos_carros_por_rodada):
+                frota.novo_carro()
+            if len(frota) > frota.max_carros: return False, iteracao
+
+    # Retornamos a iteração máxima, em caso de falha
+    frota.limpa_carros_sem_agenda()
+    return False, iteracao
+
+
+def gera_solucao(parametros:Parametros, frota:Frota, tipo='rota_independente', tabela: TabelaTransposicao = None,
+                 instrumentacao: Instrumentacao = None, qtd_candidatos: int = None, largura_feixe: int = None) -> Resultado:
+
+    # A instrumentação informada (se houver) é ligada à frota, e assim alcança todos os pontos instrumentados
+    # Da mesma forma, as listas de candidatos (k vizinhos mais próximos) alcançam toda identificação de viáveis,
+    # e a largura de feixe troca a recursão pela busca em feixe em todo cálculo de atratividade
+    if instrumentacao is not None: frota.instrumentacao = instrumentacao
+    if qtd_candidatos is not None: frota.candidatos = frota.mapa.lista_candidatos(qtd_candidatos)
+    if largura_feixe is not None: frota.largura_feixe = largura_feixe
+    instrumentacao = frota.instrumentacao
+    if instrumentacao is not None: inicio = perf_counter()
 
     if tipo == 'rota_independente':
-        return rota_independente(parametros, frota)
+        validade, iteracoes = rota_independente(parametros, frota, tabela=tabela)
 
     elif tipo == 'rota_coletiva':
-        return rota_coletiva(parametros, frota)
+        validade, iteracoes = rota_coletiva(parametros, frota, tabela=tabela)
+
+    elif tipo == 'rota_coletiva_lote':
+        validade, iteracoes = rota_coletiva_em_lote(parametros, frota)
 
     else:
         raise NotImplementedError(f'Tipo nao implementado: {tipo}')
 
+    # Anexamos ao resultado as estatísticas da instrumentação e da tabela de transposição, se existirem
+    if instrumentacao is None: return Resultado(validade, iteracoes)
+    instrumentacao.cronometra(tipo, inicio)
+    estatisticas = instrumentacao.estatisticas
+    if tabela is not None:
+        estatisticas['tabela'] = {'acertos': tabela.acertos, 'falhas': tabela.falhas,
+                                  'reaproveitamentos': tabela.reaproveitamentos, 'descartes': tabela.descartes,
+                                  'entradas': len(tabela)}
+    return Resultado(validade, iteracoes, estatisticas)
 
-def otimizacao_termino_mais_cedo(frota: Frota) -> dict:
 
-    # Ordenamos os carros da frota em ordem crescente da hora de término
-    ordenados = sorted(frota, key=lambda carro: carro.fim)
-
-    # Verificamos as possíveis merges de carros
-    reduzidos = {}
-    resultantes = []
-    for i, carro in enumerate(ordenados[:-1]):
-        if carro.id in reduzidos: continue
-        resultantes.append(carro)
-        for outro in ordenados[1+1:]:
-            if outro.id in reduzidos: continue
-            if resultantes[-1].fim <= outro.inicio:
-                resultantes[-1] = unifica_agendas_carros(resultantes[-1], outro)
-                reduzidos[outro.id] = outro
-    if ordenados[-1].id not in reduzidos:
-        resultantes.append(ordenados[-1])
+def otimizacao_termino_mais_cedo(frota: Frota) -> dict:
+    instrumentacao = frota.instrumentacao
+    if instrumentacao is not None: inicio = perf_counter()
+
+    # Cada carro é um intervalo [inicio, fim com retorno ao depósito], e dois carros podem ser unidos quando um volta
+    # ao depósito antes do outro iniciar
+    # Particionamento de intervalos: percorremos os carros em ordem de inicio, encadeando cada um à cadeia que terminou
+    # mais cedo (heap por fim), se compatível, ou abrindo uma nova cadeia. O número de cadeias resultante é o mínimo
+    cadeias = []
+    heap_fins = []
+    for carro in sorted(frota, key=lambda carro: (carro.inicio, carro.fim)):
+        if len(heap_fins) > 0 and heap_fins[0][0] <= carro.inicio:
+            _, posicao = heappop(heap_fins)
+            cadeias[posicao].append(carro)
+        else:
+            posicao = len(cadeias)
+            cadeias.append([carro])
+        heappush(heap_fins, (carro.fim_com_retorno, posicao))
+
+    # Unimos as agendas de cada cadeia sem copiar os clientes. Os carros absorvidos por outro são retornados
+    reduzidos = {carro.id: carro for cadeia in cadeias for carro in cadeia[1:]}
     if len(reduzidos) > 0:
-        frota.substitui_carros(resultantes)
+        frota.substitui_carros([cadeia[0] if len(cadeia) == 1 else encadeia_carros(cadeia) for cadeia in cadeias])
+    if instrumentacao is not None:
+        instrumentacao.conta('otimizacao.unificacoes', len(reduzidos))
+        instrumentacao.cronometra('otimizacao', inicio)
     return reduzidos
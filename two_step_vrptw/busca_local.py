@@ -0,0 +1,313 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""busca_local.py: Avaliação de movimentos de rotas em O(1) e busca local sobre as soluções construídas"""
+
+__copyright__ = "Copyright (c) 2021 Isabella Freitas & José Fonseca. MIT. See attached LICENSE.txt file"
+
+
+from typing import List, Dict, Callable
+from time import perf_counter
+
+from two_step_vrptw.utils import Mapa, Carro, Frota
+
+
+INFINITO = float('inf')
+EPSILON = 1e-6
+
+
+# ######################################################################################################################
+# SEGMENTOS DE ROTA
+
+
+class Segmento(object):
+    """Resumo de uma sequência de pontos consecutivos de uma rota, suficiente para concatenar sequências em O(1).
+    Os horários seguem as mesmas regras de Carro.atendimento: chegando ao primeiro ponto no momento A, o segmento
+    termina em max(A + duracao, termino), e só é viável com A <= limite. Cada cliente exige ainda que o carro parta
+    do ponto anterior antes do fim da sua janela, e que o deslocamento (desde o ponto anterior) somado à sua folga não
+    seja positivo, como em identifica_clientes_viaveis. As cargas são somadas por viagem (entre depósitos)"""
+    __slots__ = ('primeiro', 'ultimo', 'duracao', 'termino', 'limite', 'distancia', 'carga_inicial', 'carga_final',
+                 'tem_deposito', 'qtd_clientes', 'viavel')
+
+    def __repr__(self): return f'Segmento({self.primeiro}..{self.ultimo} |{self.qtd_clientes}| {self.distancia} [{self.termino}, {self.limite}] {self.viavel})'
+    def __str__(self): return self.__repr__()
+
+    @property
+    def fim(self) -> int:
+        # Término do segmento quando iniciado no depósito, no momento 0 (como um carro novo)
+        return max([self.duracao, self.termino])
+
+    @property
+    def rota_viavel(self) -> bool:
+        return self.viavel and self.limite >= 0
+
+
+class Avaliador(object):
+    """Constrói e concatena segmentos para um mapa e uma configuração de carro (velocidade e capacidade)"""
+
+    def __init__(self, mapa: Mapa, velocidade: int, capacidade: float):
+        self.mapa = mapa
+        self.velocidade = velocidade
+        self.capacidade = capacidade
+        self.deposito = mapa.deposito.indice
+        self.fins = mapa.fins.tolist()
+        self.folgas = mapa.folgas.tolist()
+        self.segmentos = [self.cria_segmento(no) for no in range(len(mapa.nos))]
+
+    def cria_segmento(self, no: int) -> Segmento:
+        segmento = Segmento()
+        segmento.primeiro = segmento.ultimo = no
+        segmento.distancia = 0.0
+        segmento.limite = INFINITO
+        if no == self.deposito:
+            segmento.duracao = segmento.termino = 0
+            segmento.carga_inicial = segmento.carga_final = 0.0
+            segmento.tem_deposito, segmento.qtd_clientes, segmento.viavel = True, 0, True
+        else:
+            cliente = self.mapa.nos[no]
+            segmento.duracao = cliente.servico
+            segmento.termino = cliente.inicio + cliente.servico
+            segmento.carga_inicial = segmento.carga_final = cliente.demanda
+            segmento.tem_deposito, segmento.qtd_clientes = False, 1
+            segmento.viavel = cliente.demanda <= self.capacidade
+        return segmento
+
+    def limite_partida(self, origem: int, seg: Segmento, tempo: int) -> float:
+        # Momento mais tarde em que um carro pode partir de 'origem' e ainda completar o segmento
+        if seg.primeiro == self.deposito: return seg.limite - tempo
+        return min([self.fins[seg.primeiro] - 1, seg.limite - tempo])
+
+    def concatena(self, pri: Segmento, seg: Segmento) -> Segmento:
+        tempo = self.mapa.tempo_deslocamento(pri.ultimo, seg.primeiro, self.velocidade)
+        resultado = Segmento()
+        resultado.primeiro, resultado.ultimo = pri.primeiro, seg.ultimo
+        resultado.distancia = pri.distancia + self.mapa.distancias.distancia(pri.ultimo, seg.primeiro) + seg.distancia
+        resultado.qtd_clientes = pri.qtd_clientes + seg.qtd_clientes
+        resultado.viavel = pri.viavel and seg.viavel
+        if seg.primeiro != self.deposito:
+            resultado.viavel = resultado.viavel and (tempo + self.folgas[seg.primeiro] <= 0)
+
+        # Limite de partida do último ponto do primeiro segmento, imposto pelo segundo segmento
+        limite_partida = self.limite_partida(pri.ultimo, seg, tempo)
+
+        resultado.duracao = pri.duracao + tempo + seg.duracao
+        resultado.termino = max([pri.termino + tempo + seg.duracao, seg.termino])
+        resultado.limite = min([pri.limite, limite_partida - pri.duracao]) if pri.termino <= limite_partida else -INFINITO
+
+        # Cargas por viagem: apenas as viagens que cruzam a junção dos segmentos somam cargas de ambos
+        resultado.tem_deposito = pri.tem_deposito or seg.tem_deposito
+        if not pri.tem_deposito and not seg.tem_deposito:
+            resultado.carga_inicial = resultado.carga_final = pri.carga_inicial + seg.carga_inicial
+            juncao = resultado.carga_inicial
+        elif not pri.tem_deposito:
+            resultado.carga_inicial, resultado.carga_final = pri.carga_inicial + seg.carga_inicial, seg.carga_final
+            juncao = resultado.carga_inicial
+        elif not seg.tem_deposito:
+            resultado.carga_inicial, resultado.carga_final = pri.carga_inicial, pri.carga_final + seg.carga_final
+            juncao = resultado.carga_final
+        else:
+            resultado.carga_inicial, resultado.carga_final = pri.carga_inicial, seg.carga_final
+            juncao = pri.carga_final + seg.carga_inicial
+        resultado.viavel = resultado.viavel and juncao <= self.capacidade
+        return resultado
+
+    def encadeia(self, *segmentos: Segmento) -> Segmento:
+        resultado = segmentos[0]
+        for segmento in segmentos[1:]:
+            resultado = self.concatena(resultado, segmento)
+        return resultado
+
+    def sequencia(self, nos: List[int]) -> Segmento:
+        return self.encadeia(*[self.segmentos[no] for no in nos])
+
+
+class Rota(object):
+    """Representação de uma rota (a agenda de um carro, por indices) com os segmentos de todos os seus prefixos e
+    sufixos. Qualquer movimento que combine um prefixo, poucos pontos e um sufixo é avaliado em O(1)"""
+
+    def __init__(self, avaliador: Avaliador, nos: List[int], id_carro: str = None):
+        self.avaliador = avaliador
+        self.id_carro = id_carro
+        self.nos = nos
+        segmentos = avaliador.segmentos
+        self.prefixos = [segmentos[nos[0]]]
+        for no in nos[1:]:
+            self.prefixos.append(avaliador.concatena(self.prefixos[-1], segmentos[no]))
+        self.sufixos = [segmentos[nos[-1]]]
+        for no in reversed(nos[:-1]):
+            self.sufixos.append(avaliador.concatena(segmentos[no], self.sufixos[-1]))
+        self.sufixos.reverse()
+
+    def __repr__(self): return f'Rota({self.id_carro} |{len(self.nos)}| {self.segmento})'
+    def __str__(self): return self.__repr__()
+    def __len__(self): return len(self.nos)
+
+    @property
+    def segmento(self) -> Segmento: return self.prefixos[-1]
+
+    # Vetores de prefixos e sufixos: carga da viagem corrente, término mais cedo, término mais tarde (sem inviabilizar
+    # o restante da rota) e distância acumulada, por posição da rota
+    @property
+    def cargas(self) -> List[float]: return [p.carga_final for p in self.prefixos]
+
+    @property
+    def terminos(self) -> List[int]: return [p.fim for p in self.prefixos]
+
+    @property
+    def limites(self) -> List[float]:
+        avaliador = self.avaliador
+        tempos = [avaliador.mapa.tempo_deslocamento(no, prox, avaliador.velocidade)
+                  for no, prox in zip(self.nos[:-1], self.nos[1:])]
+        return [avaliador.limite_partida(no, sufixo, tempo)
+                for no, sufixo, tempo in zip(self.nos[:-1], self.sufixos[1:], tempos)] + [INFINITO]
+
+    @property
+    def distancias(self) -> List[float]: return [p.distancia for p in self.prefixos]
+
+
+# ######################################################################################################################
+# MOVIMENTOS
+# Cada movimento recebe duas rotas distintas (A, B), a posição i de um cliente de A e a posição j de um cliente de B,
+# e retorna os novos segmentos de A e B com uma função que gera os novos indices de ambas, ou None se não se aplica
+
+
+def realocacao(avaliador: Avaliador, a: Rota, i: int, b: Rota, j: int):
+    # O cliente A[i] passa para B, logo após B[j]
+    seg = avaliador.segmentos
+    nova_a = avaliador.concatena(a.prefixos[i-1], a.sufixos[i+1])
+    nova_b = avaliador.encadeia(b.prefixos[j], seg[a.nos[i]], b.sufixos[j+1])
+    return nova_a, nova_b, lambda: (a.nos[:i] + a.nos[i+1:], b.nos[:j+1] + [a.nos[i]] + b.nos[j+1:])
+
+
+def troca(avaliador: Avaliador, a: Rota, i: int, b: Rota, j: int):
+    # O cliente A[i] troca de lugar com o cliente seguinte a B[j], passando a segui-lo
+    if b.nos[j+1] == avaliador.deposito: return None
+    seg = avaliador.segmentos
+    nova_a = avaliador.encadeia(a.prefixos[i-1], seg[b.nos[j+1]], a.sufixos[i+1])
+    nova_b = avaliador.encadeia(b.prefixos[j], seg[a.nos[i]], b.sufixos[j+2])
+    return nova_a, nova_b, lambda: (a.nos[:i] + [b.nos[j+1]] + a.nos[i+1:], b.nos[:j+1] + [a.nos[i]] + b.nos[j+2:])
+
+
+def dois_opt_estrela(avaliador: Avaliador, a: Rota, i: int, b: Rota, j: int):
+    # As rotas trocam seus finais: A segue de A[i] para B[j], e B segue de B[j-1] para A[i+1]
+    nova_a = avaliador.concatena(a.prefixos[i], b.sufixos[j])
+    nova_b = avaliador.concatena(b.prefixos[j-1], a.sufixos[i+1])
+    return nova_a, nova_b, lambda: (a.nos[:i+1] + b.nos[j:], b.nos[:j] + a.nos[i+1:])
+
+
+def _or_opt(avaliador: Avaliador, a: Rota, i: int, b: Rota, j: int, tamanho: int):
+    # A sequência de clientes A[i..i+tamanho-1] passa para B, logo após B[j], na mesma ordem
+    trecho = a.nos[i:i+tamanho]
+    if len(trecho) < tamanho or avaliador.deposito in trecho or i + tamanho >= len(a.nos): return None
+    nova_a = avaliador.concatena(a.prefixos[i-1], a.sufixos[i+tamanho])
+    nova_b = avaliador.encadeia(b.prefixos[j], avaliador.sequencia(trecho), b.sufixos[j+1])
+    return nova_a, nova_b, lambda: (a.nos[:i] + a.nos[i+tamanho:], b.nos[:j+1] + trecho + b.nos[j+1:])
+
+
+def or_opt(avaliador: Avaliador, a: Rota, i: int, b: Rota, j: int):
+    # Testamos trechos de 2 e 3 clientes, retornando o de menor distância resultante (se algum for viável)
+    opcoes = [m for m in (_or_opt(avaliador, a, i, b, j, 2), _or_opt(avaliador, a, i, b, j, 3)) if m is not None
+              and m[0].rota_viavel and m[1].rota_viavel]
+    if len(opcoes) == 0: return None
+    return min(opcoes, key=lambda m: m[0].distancia + m[1].distancia)
+
+
+MOVIMENTOS: Dict[str, Callable] = {
+    'realocacao': realocacao, 'troca': troca, 'dois_opt_estrela': dois_opt_estrela, 'or_opt': or_opt
+}
+
+
+# ######################################################################################################################
+# BUSCA LOCAL
+
+
+def remove_depositos_repetidos(nos: List[int], deposito: int = 0) -> List[int]:
+    # Depósitos consecutivos (viagens que ficaram vazias) só atrasam a rota. Uma rota sem clientes fica vazia
+    resultado = [no for pos, no in enumerate(nos) if not (no == deposito and pos > 0 and nos[pos-1] == deposito)]
+    return [] if all(no == deposito for no in resultado) else resultado
+
+
+def refaz_carro(frota: Frota, nos: List[int], id_carro: str) -> Carro:
+    # Refaz a agenda com os mesmos objetos de clientes do mapa. O carro só é ligado à frota no final, pois os
+    # clientes já estão registrados como atendidos
+    carro = Carro(id_carro, frota.deposito, frota.velocidade_carro, frota.capacidade_carro, nos=frota.mapa.nos)
+    for no in nos[1:]:
+        item = frota.mapa.nos[no]
+        if item.tipo == 'Cliente':
+            carro.atendimento(item)
+        else:
+            carro.reabastecimento(item)
+    carro.frota = frota
+    return carro
+
+
+def busca_local(frota: Frota, qtd_candidatos: int = 10, movimentos=tuple(MOVIMENTOS.keys()),
+                limite_passes: int = 20, clientes: List[int] = None) -> Dict[str, int]:
+    """Melhora a solução da frota (primeira melhora) com os movimentos informados entre pares de rotas, reduzindo a
+    distância total ou o número de carros sem nunca violar as regras de construção. Os movimentos avaliados para cada
+    cliente são limitados aos seus qtd_candidatos vizinhos mais próximos. Com clientes, apenas os movimentos a partir
+    desses clientes são avaliados (p.ex. os da fronteira entre setores). Retorna a contagem de movimentos aplicados"""
+    instrumentacao = frota.instrumentacao
+    if instrumentacao is not None: inicio = perf_counter()
+    mapa = frota.mapa
+    avaliador = Avaliador(mapa, frota.velocidade_carro, frota.capacidade_carro)
+
+    # Todas as rotas terminam no depósito. Rotas abertas (p.ex. da rota coletiva) recebem o retorno ao depósito
+    rotas = [Rota(avaliador, carro.rota.tolist() + ([avaliador.deposito] if carro.posicao.tipo == 'Cliente' else []),
+                  carro.id) for carro in frota]
+    assert all(rota.segmento.rota_viavel for rota in rotas), 'SOLUCAO INICIAL INVIAVEL PARA A BUSCA LOCAL!'
+    candidatos = mapa.lista_candidatos(qtd_candidatos).tolist()
+    aplicados = {movimento: 0 for movimento in movimentos}
+    avaliados = 0
+
+    # Posição (rota, indice na rota) de cada cliente, atualizada apenas para as rotas alteradas
+    posicoes = {}
+    def atualiza_posicoes(rota: Rota):
+        for pos, no in enumerate(rota.nos):
+            if no != avaliador.deposito: posicoes[no] = (rota, pos)
+
+    for rota in rotas:
+        atualiza_posicoes(rota)
+
+    # Com um prazo na frota, a busca é interrompida entre dois clientes: as rotas são sempre uma solução válida
+    esgotado = False
+    for _ in range(limite_passes):
+        houve_melhora = False
+        for cliente in (range(1, len(mapa.nos)) if clientes is None else clientes):
+            if frota.prazo_esgotado:
+                esgotado = True
+                break
+            for vizinho in candidatos[cliente]:
+                a, i = posicoes[cliente]
+                b, j = posicoes[vizinho]
+                if a is b: continue
+                distancia_atual = a.segmento.distancia + b.segmento.distancia
+                for nome in movimentos:
+                    movimento = MOVIMENTOS[nome](avaliador, a, i, b, j)
+                    avaliados += 1
+                    if movimento is None: continue
+                    nova_a, nova_b, gera_nos = movimento
+                    if not (nova_a.rota_viavel and nova_b.rota_viavel): continue
+                    esvaziou = nova_a.qtd_clientes == 0 or nova_b.qtd_clientes == 0
+                    if not esvaziou and (nova_a.distancia + nova_b.distancia) >= (distancia_atual - EPSILON): continue
+
+                    # Movimento aceito: reconstruímos apenas as duas rotas alteradas (O(n))
+                    for rota, nos in zip((a, b), gera_nos()):
+                        nos = remove_depositos_repetidos(nos, avaliador.deposito)
+                        rotas.remove(rota)
+                        if len(nos) == 0: continue
+                        rota = Rota(avaliador, nos, rota.id_carro)
+                        rotas.append(rota)
+                        atualiza_posicoes(rota)
+                    aplicados[nome] += 1
+                    houve_melhora = True
+                    break
+        if esgotado or not houve_melhora: break
+
+    frota.substitui_carros([refaz_carro(frota, rota.nos, rota.id_carro) for rota in rotas])
+    if instrumentacao is not None:
+        instrumentacao.conta('busca_local.movimentos_avaliados', avaliados)
+        for nome, qtd in aplicados.items():
+            instrumentacao.conta(f'busca_local.{nome}', qtd)
+        instrumentacao.cronometra('busca_local', inicio)
+    return aplicados
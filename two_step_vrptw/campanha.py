@@ -0,0 +1,175 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""campanha.py: Execução paralela de campanhas de experimentos (instâncias x parâmetros x repetições)"""
+
+__copyright__ = "Copyright (c) 2021 Isabella Freitas & José Fonseca. MIT. See attached LICENSE.txt file"
+
+
+import os
+import glob
+from time import time
+from zlib import crc32
+from typing import List, Dict, Iterator
+from dataclasses import dataclass
+from multiprocessing import Pool
+
+from numpy import random
+
+from two_step_vrptw.utils import Mapa, Frota, Parametros
+from two_step_vrptw.resultados import ArmazemResultados, registro_execucao, rotas_frota
+from two_step_vrptw import algorithms
+
+
+# ######################################################################################################################
+# CONFIGURAÇÃO PADRÃO (mesma grade historicamente usada pelo run_testfile.py)
+
+
+GRADE_PADRAO = [
+    {'peso_distancia': 2, 'peso_urgencia': 0.12,  'peso_recursoes': 0.5},
+    {'peso_distancia': 5, 'peso_urgencia': 0.165, 'peso_recursoes': 1.0},
+    {'peso_distancia': 7, 'peso_urgencia': 0.20,  'peso_recursoes': 2.0},
+]
+PARAMETROS_FIXOS = {'limite_recursoes': 3, 'clientes_recursao': 4, 'limite_iteracoes': 10000}
+REPETICOES_PADRAO = 10
+ARQUIVO_INDICE = 'concluidos.txt'
+
+
+# ######################################################################################################################
+# TAREFAS
+
+
+@dataclass(frozen=True)
+class Tarefa(object):
+    arquivo: str
+    parametros: Parametros
+    repeticao: int
+
+    def __repr__(self): return f'TAREFA({self.chave})'
+    def __str__(self): return self.__repr__()
+
+    @property
+    def chave(self) -> str:
+        dire = self.arquivo.split('/')
+        return f'{dire[-2]}/' + '_'.join(map(str, [
+            self.parametros.peso_distancia, self.parametros.peso_urgencia, self.parametros.peso_recursoes,
+            self.repeticao, dire[-1]
+        ]))
+
+    @property
+    def semente(self) -> int:
+        # Semente determinística por tarefa: processos filhos (fork) herdariam o mesmo estado aleatório do pai
+        return crc32(self.chave.encode('utf-8'))
+
+
+def gera_tarefas(arquivos: List[str], grade: List[Dict], repeticoes: int) -> List[Tarefa]:
+    return [
+        Tarefa(arquivo=arquivo, parametros=Parametros(**combinacao, **PARAMETROS_FIXOS), repeticao=rep)
+        for arquivo in arquivos
+        for combinacao in grade
+        for rep in range(repeticoes)
+    ]
+
+
+def executa(mapa: Mapa, parametros: Parametros, arquivo: str, chave: str, display=True) -> tuple:
+    # Retornamos apenas o registro compacto da execução e as rotas como arrays de indices, nunca a frota inteira
+    begin = time()
+    frota = Frota(mapa, 1)
+    validade, iteracoes = algorithms.gera_solucao(parametros, frota, tipo='rota_independente')
+    if display: print(frota, validade, iteracoes)
+    sumario_pre_opt, sumario = None, None
+    if validade:
+        sumario_pre_opt = frota.colunas_sumario
+        algorithms.otimizacao_termino_mais_cedo(frota)
+        if display: print(frota)
+        sumario = frota.colunas_sumario
+    registro = registro_execucao(chave, arquivo, parametros, validade, iteracoes, begin, time(),
+                                 sumario_pre_opt=sumario_pre_opt, sumario=sumario)
+    return registro, rotas_frota(frota)
+
+
+# ######################################################################################################################
+# INDICE DE CONCLUSÃO
+
+
+class IndiceConclusao(object):
+    """Registro (apenas acréscimos) das tarefas concluídas, usado para retomar uma campanha interrompida"""
+
+    def __init__(self, caminho: str):
+        self.caminho = caminho
+        self.concluidas = set()
+        if os.path.exists(caminho):
+            with open(caminho, 'r') as fin:
+                self.concluidas = set(linha.strip() for linha in fin if len(linha.strip()) > 0)
+
+    def __len__(self): return len(self.concluidas)
+    def __contains__(self, chave: str): return chave in self.concluidas
+
+    def registra(self, chave: str):
+        with open(self.caminho, 'a') as fout:
+            fout.write(chave + '\n')
+        self.concluidas.add(chave)
+
+
+# ######################################################################################################################
+# EXECUÇÃO PARALELA
+
+
+_MAPAS = {}  # Mapas compartilhados (somente leitura) pelos processos de trabalho
+
+
+def _inicializa_processo(mapas: Dict[str, Mapa]):
+    # Com fork, os mapas (e suas matrizes) são herdados por cópia-na-escrita, sem serialização
+    # Com spawn, são serializados uma única vez por processo, e não uma vez por tarefa
+    global _MAPAS
+    _MAPAS = mapas
+
+
+def _executa_tarefa(tarefa: Tarefa) -> tuple:
+    random.seed(tarefa.semente)
+    return executa(_MAPAS[tarefa.arquivo], tarefa.parametros, tarefa.arquivo, tarefa.chave, display=False)
+
+
+def carrega_mapas(arquivos: List[str], diretorio_cache: str = None, display=True) -> Dict[str, Mapa]:
+    mapas = {}
+    for arquivo in arquivos:
+        try:
+            mapas[arquivo] = Mapa(arquivo, diretorio_cache=diretorio_cache)
+        except AssertionError as ass:
+            if display: print(arquivo, ass)
+    return mapas
+
+
+def executa_campanha(padrao_instancias: str, grade: List[Dict] = None, repeticoes: int = REPETICOES_PADRAO,
+                     destino: str = 'results', processos: int = None, tamanho_lote: int = 100,
+                     diretorio_cache: str = None, display=True) -> Iterator[dict]:
+
+    # Lemos cada instância (e sua matriz de distâncias) uma única vez, no processo principal
+    # Com um diretório de cache, campanhas seguintes apenas mapeiam as instâncias já lidas
+    mapas = carrega_mapas(sorted(glob.glob(padrao_instancias)), diretorio_cache=diretorio_cache, display=display)
+
+    # Geramos as tarefas, descartando as já concluídas segundo o indice
+    os.makedirs(destino, exist_ok=True)
+    indice = IndiceConclusao(os.path.join(destino, ARQUIVO_INDICE))
+    tarefas = [t for t in gera_tarefas(list(mapas.keys()), grade or GRADE_PADRAO, repeticoes)
+               if t.chave not in indice]
+
+    # As instâncias de horizonte longo (r2, rc2, c2) possuem rotas maiores e demoram mais. Iniciamos por elas,
+    # e distribuímos as tarefas uma a uma entre os processos, à medida que ficam livres
+    tarefas.sort(key=lambda t: -1 * mapas[t.arquivo].capacidade_carro * len(mapas[t.arquivo].clientes))
+    if display: print(f'{len(tarefas)} tarefas pendentes ({len(indice)} concluidas) em {len(mapas)} instancias')
+
+    # Os resultados são acumulados e gravados em lotes no armazém colunar. Uma tarefa só entra no indice de
+    # conclusão depois que o seu lote foi efetivamente gravado
+    armazem = ArmazemResultados(destino, tamanho_lote=tamanho_lote)
+    try:
+        with Pool(processes=processos, initializer=_inicializa_processo, initargs=(mapas,)) as pool:
+            for registro, rotas in pool.imap_unordered(_executa_tarefa, tarefas, chunksize=1):
+                for chave in armazem.acrescenta(registro, rotas):
+                    indice.registra(chave)
+                if display: print(registro['chave'], registro['validade'], registro['iteracoes'],
+                                  round(registro['duracao'], 3))
+                yield registro
+    finally:
+        for chave in armazem.descarrega():
+            indice.registra(chave)
@@ -0,0 +1,180 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""decomposicao.py: Resolução de instâncias grandes por decomposição em setores, resolvidos em paralelo como
+sub-mapas independentes e depois unidos (com melhoria das rotas na fronteira entre setores) em uma única frota"""
+
+__copyright__ = "Copyright (c) 2021 Isabella Freitas & José Fonseca. MIT. See attached LICENSE.txt file"
+
+
+import os
+from math import ceil
+from time import perf_counter
+from typing import List, Dict, Callable, Union
+from multiprocessing import Pool
+
+from numpy import ndarray, arctan2, argsort, argmax, diff, roll, concatenate, array_split, column_stack, bincount, \
+    nonzero, zeros, allclose, pi, int64
+from numpy.random import default_rng
+
+from two_step_vrptw.utils import Mapa, Frota, Parametros
+from two_step_vrptw.distancias import DistanciasDensas
+from two_step_vrptw.resultados import rotas_frota, frota_de_rotas
+from two_step_vrptw import algorithms, busca_local, multipartida
+from two_step_vrptw.insercao import insere_indices
+
+
+TAMANHO_SETOR_PADRAO = 200
+METODOS = ('varredura', 'kmeans')
+
+
+# ######################################################################################################################
+# SETORES
+
+
+def setores_por_varredura(mapa: Mapa, qtd_setores: int) -> List[ndarray]:
+    # Clientes ordenados pelo ângulo em torno do depósito, em fatias com o mesmo número de clientes. A varredura
+    # começa na maior lacuna angular, para que nenhum setor seja cortado no meio de um aglomerado de clientes
+    delta = mapa.coordenadas[1:] - mapa.coordenadas[0]
+    angulos = arctan2(delta[:, 1], delta[:, 0])
+    ordem = argsort(angulos, kind='stable')
+    lacunas = diff(concatenate([angulos[ordem], [angulos[ordem[0]] + 2 * pi]]))
+    ordem = roll(ordem, -((int(argmax(lacunas)) + 1) % len(ordem)))
+    return [parte + 1 for parte in array_split(ordem, qtd_setores) if len(parte) > 0]
+
+
+def setores_por_kmeans(mapa: Mapa, qtd_setores: int, peso_janelas: float = 0.0, semente: int = 0,
+                       limite_iteracoes: int = 50) -> List[ndarray]:
+    # K-means (Lloyd) sobre as coordenadas dos clientes. Com peso_janelas, o centro da janela de tempo de cada cliente
+    # é uma terceira dimensão, escalada para a dispersão das coordenadas: clientes próximos mas com janelas distantes
+    # tendem a ficar em setores diferentes
+    pontos = mapa.coordenadas[1:]
+    if peso_janelas > 0:
+        centros_janelas = (mapa.inicios[1:] + mapa.fins[1:]) / 2
+        escala = pontos.std() / max([centros_janelas.std(), 1e-9])
+        pontos = column_stack([pontos, peso_janelas * escala * centros_janelas])
+    qtd_setores = min([qtd_setores, len(pontos)])
+    centroides = pontos[default_rng(semente).choice(len(pontos), qtd_setores, replace=False)]
+    for _ in range(limite_iteracoes):
+        delta = pontos[:, None, :] - centroides[None, :, :]
+        rotulos = (delta * delta).sum(axis=2).argmin(axis=1)
+        contagens = bincount(rotulos, minlength=qtd_setores)
+        novos = centroides.copy()
+        for dimensao in range(pontos.shape[1]):
+            somas = bincount(rotulos, weights=pontos[:, dimensao], minlength=qtd_setores)
+            novos[contagens > 0, dimensao] = somas[contagens > 0] / contagens[contagens > 0]
+        if allclose(novos, centroides): break
+        centroides = novos
+    return [nonzero(rotulos == setor)[0] + 1 for setor in range(qtd_setores) if contagens[setor] > 0]
+
+
+def decompoe(mapa: Mapa, qtd_setores: int, metodo: str = 'varredura', peso_janelas: float = 0.0,
+             semente: int = 0) -> List[ndarray]:
+    # Particiona os clientes (indices 1..N) em setores disjuntos, sem setores vazios
+    if metodo == 'varredura':
+        return setores_por_varredura(mapa, qtd_setores)
+    elif metodo == 'kmeans':
+        return setores_por_kmeans(mapa, qtd_setores, peso_janelas=peso_janelas, semente=semente)
+    else:
+        raise NotImplementedError(f'Metodo de decomposicao nao implementado: {metodo}')
+
+
+def clientes_de_fronteira(mapa: Mapa, setores: List[ndarray], qtd_vizinhos: int = 10) -> List[int]:
+    # Clientes com ao menos um dos seus qtd_vizinhos mais próximos em outro setor
+    setor_de = zeros(len(mapa.nos), dtype=int64) - 1
+    for setor, indices in enumerate(setores):
+        setor_de[indices] = setor
+    vizinhos = mapa.lista_candidatos(qtd_vizinhos)[1:]
+    return (nonzero((setor_de[vizinhos] != setor_de[1:, None]).any(axis=1))[0] + 1).tolist()
+
+
+# ######################################################################################################################
+# RESOLUÇÃO DOS SETORES
+
+
+def resolve_setor(mapa: Mapa, indices: ndarray, setor: int, parametros: Parametros, qtd_partidas: int = 1,
+                  semente: int = 0, objetivo: Union[str, Callable] = 'carros', **kwargs) -> (dict, List[ndarray]):
+    # Resolve o sub-mapa do setor (partidas sequenciais, neste processo) e retorna as estatísticas da melhor partida
+    # e as suas rotas, já com os indices do mapa original
+    inicio = perf_counter()
+    sub_mapa = mapa.sub_mapa(indices)
+    frota, partidas = multipartida.multipartida(sub_mapa, parametros, qtd_partidas=qtd_partidas, processos=1,
+                                                semente=semente, objetivo=objetivo, **kwargs)
+    melhor = min(partidas, key=lambda estatisticas: multipartida.chave_objetivo(objetivo, estatisticas))
+    originais = concatenate([[0], indices])
+    estatisticas = {**melhor, 'setor': setor, 'qtd_clientes': len(indices), 'qtd_partidas': len(partidas),
+                    'duracao': perf_counter() - inicio, 'processo': os.getpid()}
+    return estatisticas, [originais[rota] for rota in rotas_frota(frota)]
+
+
+_CONFIGURACAO = {}  # Mapa e argumentos comuns a todos os setores
+
+
+def _inicializa_processo(configuracao: dict):
+    global _CONFIGURACAO
+    _CONFIGURACAO = configuracao
+
+
+def _resolve_setor(tarefa: tuple) -> (dict, List[ndarray]):
+    setor, indices = tarefa
+    return resolve_setor(indices=indices, setor=setor, **_CONFIGURACAO)
+
+
+# ######################################################################################################################
+# DECOMPOSIÇÃO
+
+
+def resolve_por_setores(mapa: Mapa, parametros: Parametros, qtd_setores: int = None,
+                        tamanho_setor: int = TAMANHO_SETOR_PADRAO, metodo: str = 'varredura',
+                        peso_janelas: float = 0.0, processos: int = None, semente: int = 0, qtd_partidas: int = 1,
+                        objetivo: Union[str, Callable] = 'carros', tipo: str = 'rota_independente',
+                        velocidade_carro: int = 1, melhora: bool = False, qtd_candidatos: int = None,
+                        largura_feixe: int = None, melhora_fronteira: bool = True, qtd_vizinhos_fronteira: int = 10,
+                        limite_passes_fronteira: int = 3) -> (Frota, bool, List[Dict]):
+    """Resolve o mapa por decomposição: os clientes são particionados em setores (por varredura angular em torno do
+    depósito, ou por k-means, opcionalmente também sobre as janelas de tempo), e cada setor é resolvido como um
+    sub-mapa independente (qtd_partidas partidas, como em multipartida) em um pool de processos. As rotas dos setores
+    são unidas em uma única frota sobre o mapa original, onde:
+    - os carros de setores diferentes são unidos pela otimização de término mais cedo;
+    - os clientes que algum setor não conseguiu atender são inseridos nas rotas existentes (insere_indices);
+    - com melhora_fronteira, a busca local (até limite_passes_fronteira passes, pois esta etapa não é paralela) é
+      aplicada aos clientes da fronteira entre setores.
+    Sem qtd_setores, usamos setores de cerca de tamanho_setor clientes.
+    Retorna a frota, a sua validade (todos os clientes atendidos, com no máximo max_carros) e as estatísticas de cada
+    setor, em ordem"""
+    processos = processos or os.cpu_count()
+    qtd_setores = qtd_setores or max([1, ceil(len(mapa.clientes) / tamanho_setor)])
+    setores = decompoe(mapa, qtd_setores, metodo=metodo, peso_janelas=peso_janelas, semente=semente)
+    configuracao = {'mapa': mapa, 'parametros': parametros, 'qtd_partidas': qtd_partidas, 'semente': semente,
+                    'objetivo': objetivo, 'tipo': tipo, 'velocidade_carro': velocidade_carro, 'otimiza': True,
+                    'melhora': melhora, 'qtd_candidatos': qtd_candidatos, 'largura_feixe': largura_feixe}
+
+    # Cada processo recebe o mapa uma única vez (no inicializador) e monta os sub-mapas dos seus setores. A matriz
+    # densa vai para a memória compartilhada, como em multipartida. Os setores maiores são distribuídos primeiro,
+    # para equilibrar a carga entre os processos
+    tarefas = sorted(enumerate(setores), key=lambda tarefa: -len(tarefa[1]))
+    if processos == 1 or len(setores) == 1:
+        resultados = [resolve_setor(indices=indices, setor=setor, **configuracao) for setor, indices in tarefas]
+    else:
+        compartilhado = mapa.compartilhado() if isinstance(mapa.distancias, DistanciasDensas) else None
+        if compartilhado is not None: configuracao['mapa'] = compartilhado
+        try:
+            with Pool(processes=min([processos, len(setores)]), initializer=_inicializa_processo,
+                      initargs=(configuracao,)) as pool:
+                resultados = pool.map(_resolve_setor, tarefas, chunksize=1)
+        finally:
+            if compartilhado is not None: compartilhado.distancias.libera()
+    estatisticas = sorted([estatisticas for estatisticas, _ in resultados], key=lambda e: e['setor'])
+
+    # União dos setores: carros de setores diferentes que não se sobrepõem no tempo são encadeados, e os clientes
+    # não atendidos são inseridos na posição mais barata entre todas as rotas
+    frota = frota_de_rotas(mapa, [rota for _, rotas in resultados for rota in rotas], velocidade_carro,
+                           qtd_candidatos=qtd_candidatos)
+    algorithms.otimizacao_termino_mais_cedo(frota)
+    if frota.qtd_clientes_faltantes > 0:
+        insere_indices(frota, sorted(frota.clientes_faltantes))
+    if melhora_fronteira and len(setores) > 1 and frota.qtd_clientes_faltantes == 0:
+        busca_local.busca_local(frota, qtd_candidatos=qtd_vizinhos_fronteira, limite_passes=limite_passes_fronteira,
+                                clientes=clientes_de_fronteira(mapa, setores, qtd_vizinhos_fronteira))
+    validade = frota.qtd_clientes_faltantes == 0 and len(frota) <= frota.max_carros
+    return frota, validade, estatisticas
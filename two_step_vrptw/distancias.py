@@ -0,0 +1,324 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""distancias.py: Provedores de distâncias e tempos de deslocamento (densos, quantizados ou sob demanda)"""
+
+__copyright__ = "Copyright (c) 2021 Isabella Freitas & José Fonseca. MIT. See attached LICENSE.txt file"
+
+
+from collections import OrderedDict
+from multiprocessing import shared_memory
+
+from numpy import ndarray, empty, vstack, ix_, rint, sqrt, float64, int32, int64
+
+from two_step_vrptw.instancias import matriz_de_distancias
+
+
+MODOS = ('densa', 'quantizada', 'sob_demanda')
+
+
+def distancias_entre(origens: ndarray, destinos: ndarray) -> ndarray:
+    # Matriz (origens x destinos) de distâncias euclidianas arredondadas em 3 casas, como a matriz do mapa
+    delta = origens.astype(float64)[:, None, :] - destinos.astype(float64)[None, :, :]
+    return sqrt((delta * delta).sum(axis=2)).round(3)
+
+
+def matriz_estendida(matriz: ndarray, novas_linhas: ndarray) -> ndarray:
+    # Acrescenta k pontos a uma matriz simétrica N x N: novas_linhas (k x N+k) são as linhas (e colunas) dos novos
+    # pontos. O bloco existente é apenas copiado
+    qtd = matriz.shape[0]
+    estendida = empty((novas_linhas.shape[1], novas_linhas.shape[1]), dtype=matriz.dtype)
+    estendida[:qtd, :qtd] = matriz
+    estendida[qtd:, :] = novas_linhas
+    estendida[:qtd, qtd:] = novas_linhas[:, :qtd].T
+    return estendida
+
+
+# ######################################################################################################################
+# INTERFACE
+
+
+class ProvedorDistancias(object):
+    """Acesso às distâncias (arredondadas em 3 casas) e aos tempos de deslocamento (int(d/v)+1) entre os pontos
+    de um mapa, por indice. Os caminhos críticos do algoritmo só acessam linhas e pares, nunca a matriz inteira"""
+
+    def __len__(self): raise NotImplementedError()
+    def linha(self, origem: int) -> ndarray: raise NotImplementedError()
+
+    @property
+    def nbytes(self) -> int: raise NotImplementedError()
+
+    def linha_tempos(self, origem: int, velocidade: int) -> ndarray:
+        return (self.linha(origem) / velocidade).astype(int64) + 1
+
+    def tempo(self, origem: int, destino: int, velocidade: int) -> int:
+        return int(self.linha(origem)[destino] / velocidade) + 1
+
+    def distancias_para(self, origem: int, destinos: ndarray) -> ndarray:
+        # Distâncias apenas até os destinos informados (p.ex. uma lista de candidatos)
+        return self.linha(origem)[destinos]
+
+    def linhas(self, origens: ndarray, destinos: ndarray = None) -> ndarray:
+        # Matriz (origens x destinos) de várias origens de uma vez (p.ex. as posições de todos os carros)
+        if destinos is None: return vstack([self.linha(origem) for origem in origens])
+        return vstack([self.distancias_para(origem, destinos) for origem in origens])
+
+    def linhas_tempos(self, origens: ndarray, velocidade: int, destinos: ndarray = None) -> ndarray:
+        return (self.linhas(origens, destinos) / velocidade).astype(int64) + 1
+
+    def tempos_para(self, origem: int, destinos: ndarray, velocidade: int) -> ndarray:
+        return (self.distancias_para(origem, destinos) / velocidade).astype(int64) + 1
+
+    def distancia(self, origem: int, destino: int) -> float:
+        return float(self.linha(origem)[destino])
+
+    def matriz_de_tempos(self, velocidade: int) -> ndarray:
+        return (self.matriz_completa() / velocidade).astype(int64) + 1
+
+    def estendido(self, coordenadas: ndarray) -> 'ProvedorDistancias':
+        # Novo provedor para as coordenadas informadas: as atuais seguidas das de novos pontos. Apenas as distâncias
+        # de (e para) os novos pontos são calculadas
+        raise NotImplementedError()
+
+    def restrito(self, indices: ndarray) -> 'ProvedorDistancias':
+        # Novo provedor apenas para os pontos informados (p.ex. um setor do mapa), reindexados 0..k-1 na mesma ordem
+        raise NotImplementedError()
+
+    def matriz_completa(self) -> ndarray:
+        # Materializa a matriz N x N. Útil para análise, mas evitado nos caminhos críticos
+        matriz = empty((len(self), len(self)), dtype=float64)
+        for origem in range(len(self)):
+            matriz[origem] = self.linha(origem)
+        return matriz
+
+
+# ######################################################################################################################
+# IMPLEMENTAÇÕES
+
+
+class DistanciasDensas(ProvedorDistancias):
+    """Matriz completa em memória (float64, ou float32 para reduzir a memória pela metade).
+    As matrizes de tempo são pré-computadas uma única vez por velocidade"""
+
+    def __init__(self, matriz: ndarray):
+        self.matriz = matriz
+        self.matrizes_de_tempos = {}
+
+    def __repr__(self): return f'DistanciasDensas({len(self)}x{len(self)} {self.matriz.dtype})'
+    def __len__(self): return self.matriz.shape[0]
+    def linha(self, origem: int) -> ndarray: return self.matriz[origem]
+
+    @property
+    def nbytes(self) -> int:
+        return self.matriz.nbytes + sum(m.nbytes for m in self.matrizes_de_tempos.values())
+
+    def matriz_de_tempos(self, velocidade: int) -> ndarray:
+        if velocidade not in self.matrizes_de_tempos:
+            self.matrizes_de_tempos[velocidade] = (self.matriz.astype(float64) / velocidade).astype(int64) + 1
+        return self.matrizes_de_tempos[velocidade]
+
+    def linha_tempos(self, origem: int, velocidade: int) -> ndarray:
+        return self.matriz_de_tempos(velocidade)[origem]
+
+    def tempo(self, origem: int, destino: int, velocidade: int) -> int:
+        return int(self.matriz_de_tempos(velocidade)[origem, destino])
+
+    def tempos_para(self, origem: int, destinos: ndarray, velocidade: int) -> ndarray:
+        return self.matriz_de_tempos(velocidade)[origem, destinos]
+
+    def linhas(self, origens: ndarray, destinos: ndarray = None) -> ndarray:
+        return self.matriz[origens] if destinos is None else self.matriz[ix_(origens, destinos)]
+
+    def linhas_tempos(self, origens: ndarray, velocidade: int, destinos: ndarray = None) -> ndarray:
+        tempos = self.matriz_de_tempos(velocidade)
+        return tempos[origens] if destinos is None else tempos[ix_(origens, destinos)]
+
+    def matriz_completa(self) -> ndarray:
+        return self.matriz
+
+    def estendido(self, coordenadas: ndarray) -> 'DistanciasDensas':
+        # As matrizes de tempo já calculadas também são estendidas, apenas nas novas linhas e colunas
+        novas_linhas = distancias_entre(coordenadas[len(self):], coordenadas).astype(self.matriz.dtype)
+        provedor = DistanciasDensas(matriz_estendida(self.matriz, novas_linhas))
+        for velocidade, tempos in self.matrizes_de_tempos.items():
+            novos_tempos = (novas_linhas.astype(float64) / velocidade).astype(int64) + 1
+            provedor.matrizes_de_tempos[velocidade] = matriz_estendida(tempos, novos_tempos)
+        return provedor
+
+    def restrito(self, indices: ndarray) -> 'DistanciasDensas':
+        # Submatrizes (cópias) das distâncias e dos tempos já calculados
+        provedor = DistanciasDensas(self.matriz[ix_(indices, indices)])
+        for velocidade, tempos in self.matrizes_de_tempos.items():
+            provedor.matrizes_de_tempos[velocidade] = tempos[ix_(indices, indices)]
+        return provedor
+
+
+class DistanciasCompartilhadas(DistanciasDensas):
+    """Matriz densa (e matrizes de tempo pré-computadas por velocidade) em blocos de memória compartilhada.
+    Ao ser serializado (p.ex. para processos de trabalho com spawn), o provedor transmite apenas os nomes dos blocos,
+    e cada processo mapeia as mesmas matrizes, sem cópia. Apenas o provedor original libera (unlink) os blocos"""
+
+    def __init__(self, matriz: ndarray, velocidades=()):
+        self.blocos = {}
+        self.proprietario = True
+        self.matriz = self._compartilha('distancias', matriz)
+        self.matrizes_de_tempos = {}
+        for velocidade in velocidades:
+            tempos = (matriz.astype(float64) / velocidade).astype(int64) + 1
+            self.matrizes_de_tempos[velocidade] = self._compartilha(velocidade, tempos)
+
+    def __repr__(self): return f'DistanciasCompartilhadas({len(self)}x{len(self)} {self.matriz.dtype} |{len(self.blocos)}|)'
+
+    def _compartilha(self, chave, matriz: ndarray) -> ndarray:
+        bloco = shared_memory.SharedMemory(create=True, size=max([1, matriz.nbytes]))
+        vista = ndarray(matriz.shape, dtype=matriz.dtype, buffer=bloco.buf)
+        vista[:] = matriz
+        self.blocos[chave] = bloco
+        return vista
+
+    def _vista(self, chave) -> ndarray:
+        return self.matriz if chave == 'distancias' else self.matrizes_de_tempos[chave]
+
+    def __getstate__(self):
+        return {chave: (bloco.name, self._vista(chave).shape, self._vista(chave).dtype.str)
+                for chave, bloco in self.blocos.items()}
+
+    def __setstate__(self, estado):
+        self.blocos = {}
+        self.proprietario = False
+        self.matrizes_de_tempos = {}
+        for chave, (nome, forma, tipo) in estado.items():
+            bloco = shared_memory.SharedMemory(name=nome)
+            self.blocos[chave] = bloco
+            vista = ndarray(forma, dtype=tipo, buffer=bloco.buf)
+            if chave == 'distancias':
+                self.matriz = vista
+            else:
+                self.matrizes_de_tempos[chave] = vista
+
+    def libera(self):
+        # Vistas ainda em uso (p.ex. linhas retornadas) impedem o fechamento local, mas não a remoção dos blocos
+        self.matriz = None
+        self.matrizes_de_tempos = {}
+        for bloco in self.blocos.values():
+            try:
+                bloco.close()
+            except BufferError:
+                pass
+            if self.proprietario: bloco.unlink()
+        self.blocos = {}
+
+
+class DistanciasQuantizadas(ProvedorDistancias):
+    """Matriz completa em int32, com as distâncias multiplicadas pela escala. Com a escala padrão (1000), a
+    representação é exata para distâncias arredondadas em 3 casas, com metade da memória de float64.
+    A matriz é calculada em blocos de linhas, sem nunca materializar a versão float64 inteira"""
+
+    def __init__(self, coordenadas: ndarray, escala: int = 1000, tamanho_bloco: int = 1024, matriz: ndarray = None):
+        self.escala = escala
+        self.tamanho_bloco = tamanho_bloco
+        self.matriz = matriz
+        if matriz is not None: return
+        self.matriz = empty((coordenadas.shape[0], coordenadas.shape[0]), dtype=int32)
+        for inicio in range(0, coordenadas.shape[0], tamanho_bloco):
+            self.matriz[inicio:inicio+tamanho_bloco] = self.quantiza(coordenadas[inicio:inicio+tamanho_bloco], coordenadas)
+
+    def quantiza(self, origens: ndarray, destinos: ndarray) -> ndarray:
+        return rint(distancias_entre(origens, destinos) * self.escala)
+
+    def __repr__(self): return f'DistanciasQuantizadas({len(self)}x{len(self)} /{self.escala})'
+    def __len__(self): return self.matriz.shape[0]
+    def linha(self, origem: int) -> ndarray: return self.matriz[origem] / self.escala
+
+    @property
+    def nbytes(self) -> int: return self.matriz.nbytes
+
+    def distancias_para(self, origem: int, destinos: ndarray) -> ndarray:
+        return self.matriz[origem, destinos] / self.escala
+
+    def distancia(self, origem: int, destino: int) -> float:
+        return float(self.matriz[origem, destino] / self.escala)
+
+    def tempo(self, origem: int, destino: int, velocidade: int) -> int:
+        return int(self.matriz[origem, destino] / self.escala / velocidade) + 1
+
+    def linhas(self, origens: ndarray, destinos: ndarray = None) -> ndarray:
+        return (self.matriz[origens] if destinos is None else self.matriz[ix_(origens, destinos)]) / self.escala
+
+    def estendido(self, coordenadas: ndarray) -> 'DistanciasQuantizadas':
+        novas_linhas = self.quantiza(coordenadas[len(self):], coordenadas).astype(int32)
+        return DistanciasQuantizadas(coordenadas, escala=self.escala, tamanho_bloco=self.tamanho_bloco,
+                                     matriz=matriz_estendida(self.matriz, novas_linhas))
+
+    def restrito(self, indices: ndarray) -> 'DistanciasQuantizadas':
+        return DistanciasQuantizadas(None, escala=self.escala, tamanho_bloco=self.tamanho_bloco,
+                                     matriz=self.matriz[ix_(indices, indices)])
+
+
+class DistanciasSobDemanda(ProvedorDistancias):
+    """Apenas as coordenadas ficam em memória. Cada linha de distâncias é calculada quando requisitada e mantida
+    em um cache LRU de linhas, limitado pelo orçamento de memória (em bytes)"""
+
+    def __init__(self, coordenadas: ndarray, orcamento_memoria: int = 64 * 2**20):
+        self.coordenadas = coordenadas.astype(float64)
+        self.orcamento_memoria = orcamento_memoria
+        self.max_linhas = max([1, orcamento_memoria // (self.coordenadas.shape[0] * 8)])
+        self.cache_linhas = OrderedDict()
+        self.acertos = 0
+        self.falhas = 0
+
+    def __repr__(self): return f'DistanciasSobDemanda({len(self)} |{len(self.cache_linhas)}/{self.max_linhas}| +{self.acertos} -{self.falhas})'
+    def __len__(self): return self.coordenadas.shape[0]
+
+    @property
+    def nbytes(self) -> int:
+        return self.coordenadas.nbytes + sum(linha.nbytes for linha in self.cache_linhas.values())
+
+    def linha(self, origem: int) -> ndarray:
+        linha = self.cache_linhas.get(origem)
+        if linha is not None:
+            self.cache_linhas.move_to_end(origem)
+            self.acertos += 1
+            return linha
+        self.falhas += 1
+        delta = self.coordenadas - self.coordenadas[origem]
+        linha = sqrt((delta * delta).sum(axis=1)).round(3)
+        self.cache_linhas[origem] = linha
+        if len(self.cache_linhas) > self.max_linhas:
+            self.cache_linhas.popitem(last=False)  # Descartamos a linha usada há mais tempo
+        return linha
+
+    def distancias_para(self, origem: int, destinos: ndarray) -> ndarray:
+        # Poucos destinos são calculados diretamente, sem calcular (nem guardar no cache) a linha inteira
+        linha = self.cache_linhas.get(origem)
+        if linha is not None: return linha[destinos]
+        delta = self.coordenadas[destinos] - self.coordenadas[origem]
+        return sqrt((delta * delta).sum(axis=1)).round(3)
+
+    def distancia(self, origem: int, destino: int) -> float:
+        # Pares isolados também são calculados diretamente, a menos que a linha da origem já esteja no cache
+        linha = self.cache_linhas.get(origem)
+        if linha is not None: return float(linha[destino])
+        delta = self.coordenadas[destino] - self.coordenadas[origem]
+        return float(sqrt((delta * delta).sum()).round(3))
+
+    def tempo(self, origem: int, destino: int, velocidade: int) -> int:
+        return int(self.distancia(origem, destino) / velocidade) + 1
+
+    def estendido(self, coordenadas: ndarray) -> 'DistanciasSobDemanda':
+        # As linhas em cache não possuem as colunas dos novos pontos: o novo provedor inicia com o cache vazio
+        return DistanciasSobDemanda(coordenadas, orcamento_memoria=self.orcamento_memoria)
+
+    def restrito(self, indices: ndarray) -> 'DistanciasSobDemanda':
+        return DistanciasSobDemanda(self.coordenadas[indices], orcamento_memoria=self.orcamento_memoria)
+
+
+def cria_provedor(modo: str, coordenadas: ndarray, matriz: ndarray = None, **kwargs) -> ProvedorDistancias:
+    if modo == 'densa':
+        return DistanciasDensas(matriz if matriz is not None else matriz_de_distancias(coordenadas, **kwargs))
+    elif modo == 'quantizada':
+        return DistanciasQuantizadas(coordenadas, **kwargs)
+    elif modo == 'sob_demanda':
+        return DistanciasSobDemanda(coordenadas, **kwargs)
+    else:
+        raise NotImplementedError(f'Modo de distancias nao implementado: {modo}')
@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""insercao.py: Inserção incremental de novos clientes em uma frota já resolvida, sem refazer a solução"""
+
+__copyright__ = "Copyright (c) 2021 Isabella Freitas & José Fonseca. MIT. See attached LICENSE.txt file"
+
+
+from typing import List, Dict
+from time import perf_counter
+
+from numpy import argpartition
+
+from two_step_vrptw.utils import Cliente, Frota
+from two_step_vrptw.busca_local import Avaliador, Rota, refaz_carro, EPSILON
+
+
+# ######################################################################################################################
+# INSERÇÃO MAIS BARATA
+
+
+def posicoes_permitidas(frota: Frota, cliente: int, qtd_candidatos: int = None) -> set:
+    # Com qtd_candidatos, o cliente só é inserido ao lado de um dos seus k vizinhos mais próximos (ou de um depósito)
+    if qtd_candidatos is None: return None
+    linha = frota.mapa.linha_distancias(cliente)
+    k = min([qtd_candidatos + 1, len(linha) - 1])
+    vizinhos = argpartition(linha, k)[:k + 1].tolist()
+    return set(vizinhos) - {cliente} | {frota.deposito.indice}
+
+
+def melhor_insercao(avaliador: Avaliador, rotas: Dict[str, Rota], cliente: int, permitidos: set = None) -> tuple:
+    # Retorna (aumento de distância, rota, posição) da inserção viável mais barata do cliente logo após rota.nos[posição]
+    # Cada posição é avaliada em O(1), pela concatenação do prefixo, do cliente e do sufixo da rota. Antes disso,
+    # descartamos as posições cuja viagem não comporta a demanda, ou das quais o carro só parte após o fim da janela
+    segmento = avaliador.segmentos[cliente]
+    fim_janela = avaliador.fins[cliente]
+    folga_carga = avaliador.capacidade - segmento.carga_inicial
+    melhor = None
+    for rota in rotas.values():
+        distancia_atual = rota.segmento.distancia
+        prefixos, sufixos, nos = rota.prefixos, rota.sufixos, rota.nos
+        for posicao in range(len(nos) - 1):
+            prefixo, sufixo = prefixos[posicao], sufixos[posicao+1]
+            if prefixo.fim >= fim_janela: break  # Os términos dos prefixos só crescem ao longo da rota
+            carga_viagem = (0.0 if nos[posicao] == avaliador.deposito else prefixo.carga_final) + \
+                           (0.0 if nos[posicao+1] == avaliador.deposito else sufixo.carga_inicial)
+            if carga_viagem > folga_carga: continue
+            if permitidos is not None and nos[posicao] not in permitidos and nos[posicao+1] not in permitidos:
+                continue
+            nova = avaliador.encadeia(prefixo, segmento, sufixo)
+            if not nova.rota_viavel: continue
+            custo = nova.distancia - distancia_atual
+            if melhor is None or custo < melhor[0] - EPSILON:
+                melhor = (custo, rota, posicao)
+    return melhor
+
+
+def insere_indices(frota: Frota, indices: List[int], qtd_candidatos: int = None) -> Dict[str, list]:
+    """Insere cada cliente ainda não atendido (indices do mapa da frota), na ordem informada, na posição viável mais
+    barata (em distância) das agendas existentes. Um novo carro só é aberto quando nenhuma inserção é viável,
+    respeitando max_carros. Apenas os carros alterados são refeitos. Com qtd_candidatos, só são avaliadas as posições
+    vizinhas aos k clientes mais próximos de cada cliente.
+    Retorna os (indice, carro) inseridos, os novos carros e os indices dos clientes que não puderam ser atendidos"""
+    instrumentacao = frota.instrumentacao
+    if instrumentacao is not None: inicio = perf_counter()
+    mapa = frota.mapa
+    deposito = mapa.deposito.indice
+    avaliador = Avaliador(mapa, frota.velocidade_carro, frota.capacidade_carro)
+
+    # Como na busca local, as rotas são avaliadas fechadas (terminando no depósito). Rotas abertas continuam abertas
+    abertas = set(carro.id for carro in frota if carro.posicao.tipo == 'Cliente')
+    rotas = {carro.id: Rota(avaliador, carro.rota.tolist() + ([deposito] if carro.id in abertas else []), carro.id)
+             for carro in frota}
+    resultado = {'inseridos': [], 'novos_carros': [], 'nao_inseridos': []}
+    alterados = set()
+
+    for cliente in indices:
+        melhor = melhor_insercao(avaliador, rotas, cliente, posicoes_permitidas(frota, cliente, qtd_candidatos))
+        if melhor is not None:
+            _, rota, posicao = melhor
+            rota = Rota(avaliador, rota.nos[:posicao+1] + [cliente] + rota.nos[posicao+1:], rota.id_carro)
+        elif len(frota.carros) < frota.max_carros and \
+                avaliador.sequencia([deposito, cliente, deposito]).rota_viavel:
+            rota = Rota(avaliador, [deposito, cliente, deposito], frota.novo_id_carro())
+            frota.carros[rota.id_carro] = None  # Reservamos o id. O carro é criado ao final, com os demais
+            resultado['novos_carros'].append(rota.id_carro)
+        else:
+            resultado['nao_inseridos'].append(cliente)
+            continue
+        rotas[rota.id_carro] = rota
+        alterados.add(rota.id_carro)
+        resultado['inseridos'].append((cliente, rota.id_carro))
+
+    # Refazemos apenas os carros alterados, e registramos os clientes inseridos como atendidos
+    for id_carro in alterados:
+        nos = rotas[id_carro].nos
+        if id_carro in abertas: nos = nos[:-1]
+        frota.carros[id_carro] = refaz_carro(frota, nos, id_carro)
+    for cliente, _ in resultado['inseridos']:
+        frota.registra_atendimento(mapa.nos[cliente])
+
+    if instrumentacao is not None:
+        instrumentacao.conta('insercao.inseridos', len(resultado['inseridos']))
+        instrumentacao.conta('insercao.novos_carros', len(resultado['novos_carros']))
+        instrumentacao.conta('insercao.nao_inseridos', len(resultado['nao_inseridos']))
+        instrumentacao.cronometra('insercao', inicio)
+    return resultado
+
+
+def insere_clientes(frota: Frota, clientes: List[Cliente], qtd_candidatos: int = None) -> Dict[str, list]:
+    """Acrescenta os novos clientes ao mapa da frota (estendendo as distâncias apenas nas novas linhas e colunas) e
+    os insere, na ordem informada, como em insere_indices"""
+    mapa = frota.mapa.com_clientes(clientes)
+    frota.substitui_mapa(mapa)
+    return insere_indices(frota, list(range(len(mapa.nos) - len(clientes), len(mapa.nos))), qtd_candidatos)
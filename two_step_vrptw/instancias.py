@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""instancias.py: Leitura vetorizada de instâncias (Solomon e Gehring-Homberger) e cache binário de mapas"""
+
+__copyright__ = "Copyright (c) 2021 Isabella Freitas & José Fonseca. MIT. See attached LICENSE.txt file"
+
+
+import os
+from hashlib import sha1
+
+from numpy import ndarray, array, load, save, savez, sqrt, ascontiguousarray, float64, int64
+
+
+VERSAO_CACHE = 1
+COLUNAS = ('numero', 'x', 'y', 'demanda', 'inicio', 'fim', 'servico')
+
+
+# ######################################################################################################################
+# LEITURA
+
+
+def le_instancia(arquivo: str) -> (str, int, int, ndarray):
+    """Lê um arquivo no formato de Solomon (também usado nas instâncias de 200 a 1000 clientes de Gehring-Homberger)
+    Retorna o nome, o número máximo e a capacidade dos veículos e uma matriz (N+1 x 7) com as colunas de COLUNAS,
+    sendo a primeira linha o depósito"""
+    with open(arquivo, 'r') as fin:
+        linhas = [linha.strip() for linha in fin]
+    linhas = [linha for linha in linhas if len(linha) > 0]
+    nome_teste = linhas[0]
+
+    # Os valores dos veículos estão na primeira linha após o cabeçalho 'NUMBER CAPACITY'
+    # Os pontos estão em todas as linhas após a seção 'CUSTOMER' e seu cabeçalho, lidos de uma única vez
+    linha_veiculos = next(i for i, linha in enumerate(linhas) if linha.upper().startswith('NUMBER')) + 1
+    max_carros, capacidade_carro = [int(v) for v in linhas[linha_veiculos].split()]
+    linha_pontos = next(i for i, linha in enumerate(linhas) if linha.upper().startswith('CUSTOMER')) + 2
+    valores = array(' '.join(linhas[linha_pontos:]).split(), dtype=float64).reshape(-1, len(COLUNAS))
+
+    # Mantemos valores inteiros quando o arquivo só possui inteiros (caso de Solomon e Gehring-Homberger)
+    if (valores == valores.round()).all(): valores = valores.astype(int64)
+    return nome_teste, max_carros, capacidade_carro, valores
+
+
+def valida_janelas(valores: ndarray):
+    # Mesma validação de Cliente.__post_init__, aplicada de uma vez a todos os clientes
+    clientes = valores[1:]
+    invalidos = ((clientes[:, 5] - clientes[:, 4]) < clientes[:, 6]).nonzero()[0]
+    if len(invalidos) > 0:
+        _, x, y, demanda, inicio, fim, servico = clientes[invalidos[0]].tolist()
+        raise AssertionError(f'CLIENTE COM JANELA DE SERVICO INVALIDA! CLIENTE({demanda} ({x}, {y}) [{inicio}, {fim}] {servico})')
+
+
+def matriz_de_distancias(coordenadas: ndarray, dtype=float64) -> ndarray:
+    # Distancias euclidianas (arredondadas em 3 casas) entre todos os pontos, em uma única operação vetorizada
+    coordenadas = coordenadas.astype(float64)
+    delta = coordenadas[:, None, :] - coordenadas[None, :, :]
+    return ascontiguousarray(sqrt((delta * delta).sum(axis=2)).round(3), dtype=dtype)
+
+
+# ######################################################################################################################
+# CACHE BINÁRIO
+
+
+def chave_cache(arquivo: str, dtype=float64) -> str:
+    with open(arquivo, 'rb') as fin:
+        conteudo = sha1(fin.read()).hexdigest()
+    return f'{conteudo}-v{VERSAO_CACHE}-{array([], dtype=dtype).dtype.name}'
+
+
+def carrega_cache(arquivo: str, diretorio_cache: str, dtype=float64, com_matriz=True):
+    # Os pontos ficam em um NPZ, e a matriz em um NPY separado, mapeado em memória (somente leitura)
+    caminho = os.path.join(diretorio_cache, chave_cache(arquivo, dtype))
+    if not os.path.exists(caminho + '.npz'): return None
+    if com_matriz and not os.path.exists(caminho + '.npy'): return None
+    with load(caminho + '.npz', allow_pickle=False) as dados:
+        if int(dados['versao']) != VERSAO_CACHE: return None
+        nome_teste, max_carros, capacidade_carro = str(dados['nome']), int(dados['max_carros']), int(dados['capacidade_carro'])
+        valores = dados['valores']
+    matriz = load(caminho + '.npy', mmap_mode='r') if com_matriz else None
+    return nome_teste, max_carros, capacidade_carro, valores, matriz
+
+
+def grava_cache(arquivo: str, diretorio_cache: str, nome_teste: str, max_carros: int, capacidade_carro: int,
+                valores: ndarray, matriz: ndarray, dtype=float64):
+    # A matriz é gravada antes dos pontos: um NPZ existente sempre tem a sua matriz completa ao lado
+    os.makedirs(diretorio_cache, exist_ok=True)
+    caminho = os.path.join(diretorio_cache, chave_cache(arquivo, dtype))
+    with open(caminho + '.npy.tmp', 'wb') as fout:
+        save(fout, matriz)
+    os.replace(caminho + '.npy.tmp', caminho + '.npy')
+    with open(caminho + '.npz.tmp', 'wb') as fout:
+        savez(fout, versao=VERSAO_CACHE, nome=nome_teste, max_carros=max_carros, capacidade_carro=capacidade_carro,
+              valores=valores)
+    os.replace(caminho + '.npz.tmp', caminho + '.npz')
+
+
+def carrega_instancia(arquivo: str, dtype=float64, diretorio_cache: str = None,
+                      com_matriz=True) -> (str, int, int, ndarray, ndarray):
+    """Retorna (nome, max_carros, capacidade_carro, valores, matriz_de_distancias), lendo do cache se possível.
+    Sem com_matriz, a matriz não é calculada (retorna None) nem gravada no cache.
+    Instâncias inválidas levantam AssertionError e nunca são gravadas no cache"""
+    if diretorio_cache is not None:
+        dados = carrega_cache(arquivo, diretorio_cache, dtype, com_matriz=com_matriz)
+        if dados is not None: return dados
+    nome_teste, max_carros, capacidade_carro, valores = le_instancia(arquivo)
+    valida_janelas(valores)
+    if not com_matriz: return nome_teste, max_carros, capacidade_carro, valores, None
+    matriz = matriz_de_distancias(valores[:, 1:3], dtype=dtype)
+    if diretorio_cache is not None:
+        grava_cache(arquivo, diretorio_cache, nome_teste, max_carros, capacidade_carro, valores, matriz, dtype)
+    return nome_teste, max_carros, capacidade_carro, valores, matriz
@@ -0,0 +1,55 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""instrumentacao.py: Contadores, cronômetros e ganchos (opcionais) dos caminhos críticos do algoritmo"""
+
+__copyright__ = "Copyright (c) 2021 Isabella Freitas & José Fonseca. MIT. See attached LICENSE.txt file"
+
+
+from time import perf_counter
+from typing import Callable, List
+from collections import defaultdict
+
+
+CONTADOR = 'contador'
+TEMPO = 'tempo'
+
+
+class Instrumentacao(object):
+    """Coletor de estatísticas de execução. É ligado a uma Frota (frota.instrumentacao), e cada ponto instrumentado
+    verifica apenas se ele existe: sem instrumentação, o custo é de um acesso de atributo por chamada.
+    Ganchos inscritos recebem cada evento como (tipo, nome, valor), com tipo CONTADOR ou TEMPO (em segundos)"""
+
+    def __init__(self):
+        self.contadores = defaultdict(int)
+        self.tempos = defaultdict(float)
+        self.ganchos: List[Callable[[str, str, float], None]] = []
+
+    def __repr__(self): return f'Instrumentacao(|{len(self.contadores)}| contadores |{len(self.tempos)}| tempos)'
+    def __str__(self): return self.__repr__()
+
+    def inscreve(self, gancho: Callable[[str, str, float], None]):
+        self.ganchos.append(gancho)
+
+    def desinscreve(self, gancho: Callable[[str, str, float], None]):
+        self.ganchos.remove(gancho)
+
+    def conta(self, nome: str, valor=1):
+        self.contadores[nome] += valor
+        for gancho in self.ganchos:
+            gancho(CONTADOR, nome, valor)
+
+    def cronometra(self, nome: str, inicio: float):
+        # Acumula o tempo decorrido desde 'inicio' (obtido de perf_counter) na fase 'nome'
+        decorrido = perf_counter() - inicio
+        self.tempos[nome] += decorrido
+        for gancho in self.ganchos:
+            gancho(TEMPO, nome, decorrido)
+
+    @property
+    def estatisticas(self) -> dict:
+        return {'contadores': dict(self.contadores), 'tempos': dict(self.tempos)}
+
+    def limpa(self):
+        self.contadores.clear()
+        self.tempos.clear()
@@ -0,0 +1,210 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""multipartida.py: Múltiplas partidas independentes de gera_solucao, em paralelo e com sementes reprodutíveis,
+e o modo com prazo, que fornece as melhores soluções encontradas à medida que surgem"""
+
+__copyright__ = "Copyright (c) 2021 Isabella Freitas & José Fonseca. MIT. See attached LICENSE.txt file"
+
+
+import os
+from time import perf_counter
+from typing import List, Dict, Callable, Union, Iterator
+from dataclasses import dataclass
+from collections import deque
+from multiprocessing import Pool
+
+from numpy import ndarray
+from numpy.random import Generator, SeedSequence, default_rng
+
+from two_step_vrptw.utils import Mapa, Frota, Parametros
+from two_step_vrptw.distancias import DistanciasDensas, DistanciasCompartilhadas
+from two_step_vrptw.resultados import rotas_frota, frota_de_rotas
+from two_step_vrptw import algorithms, busca_local
+
+
+# ######################################################################################################################
+# OBJETIVOS
+
+
+# Cada objetivo ordena as estatísticas de uma partida (menor é melhor). Soluções inválidas são sempre as piores,
+# e empates são resolvidos pelo número da partida, para que a escolha não dependa da ordem de conclusão
+OBJETIVOS = {
+    'carros': lambda estatisticas: (estatisticas['qtd_carros'], estatisticas['distancia']),
+    'distancia': lambda estatisticas: (estatisticas['distancia'], estatisticas['qtd_carros']),
+    'tempo_total': lambda estatisticas: (estatisticas['tempo_total'], estatisticas['qtd_carros']),
+}
+
+
+def chave_objetivo(objetivo: Union[str, Callable], estatisticas: dict) -> tuple:
+    funcao = OBJETIVOS[objetivo] if isinstance(objetivo, str) else objetivo
+    return (not estatisticas['validade'], funcao(estatisticas), estatisticas['partida'])
+
+
+# ######################################################################################################################
+# UMA PARTIDA
+
+
+def gerador_da_partida(semente: int, partida: int) -> Generator:
+    # Fluxo da partida i: o i-ésimo filho de SeedSequence(semente), qualquer que seja o processo que a executa
+    return default_rng(SeedSequence(semente, spawn_key=(partida,)))
+
+
+def constroi_partida(mapa: Mapa, parametros: Parametros, partida: int, semente: int = 0,
+                     tipo: str = 'rota_independente', velocidade_carro: int = 1, otimiza: bool = True,
+                     melhora: bool = False, qtd_candidatos: int = None, largura_feixe: int = None,
+                     prazo: float = None) -> (Frota, bool, int):
+    # Com um prazo (perf_counter), a construção falha e a busca local é interrompida quando ele se esgota
+    frota = Frota(mapa, velocidade_carro, qtd_candidatos=qtd_candidatos, gerador=gerador_da_partida(semente, partida),
+                  largura_feixe=largura_feixe)
+    frota.prazo = prazo
+    validade, iteracoes = algorithms.gera_solucao(parametros, frota, tipo=tipo)
+    if validade and otimiza: algorithms.otimizacao_termino_mais_cedo(frota)
+    if validade and melhora: busca_local.busca_local(frota)
+    return frota, validade, iteracoes
+
+
+def estatisticas_frota(frota: Frota, partida: int, validade: bool, iteracoes: int) -> dict:
+    carros = list(frota)
+    return {
+        'partida': partida, 'validade': bool(validade), 'iteracoes': iteracoes, 'qtd_carros': len(carros),
+        'distancia': sum(carro.distancia for carro in carros),
+        'tempo_atividade': sum(carro.fim - carro.inicio for carro in carros),
+        'tempo_total': sum(carro.fim for carro in carros)
+    }
+
+
+def executa_partida(mapa: Mapa, parametros: Parametros, partida: int, **kwargs) -> (dict, List[ndarray]):
+    # Retornamos apenas as estatísticas da partida e as rotas como arrays de indices, nunca a frota inteira
+    inicio = perf_counter()
+    frota, validade, iteracoes = constroi_partida(mapa, parametros, partida, **kwargs)
+    estatisticas = {**estatisticas_frota(frota, partida, validade, iteracoes),
+                    'duracao': perf_counter() - inicio, 'processo': os.getpid()}
+    return estatisticas, rotas_frota(frota)
+
+
+# ######################################################################################################################
+# EXECUÇÃO PARALELA
+
+
+_CONFIGURACAO = {}  # Mapa (com a matriz em memória compartilhada) e argumentos comuns a todas as partidas
+
+
+def _inicializa_processo(configuracao: dict):
+    global _CONFIGURACAO
+    _CONFIGURACAO = configuracao
+
+
+def _executa_partida(partida: int) -> (dict, List[ndarray]):
+    return executa_partida(partida=partida, **_CONFIGURACAO)
+
+
+def multipartida(mapa: Mapa, parametros: Parametros, qtd_partidas: int = None, tempo_limite: float = None,
+                 processos: int = None, semente: int = 0, objetivo: Union[str, Callable] = 'carros',
+                 tipo: str = 'rota_independente', velocidade_carro: int = 1, otimiza: bool = True,
+                 melhora: bool = False, qtd_candidatos: int = None, largura_feixe: int = None) -> (Frota, List[Dict]):
+    """Executa partidas independentes de gera_solucao (seguidas da otimização de término e, com melhora, da busca
+    local) até completar qtd_partidas ou esgotar o tempo_limite (em segundos; as partidas em andamento são
+    concluídas). Cada partida usa o seu próprio fluxo aleatório, derivado da semente e do número da partida: com um
+    número fixo de partidas, o resultado não depende do número de processos.
+    Retorna a melhor frota segundo o objetivo (nome em OBJETIVOS ou função das estatísticas) e as estatísticas de
+    todas as partidas, em ordem"""
+    assert qtd_partidas is not None or tempo_limite is not None, 'INFORME QTD_PARTIDAS E/OU TEMPO_LIMITE!'
+    processos = processos or os.cpu_count()
+    prazo = None if tempo_limite is None else perf_counter() + tempo_limite
+    configuracao = {'parametros': parametros, 'semente': semente, 'tipo': tipo, 'velocidade_carro': velocidade_carro,
+                    'otimiza': otimiza, 'melhora': melhora, 'qtd_candidatos': qtd_candidatos,
+                    'largura_feixe': largura_feixe}
+
+    def continua(proxima: int) -> bool:
+        return ((qtd_partidas is None or proxima < qtd_partidas)
+                and (prazo is None or proxima == 0 or perf_counter() < prazo))
+
+    # Mantemos apenas as rotas da melhor partida até o momento
+    partidas, melhor, melhores_rotas = [], None, None
+    def registra(estatisticas: dict, rotas: List[ndarray]):
+        nonlocal melhor, melhores_rotas
+        partidas.append(estatisticas)
+        if melhor is None or chave_objetivo(objetivo, estatisticas) < chave_objetivo(objetivo, melhor):
+            melhor, melhores_rotas = estatisticas, rotas
+
+    proxima = 0
+    if processos == 1:
+        while continua(proxima):
+            registra(*executa_partida(mapa, partida=proxima, **configuracao))
+            proxima += 1
+    else:
+        # A matriz densa (e a de tempos) vai para a memória compartilhada: com spawn, cada processo apenas mapeia
+        # os mesmos blocos. Os demais provedores (quantizado, sob demanda) são enviados como estão, sem materializar a
+        # matriz completa. As partidas são distribuídas aos poucos, para que o tempo limite possa ser respeitado
+        compartilha = isinstance(mapa.distancias, DistanciasDensas) \
+            and not isinstance(mapa.distancias, DistanciasCompartilhadas)
+        compartilhado = mapa.compartilhado(velocidades=(velocidade_carro, )) if compartilha else None
+        configuracao['mapa'] = mapa if compartilhado is None else compartilhado
+        try:
+            with Pool(processes=processos, initializer=_inicializa_processo, initargs=(configuracao,)) as pool:
+                pendentes = deque()
+                while True:
+                    while len(pendentes) < 2 * processos and continua(proxima):
+                        pendentes.append(pool.apply_async(_executa_partida, (proxima, )))
+                        proxima += 1
+                    if len(pendentes) == 0: break
+                    registra(*pendentes.popleft().get())
+        finally:
+            if compartilhado is not None: compartilhado.distancias.libera()
+
+    # A melhor frota é refeita no processo principal, sobre o mapa original
+    partidas.sort(key=lambda estatisticas: estatisticas['partida'])
+    return frota_de_rotas(mapa, melhores_rotas, velocidade_carro), partidas
+
+
+# ######################################################################################################################
+# MODO COM PRAZO (ANYTIME)
+
+
+@dataclass(frozen=True)
+class Incumbente(object):
+    partida: int
+    frota: Frota
+    sumario: Dict[str, ndarray]  # Colunas de Frota.sumario, sem pandas
+    decorrido: float  # Segundos desde o início da busca
+    iteracoes: int  # Iterações da construção desta solução
+    iteracoes_totais: int  # Iterações de todas as partidas até esta solução
+    estatisticas: dict
+
+    def __repr__(self): return f'INCUMBENTE({self.partida}: {self.frota} {round(self.estatisticas["distancia"], 3)} @{round(self.decorrido, 3)}s)'
+    def __str__(self): return self.__repr__()
+
+
+def incumbentes(mapa: Mapa, parametros: Parametros, tempo_limite: float, semente: int = 0,
+                objetivo: Union[str, Callable] = 'carros', **kwargs) -> Iterator[Incumbente]:
+    """Executa partidas (como em multipartida, mas no próprio processo) até esgotar o tempo_limite (em segundos),
+    fornecendo cada nova melhor solução válida assim que encontrada. Ao esgotar o prazo, a partida em andamento é
+    interrompida: uma construção incompleta é descartada, e uma busca local parcial ainda é uma solução válida.
+    O gerador retorna (StopIteration.value) o melhor incumbente, ou None se nenhuma solução válida foi encontrada"""
+    inicio = perf_counter()
+    prazo = inicio + tempo_limite
+    melhor, iteracoes_totais, partida = None, 0, 0
+    while perf_counter() < prazo:
+        frota, validade, iteracoes = constroi_partida(mapa, parametros, partida, semente=semente, prazo=prazo, **kwargs)
+        iteracoes_totais += iteracoes
+        estatisticas = estatisticas_frota(frota, partida, validade, iteracoes)
+        partida += 1
+        if not validade: continue
+        if melhor is not None and chave_objetivo(objetivo, estatisticas) >= chave_objetivo(objetivo, melhor.estatisticas):
+            continue
+        melhor = Incumbente(partida=estatisticas['partida'], frota=frota, sumario=frota.colunas_sumario,
+                            decorrido=perf_counter() - inicio, iteracoes=iteracoes,
+                            iteracoes_totais=iteracoes_totais, estatisticas=estatisticas)
+        yield melhor
+    return melhor
+
+
+def resolve_ate_prazo(mapa: Mapa, parametros: Parametros, tempo_limite: float, **kwargs) -> Incumbente:
+    # Consome os incumbentes e retorna apenas o melhor (ou None)
+    geracao = incumbentes(mapa, parametros, tempo_limite, **kwargs)
+    while True:
+        try:
+            next(geracao)
+        except StopIteration as fim:
+            return fim.value
@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""resultados.py: Armazenamento colunar e compacto dos resultados de execuções do algoritmo"""
+
+__copyright__ = "Copyright (c) 2021 Isabella Freitas & José Fonseca. MIT. See attached LICENSE.txt file"
+
+
+import os
+import glob
+from time import time_ns
+from uuid import uuid4
+from typing import List, Dict, Union, TYPE_CHECKING
+from dataclasses import asdict
+
+from numpy import ndarray, array, concatenate, cumsum, split, load, savez, nan, int32, int64, float64
+
+from two_step_vrptw.utils import Mapa, Frota, Parametros
+
+if TYPE_CHECKING: from pandas import DataFrame
+
+
+# ######################################################################################################################
+# REGISTRO COMPACTO DE UMA EXECUÇÃO
+
+
+METRICAS = ['qtd_carros', 'distancia', 'tempo_deslocamento', 'tempo_layover', 'tempo_atividade', 'inicio', 'fim',
+            'tempo_total']
+COLUNAS = {
+    'chave': str, 'arquivo': str,
+    'peso_distancia': float64, 'peso_urgencia': float64, 'peso_recursoes': float64,
+    'limite_recursoes': int64, 'clientes_recursao': int64, 'limite_iteracoes': int64,
+    'qtd_novos_carros_por_rodada': int64,
+    'begin': float64, 'end': float64, 'duracao': float64, 'validade': bool, 'iteracoes': int64,
+    **{f'{metrica}_pre_opt': float64 for metrica in METRICAS},
+    **{metrica: float64 for metrica in METRICAS},
+}
+
+
+def metricas_sumario(sumario: Union['DataFrame', Dict[str, ndarray]]) -> Dict[str, float]:
+    # Aceita o sumário em DataFrame ou apenas as suas colunas (Frota.colunas_sumario), sem pandas
+    if sumario is None or len(sumario['distancia']) == 0: return {metrica: nan for metrica in METRICAS}
+    return {
+        'qtd_carros': len(sumario['distancia']), 'distancia': sumario['distancia'].sum(),
+        'tempo_deslocamento': sumario['tempo_deslocamento'].sum(), 'tempo_layover': sumario['tempo_layover'].sum(),
+        'tempo_atividade': sumario['tempo_atividade'].sum(), 'inicio': sumario['inicio'].min(),
+        'fim': sumario['fim'].max(), 'tempo_total': sumario['fim'].sum()
+    }
+
+
+def rotas_frota(frota: Frota) -> List[ndarray]:
+    # Cada rota é a sequência de indices (no mapa) da agenda do carro. O indice 0 é o depósito
+    return [array(carro.rota, dtype=int32) for carro in frota]
+
+
+def frota_de_rotas(mapa: Mapa, rotas: List[ndarray], velocidade_carro: int = 1, **kwargs) -> Frota:
+    # Inverso de rotas_frota: refaz os carros (e os clientes atendidos) da frota a partir das rotas
+    frota = Frota(mapa, velocidade_carro, **kwargs)
+    for rota in rotas:
+        carro = frota.novo_carro()
+        for no in rota[1:].tolist():
+            item = mapa.nos[no]
+            if item.tipo == 'Cliente':
+                carro.atendimento(item)
+            else:
+                carro.reabastecimento(item)
+    return frota
+
+
+def registro_execucao(chave: str, arquivo: str, parametros: Parametros, validade: bool, iteracoes: int,
+                      begin: float, end: float, sumario_pre_opt: Dict[str, ndarray] = None,
+                      sumario: Dict[str, ndarray] = None) -> dict:
+    registro = {'chave': chave, 'arquivo': arquivo, **asdict(parametros),
+                'begin': begin, 'end': end, 'duracao': end - begin, 'validade': validade, 'iteracoes': iteracoes}
+    registro.update({f'{metrica}_pre_opt': valor for metrica, valor in metricas_sumario(sumario_pre_opt).items()})
+    registro.update(metricas_sumario(sumario))
+    return registro
+
+
+# ######################################################################################################################
+# ARMAZENAMENTO EM PARTES (SHARDS) NPZ
+
+
+class ArmazemResultados(object):
+    """Acumula registros de execução e os grava em partes NPZ colunares, apenas por acréscimo.
+    As partes podem ser lidas sem deserializar objetos Python (allow_pickle=False)"""
+
+    def __init__(self, diretorio: str, tamanho_lote: int = 500):
+        os.makedirs(diretorio, exist_ok=True)
+        self.diretorio = diretorio
+        self.tamanho_lote = tamanho_lote
+        self.registros = []
+        self.rotas = []
+
+    def __repr__(self): return f'ArmazemResultados({self.diretorio} |{len(self.registros)}/{self.tamanho_lote}|)'
+    def __str__(self): return self.__repr__()
+    def __len__(self): return len(self.registros)
+    def __enter__(self): return self
+    def __exit__(self, *args): self.descarrega()
+
+    def acrescenta(self, registro: dict, rotas: List[ndarray]) -> List[str]:
+        self.registros.append(registro)
+        self.rotas.append(rotas)
+        if len(self.registros) >= self.tamanho_lote: return self.descarrega()
+        return []
+
+    def descarrega(self) -> List[str]:
+        if len(self.registros) == 0: return []
+
+        # Colunas dos registros, rotas concatenadas e os limites de cada rota / de cada execução
+        colunas = {coluna: array([r[coluna] for r in self.registros], dtype=tipo) for coluna, tipo in COLUNAS.items()}
+        rotas = [rota for rotas_execucao in self.rotas for rota in rotas_execucao]
+        colunas['rotas'] = concatenate(rotas).astype(int32) if len(rotas) > 0 else array([], dtype=int32)
+        colunas['tamanho_rotas'] = array([len(rota) for rota in rotas], dtype=int32)
+        colunas['qtd_rotas'] = array([len(rotas_execucao) for rotas_execucao in self.rotas], dtype=int32)
+
+        # Gravamos em um arquivo temporário e renomeamos, para que uma parte nunca seja lida pela metade. O nome da parte
+        # é único mesmo com vários processos gravando no mesmo diretório (instante, pid e uuid), e em ordem de gravação
+        caminho = os.path.join(self.diretorio, f'parte-{time_ns():020d}-{os.getpid()}-{uuid4().hex[:8]}.npz')
+        with open(caminho + '.tmp', 'wb') as fout:
+            savez(fout, **colunas)
+        os.replace(caminho + '.tmp', caminho)
+
+        chaves = [r['chave'] for r in self.registros]
+        self.registros, self.rotas = [], []
+        return chaves
+
+
+def _partes(diretorio: str) -> List[str]:
+    return sorted(glob.glob(os.path.join(diretorio, 'parte-*.npz')))
+
+
+def carrega_registros(diretorio: str) -> 'DataFrame':
+    from pandas import DataFrame
+    partes = []
+    for caminho in _partes(diretorio):
+        with load(caminho, allow_pickle=False) as parte:
+            partes.append({coluna: parte[coluna] for coluna in COLUNAS})
+    if len(partes) == 0: return DataFrame(columns=list(COLUNAS))
+    return DataFrame({coluna: concatenate([parte[coluna] for parte in partes]) for coluna in COLUNAS})
+
+
+def carrega_rotas(diretorio: str) -> List[List[ndarray]]:
+    # Lista (alinhada às linhas de carrega_registros) com as rotas de cada execução, como arrays de indices
+    resultado = []
+    for caminho in _partes(diretorio):
+        with load(caminho, allow_pickle=False) as parte:
+            rotas = split(parte['rotas'], cumsum(parte['tamanho_rotas'])[:-1]) if len(parte['tamanho_rotas']) else []
+            limites = cumsum(parte['qtd_rotas'])
+            resultado += [list(rotas[fim-qtd:fim]) for fim, qtd in zip(limites.tolist(), parte['qtd_rotas'].tolist())]
+    return resultado
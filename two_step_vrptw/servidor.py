@@ -0,0 +1,322 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""servidor.py: Serviço local de soluções (asyncio), com cache de mapas por conteúdo e processos de trabalho"""
+
+__copyright__ = "Copyright (c) 2021 Isabella Freitas & José Fonseca. MIT. See attached LICENSE.txt file"
+
+
+import os
+import json
+import socket
+import asyncio
+import tempfile
+from time import time, perf_counter
+from hashlib import sha1
+from typing import Dict
+from dataclasses import asdict
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
+
+from numpy import percentile
+
+from two_step_vrptw.utils import Mapa, Parametros
+from two_step_vrptw import multipartida
+
+
+# O protocolo é de linhas JSON sobre TCP local: cada linha é uma requisição, respondida por uma única linha
+# Requisições: {"operacao": "resolve", ...}, {"operacao": "metricas"} e {"operacao": "ping"}
+PORTA_PADRAO = 8765
+TAMANHO_CACHE_PADRAO = 32
+OPCOES_RESOLUCAO = ('qtd_partidas', 'tempo_limite', 'semente', 'objetivo', 'tipo', 'otimiza', 'melhora',
+                    'qtd_candidatos', 'largura_feixe')
+
+
+# ######################################################################################################################
+# CACHE DE MAPAS
+
+
+class CacheMapas(object):
+    """Cache LRU de mapas já lidos, indexado pelo hash (sha1) do conteúdo da instância. Os mapas são lidos pelo cache
+    binário de instancias.py: a matriz de distâncias é mapeada (somente leitura) do mesmo arquivo por todos os
+    processos, e o sistema operacional compartilha as suas páginas"""
+
+    def __init__(self, diretorio_cache: str, tamanho_maximo: int = TAMANHO_CACHE_PADRAO):
+        self.diretorio_cache = diretorio_cache
+        self.tamanho_maximo = tamanho_maximo
+        self.mapas = OrderedDict()
+        self.acertos = 0
+        self.falhas = 0
+
+    def __repr__(self): return f'CacheMapas(|{len(self.mapas)}/{self.tamanho_maximo}| +{self.acertos} -{self.falhas})'
+    def __len__(self): return len(self.mapas)
+    def __contains__(self, chave: str): return chave in self.mapas
+
+    def obtem(self, chave: str, arquivo: str) -> Mapa:
+        mapa = self.mapas.get(chave)
+        if mapa is not None:
+            self.mapas.move_to_end(chave)
+            self.acertos += 1
+            return mapa
+        self.falhas += 1
+        mapa = Mapa(arquivo, diretorio_cache=self.diretorio_cache)
+        self.mapas[chave] = mapa
+        if len(self.mapas) > self.tamanho_maximo:
+            self.mapas.popitem(last=False)  # Descartamos o mapa usado há mais tempo
+        return mapa
+
+
+class CacheMetadados(object):
+    """Cache LRU, no processo principal, apenas dos metadados (nome e quantidade de clientes) das instâncias já
+    validadas, indexado pelo hash (sha1) do conteúdo. Os mapas em si só existem nos processos de trabalho"""
+
+    def __init__(self, tamanho_maximo: int = TAMANHO_CACHE_PADRAO):
+        self.tamanho_maximo = tamanho_maximo
+        self.metadados = OrderedDict()
+        self.acertos = 0
+        self.falhas = 0
+
+    def __repr__(self):
+        return f'CacheMetadados(|{len(self.metadados)}/{self.tamanho_maximo}| +{self.acertos} -{self.falhas})'
+    def __len__(self): return len(self.metadados)
+    def __contains__(self, chave: str): return chave in self.metadados
+
+    def obtem(self, chave: str) -> dict:
+        # Retorna None para instâncias ainda não validadas
+        metadados = self.metadados.get(chave)
+        if metadados is None:
+            self.falhas += 1
+            return None
+        self.metadados.move_to_end(chave)
+        self.acertos += 1
+        return metadados
+
+    def registra(self, chave: str, metadados: dict):
+        self.metadados[chave] = metadados
+        if len(self.metadados) > self.tamanho_maximo:
+            self.metadados.popitem(last=False)  # Descartamos a instância usada há mais tempo
+
+
+def chave_conteudo(conteudo: bytes) -> str:
+    return sha1(conteudo).hexdigest()
+
+
+# ######################################################################################################################
+# PROCESSOS DE TRABALHO
+
+
+_CACHE = None  # Cache de mapas de cada processo de trabalho
+
+
+def _inicializa_processo(diretorio_cache: str, tamanho_cache: int):
+    global _CACHE
+    _CACHE = CacheMapas(diretorio_cache, tamanho_cache)
+
+
+def _valida(chave: str, arquivo: str) -> dict:
+    # Executado no processo de trabalho, na primeira requisição de cada instância: lê (e valida) o mapa, o que também
+    # grava o cache binário usado pelos demais processos. Instâncias inválidas levantam AssertionError
+    mapa = _CACHE.obtem(chave, arquivo)
+    return {'nome': mapa.nome, 'qtd_clientes': len(mapa.clientes)}
+
+
+def _resolve(chave: str, arquivo: str, parametros: dict, opcoes: dict) -> dict:
+    # Executado no processo de trabalho. Retornamos apenas dados serializáveis em JSON
+    inicio = time()
+    mapa = _CACHE.obtem(chave, arquivo)
+    opcoes = {'qtd_partidas': 1, **opcoes}
+    frota, partidas = multipartida.multipartida(mapa, Parametros(**parametros), processos=1, **opcoes)
+    melhor = min(partidas, key=lambda p: multipartida.chave_objetivo(opcoes.get('objetivo', 'carros'), p))
+    return {
+        'validade': melhor['validade'], 'qtd_carros': melhor['qtd_carros'], 'distancia': float(melhor['distancia']),
+        'tempo_total': int(melhor['tempo_total']), 'partida': melhor['partida'], 'qtd_partidas': len(partidas),
+        'iteracoes': sum(p['iteracoes'] for p in partidas),
+        'rotas': [carro.rota.tolist() for carro in frota],
+        'inicio_execucao': inicio, 'duracao_execucao': time() - inicio
+    }
+
+
+# ######################################################################################################################
+# SERVIDOR
+
+
+class ServidorSolucoes(object):
+    """Servidor asyncio de soluções. Cada requisição de solução informa a instância (caminho ou conteúdo) e os
+    Parametros, e é executada em um processo do pool. Nenhuma leitura bloqueia o laço de eventos: o hash da instância
+    é calculado em uma thread, e os mapas só são lidos nos processos de trabalho, uma única vez em cada um (pelo hash
+    do conteúdo). O processo principal guarda apenas os metadados das instâncias já validadas"""
+
+    def __init__(self, host: str = '127.0.0.1', porta: int = PORTA_PADRAO, processos: int = None,
+                 diretorio_cache: str = None, tamanho_cache: int = TAMANHO_CACHE_PADRAO, janela_latencias: int = 1000):
+        self.host = host
+        self.porta = porta
+        self.processos = processos or os.cpu_count()
+        self.diretorio_cache = diretorio_cache or os.path.join(tempfile.gettempdir(), 'two_step_vrptw_cache')
+        self.diretorio_instancias = os.path.join(self.diretorio_cache, 'instancias')
+        os.makedirs(self.diretorio_instancias, exist_ok=True)
+        self.cache = CacheMetadados(tamanho_cache)
+        self.pool = None
+        self.servidor = None
+
+        # Métricas: profundidade da fila (requisições aguardando ou em execução) e latências das últimas requisições
+        self.em_andamento = 0
+        self.max_em_andamento = 0
+        self.qtd_requisicoes = 0
+        self.qtd_erros = 0
+        self.latencias = deque(maxlen=janela_latencias)
+        self.esperas = deque(maxlen=janela_latencias)
+
+    def __repr__(self): return f'ServidorSolucoes({self.host}:{self.porta} x{self.processos} {self.cache})'
+    def __str__(self): return self.__repr__()
+
+    # ##################################################################################################################
+    # CICLO DE VIDA
+
+    async def inicia(self):
+        self.pool = ProcessPoolExecutor(max_workers=self.processos, initializer=_inicializa_processo,
+                                        initargs=(self.diretorio_cache, self.cache.tamanho_maximo))
+        self.servidor = await asyncio.start_server(self.atende_conexao, self.host, self.porta)
+        self.porta = self.servidor.sockets[0].getsockname()[1]  # Com porta 0, o sistema escolhe uma porta livre
+
+    async def encerra(self):
+        if self.servidor is not None:
+            self.servidor.close()
+            await self.servidor.wait_closed()
+        if self.pool is not None:
+            self.pool.shutdown(wait=True)
+
+    async def executa(self):
+        await self.inicia()
+        try:
+            async with self.servidor:
+                await self.servidor.serve_forever()
+        finally:
+            await self.encerra()
+
+    # ##################################################################################################################
+    # REQUISIÇÕES
+
+    async def atende_conexao(self, leitor: asyncio.StreamReader, escritor: asyncio.StreamWriter):
+        try:
+            while True:
+                linha = await leitor.readline()
+                if len(linha) == 0: break
+                try:
+                    resposta = await self.atende(json.loads(linha))
+                except Exception as erro:
+                    self.qtd_erros += 1
+                    resposta = {'ok': False, 'erro': f'{type(erro).__name__}: {erro}'}
+                escritor.write(json.dumps(resposta).encode('utf-8') + b'\n')
+                await escritor.drain()
+        finally:
+            escritor.close()
+
+    async def atende(self, requisicao: dict) -> dict:
+        operacao = requisicao.get('operacao', 'resolve')
+        if operacao == 'ping': return {'ok': True}
+        if operacao == 'metricas': return {'ok': True, **self.metricas}
+        if operacao == 'resolve': return await self.resolve(requisicao)
+        raise NotImplementedError(f'Operacao nao implementada: {operacao}')
+
+    def localiza_instancia(self, requisicao: dict) -> (str, str):
+        # Instâncias enviadas por conteúdo são gravadas (uma única vez) no diretório de instâncias, pelo seu hash
+        if 'conteudo' in requisicao:
+            conteudo = requisicao['conteudo'].encode('utf-8')
+            chave = chave_conteudo(conteudo)
+            arquivo = os.path.join(self.diretorio_instancias, chave + '.txt')
+            if not os.path.exists(arquivo):
+                with open(arquivo + '.tmp', 'wb') as fout:
+                    fout.write(conteudo)
+                os.replace(arquivo + '.tmp', arquivo)
+            return chave, arquivo
+        arquivo = requisicao['arquivo']
+        with open(arquivo, 'rb') as fin:
+            return chave_conteudo(fin.read()), arquivo
+
+    async def resolve(self, requisicao: dict) -> dict:
+        recebido = time()
+        inicio = perf_counter()
+        self.qtd_requisicoes += 1
+        laco = asyncio.get_running_loop()
+        chave, arquivo = await laco.run_in_executor(None, self.localiza_instancia, requisicao)
+
+        # Na primeira vez, o mapa é lido (e validado) em um processo de trabalho, o que também grava o cache binário
+        # usado pelos demais. Instâncias já validadas não são lidas de novo. Instâncias inválidas (AssertionError)
+        # são respondidas como erro sem executar a solução
+        metadados = self.cache.obtem(chave)
+        aquecido = metadados is not None
+        if not aquecido:
+            metadados = await laco.run_in_executor(self.pool, _valida, chave, arquivo)
+            self.cache.registra(chave, metadados)
+        opcoes = {opcao: requisicao[opcao] for opcao in OPCOES_RESOLUCAO if opcao in requisicao}
+
+        self.em_andamento += 1
+        self.max_em_andamento = max([self.max_em_andamento, self.em_andamento])
+        try:
+            resultado = await laco.run_in_executor(
+                self.pool, _resolve, chave, arquivo, requisicao['parametros'], opcoes
+            )
+        finally:
+            self.em_andamento -= 1
+        latencia = perf_counter() - inicio
+        self.latencias.append(latencia)
+        self.esperas.append(max([0.0, resultado['inicio_execucao'] - recebido]))
+        return {'ok': True, 'instancia': chave, 'nome': metadados['nome'], 'aquecido': aquecido, **resultado,
+                'latencia': latencia}
+
+    @property
+    def metricas(self) -> dict:
+        def quantis(valores) -> Dict[str, float]:
+            if len(valores) == 0: return {'p50': None, 'p95': None, 'p99': None}
+            return {f'p{q}': float(percentile(list(valores), q)) for q in (50, 95, 99)}
+        return {
+            'requisicoes': self.qtd_requisicoes, 'erros': self.qtd_erros, 'processos': self.processos,
+            'profundidade_fila': self.em_andamento, 'max_profundidade_fila': self.max_em_andamento,
+            'cache': {'mapas': len(self.cache), 'acertos': self.cache.acertos, 'falhas': self.cache.falhas},
+            'latencia': quantis(self.latencias), 'espera': quantis(self.esperas)
+        }
+
+
+def executa_servidor(**kwargs):
+    servidor = ServidorSolucoes(**kwargs)
+    asyncio.run(servidor.executa())
+
+
+# ######################################################################################################################
+# CLIENTE
+
+
+class ClienteServidor(object):
+    """Cliente síncrono do servidor de soluções, por uma única conexão TCP reaproveitada entre as requisições"""
+
+    def __init__(self, host: str = '127.0.0.1', porta: int = PORTA_PADRAO, timeout: float = None):
+        self.conexao = socket.create_connection((host, porta), timeout=timeout)
+        self.arquivo = self.conexao.makefile('rwb')
+
+    def __enter__(self): return self
+    def __exit__(self, *args): self.fecha()
+
+    def fecha(self):
+        self.arquivo.close()
+        self.conexao.close()
+
+    def requisita(self, requisicao: dict) -> dict:
+        self.arquivo.write(json.dumps(requisicao).encode('utf-8') + b'\n')
+        self.arquivo.flush()
+        resposta = json.loads(self.arquivo.readline())
+        if not resposta.get('ok', False): raise RuntimeError(resposta.get('erro'))
+        return resposta
+
+    def resolve(self, parametros: Parametros, arquivo: str = None, conteudo: str = None, **opcoes) -> dict:
+        # Informe o caminho (visível pelo servidor) ou o conteúdo da instância. As opções são as de OPCOES_RESOLUCAO
+        assert (arquivo is None) != (conteudo is None), 'INFORME O ARQUIVO OU O CONTEUDO DA INSTANCIA!'
+        requisicao = {'operacao': 'resolve', 'parametros': asdict(parametros), **opcoes}
+        if arquivo is not None: requisicao['arquivo'] = arquivo
+        if conteudo is not None: requisicao['conteudo'] = conteudo
+        return self.requisita(requisicao)
+
+    def metricas(self) -> dict:
+        return self.requisita({'operacao': 'metricas'})
+
+    def ping(self) -> dict:
+        return self.requisita({'operacao': 'ping'})
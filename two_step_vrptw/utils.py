@@ -7,14 +7,23 @@ __copyright__ = "Copyright (c) 2021 Isabella Freitas & José Fonseca. MIT. See a
 
 
 from math import sqrt
-from copy import deepcopy
+from time import perf_counter
+from copy import copy
+from array import array as array_compacto
 from sys import maxsize as int_inf
-from typing import List, Tuple, Union, Dict, Iterator
-from dataclasses import dataclass, field
+from typing import List, Tuple, Union, Dict, Iterator, TYPE_CHECKING
+from dataclasses import dataclass, field, replace
 from functools import lru_cache as memoized
+from collections import OrderedDict
 
-from pandas import DataFrame
-from numpy import power, sqrt
+from numpy import ndarray, array, asarray, zeros, arange, argsort, vstack, concatenate, float64, int64, sqrt, packbits
+
+from two_step_vrptw.instancias import le_instancia, valida_janelas, matriz_de_distancias, carrega_instancia
+from two_step_vrptw.distancias import ProvedorDistancias, DistanciasDensas, DistanciasCompartilhadas, cria_provedor
+from two_step_vrptw.vizinhanca import vizinhos_mais_proximos
+
+# O núcleo do algoritmo depende apenas de numpy. O pandas só é importado quando um sumário em DataFrame é pedido
+if TYPE_CHECKING: from pandas import DataFrame
 
 
 # ######################################################################################################################
@@ -51,6 +60,7 @@ class Cliente(Posicao):
     inicio:  int
     fim:     int
     servico: int
+    indice:  int = -1  # Identidade estável do cliente no mapa: clientes de mesmos atributos são distintos
     tipo = 'Cliente'
 
     def __repr__(self): return f'CLIENTE({self.demanda} ({self.x}, {self.y}) [{self.inicio}, {self.fim}] {self.servico})'
@@ -61,6 +71,7 @@ class Cliente(Posicao):
 
 @dataclass(frozen=True)
 class Deposito(Posicao):
+    indice:  int = field(default=0, compare=False)
     demanda = 0.0
     inicio = 0
     fim = int_inf
@@ -78,60 +89,199 @@ class Mapa(object):
     capacidade_carro: float
     deposito: Deposito
     clientes: List[Cliente]
-    matriz_de_distancias: DataFrame
-    dict_referencias: Dict
-
-    def __init__(self, arquivo: str):
+    nos: List[Union[Deposito, Cliente]]
+    distancias: ProvedorDistancias
+    demandas: ndarray
+    inicios: ndarray
+    fins: ndarray
+    servicos: ndarray
+    folgas: ndarray
+    ordem_fins: ndarray
+    posicoes_por_fim: ndarray
+    fins_por_fim: ndarray
+    inicios_por_fim: ndarray
+    demandas_por_fim: ndarray
+    folgas_por_fim: ndarray
+    ordem_inicios: ndarray
+    posicoes_por_inicio: ndarray
+    inicios_por_inicio: ndarray
+    fins_por_inicio: ndarray
+    demandas_por_inicio: ndarray
+    folgas_por_inicio: ndarray
+    largura_janelas: int
+    coordenadas: ndarray
+    candidatos: Dict[int, ndarray]
+    tempos_por_fim: Dict[int, ndarray]
+
+    def __init__(self, arquivo: str, dtype=float64, diretorio_cache: str = None, distancias: str = 'densa',
+                 qtd_candidatos: int = None, **kwargs):
+        # Com um diretório de cache, pontos e matriz de distâncias são lidos do cache binário da instância (se existir)
+        # O modo de distancias define o provedor: 'densa' (dtype float64 ou float32), 'quantizada' (int32 escalado) ou
+        # 'sob_demanda' (linhas calculadas sob demanda, em cache LRU limitado por orcamento_memoria, em bytes)
+        # Com qtd_candidatos, as listas dos k clientes mais próximos de cada ponto já são pré-calculadas
         object.__setattr__(self, 'arquivo', arquivo)
-        nome, max_carros, capacidade_carro, deposito, clientes = self.parse_arquivo(arquivo)
-        matriz_de_distancias, dict_referencias = self.cria_matriz_de_distancias(deposito, clientes)
+        nome, max_carros, capacidade_carro, valores, matriz = carrega_instancia(
+            arquivo, dtype=dtype, diretorio_cache=diretorio_cache, com_matriz=(distancias == 'densa')
+        )
+        if distancias == 'densa': kwargs['dtype'] = dtype
+        deposito, clientes = self.cria_nos(valores)
         object.__setattr__(self, 'nome', nome)
         object.__setattr__(self, 'max_carros', max_carros)
         object.__setattr__(self, 'capacidade_carro', capacidade_carro)
         object.__setattr__(self, 'deposito', deposito)
         object.__setattr__(self, 'clientes', clientes)
-        object.__setattr__(self, 'matriz_de_distancias', matriz_de_distancias)
-        object.__setattr__(self, 'dict_referencias', dict_referencias)
+        object.__setattr__(self, 'nos', [deposito] + clientes)
+        object.__setattr__(self, 'distancias', cria_provedor(distancias, valores[:, 1:3], matriz=matriz, **kwargs))
+        for nome_vetor, vetor in self.cria_vetores_de_nos(self.nos).items():
+            object.__setattr__(self, nome_vetor, vetor)
+        object.__setattr__(self, 'coordenadas', valores[:, 1:3].astype(float64))
+        object.__setattr__(self, 'candidatos', {})
+        object.__setattr__(self, 'tempos_por_fim', {})
+        if qtd_candidatos is not None: self.lista_candidatos(qtd_candidatos)
 
     def __repr__(self): return f'MAPA({self.nome}: {self.max_carros}x{self.capacidade_carro} ${len(self.clientes)})'
     def __str__(self): return self.__repr__()
 
     @staticmethod
     def parse_arquivo(arquivo):
-        clientes = []
-        with open(arquivo, 'r') as fin:
-            for num_linha, linha in enumerate(fin):
-                linha = linha.strip()
-                if len(linha) == 0: continue
-                if num_linha == 0:
-                    nome_teste = linha
-                    continue
-                if num_linha == 4:
-                    max_carros, capacidade_carro = [int(v) for v in linha.split(' ') if len(v) > 0]
-                    continue
-                if num_linha >= 9:
-                    _, x, y, demanda, inicio, fim, servico = [int(v) for v in linha.split(' ') if len(v) > 0]
-                    if num_linha == 9:
-                        deposito = Deposito(x=x, y=y)
-                    else:
-                        clientes.append(Cliente(x=x, y=y, demanda=demanda, inicio=inicio, fim=fim, servico=servico))
+        nome_teste, max_carros, capacidade_carro, valores = le_instancia(arquivo)
+        valida_janelas(valores)
+        deposito, clientes = Mapa.cria_nos(valores)
         return nome_teste, max_carros, capacidade_carro, deposito, clientes
 
     @staticmethod
-    def cria_matriz_de_distancias(deposito: Deposito, clientes: List[Cliente]) -> (DataFrame, dict):
+    def cria_nos(valores: ndarray) -> (Deposito, List[Cliente]):
+        # A primeira linha é o depósito (indice 0). Os clientes recebem os indices 1..N, na ordem do arquivo
+        _, x, y, _, _, _, _ = valores[0].tolist()
+        deposito = Deposito(x=x, y=y, indice=0)
+        clientes = [Cliente(x=x, y=y, demanda=demanda, inicio=inicio, fim=fim, servico=servico, indice=indice)
+                    for indice, (_, x, y, demanda, inicio, fim, servico) in enumerate(valores[1:].tolist(), start=1)]
+        return deposito, clientes
+
+    @staticmethod
+    def cria_matriz_de_distancias(deposito: Deposito, clientes: List[Cliente], dtype=float64) -> (ndarray, dict):
         lista_referencia = [deposito] + clientes
         str_lista_referencia = list(map(str, lista_referencia))
 
-        # Calculamos as distancias entre cada ponto no mapa
-        df_x = DataFrame([[i.x for i in lista_referencia]] * len(lista_referencia),
-                         columns=str_lista_referencia, index=str_lista_referencia)
-        df_x = (df_x - df_x.T).applymap(lambda x: power(x, 2))
-        df_y = DataFrame([[i.y for i in lista_referencia]] * len(lista_referencia),
-                         columns=str_lista_referencia, index=str_lista_referencia)
-        df_y = (df_y - df_y.T).applymap(lambda y: power(y, 2))
-        df_distancias = (df_x + df_y).applymap(sqrt).astype(float).round(3)
+        # Calculamos as distancias entre cada ponto no mapa, em uma única operação vetorizada (broadcast)
+        # A linha/coluna de cada ponto é o seu indice: 0 para o depósito, 1..N para os clientes
+        coordenadas = array([[i.x, i.y] for i in lista_referencia], dtype=float64)
+        return matriz_de_distancias(coordenadas, dtype=dtype), dict(zip(str_lista_referencia, lista_referencia))
+
+    @staticmethod
+    def cria_vetores_de_nos(nos: List[Union[Deposito, Cliente]]) -> Dict[str, ndarray]:
+        # Atributos de cada ponto do mapa, indexados pelo indice do ponto (mesma ordem da matriz de distancias)
+        # A folga (inicio + servico - fim) somada ao tempo de deslocamento indica a viabilidade do atendimento
+        inicios = array([no.inicio for no in nos], dtype=int64)
+        fins = array([no.fim for no in nos], dtype=int64)
+        servicos = array([no.servico for no in nos], dtype=int64)
+
+        # Indice de janelas: os clientes (indices 1..N) ordenados pelo fim de suas janelas, com seus atributos na
+        # mesma ordem. Os clientes cuja janela ainda não fechou no momento t são sempre um sufixo dessa ordem
+        demandas = array([no.demanda for no in nos], dtype=float64)
+        folgas = inicios + servicos - fins
+        ordem_fins = argsort(fins[1:], kind='stable') + 1
+        posicoes_por_fim = zeros(len(nos), dtype=int64) - 1  # O depósito (-1) não está no indice
+        posicoes_por_fim[ordem_fins] = arange(len(ordem_fins))
+
+        # Os clientes também ordenados pelo inicio de suas janelas. Com a maior largura de janela, os clientes de janela
+        # aberta no momento t que abrem até t + horizonte são um trecho contíguo dessa ordem
+        ordem_inicios = argsort(inicios[1:], kind='stable') + 1
+        posicoes_por_inicio = zeros(len(nos), dtype=int64) - 1
+        posicoes_por_inicio[ordem_inicios] = arange(len(ordem_inicios))
+        return {
+            'demandas': demandas, 'inicios': inicios, 'fins': fins, 'servicos': servicos, 'folgas': folgas,
+            'ordem_fins': ordem_fins, 'posicoes_por_fim': posicoes_por_fim,
+            'fins_por_fim': fins[ordem_fins], 'inicios_por_fim': inicios[ordem_fins],
+            'demandas_por_fim': demandas[ordem_fins], 'folgas_por_fim': folgas[ordem_fins],
+            'ordem_inicios': ordem_inicios, 'posicoes_por_inicio': posicoes_por_inicio,
+            'inicios_por_inicio': inicios[ordem_inicios], 'fins_por_inicio': fins[ordem_inicios],
+            'demandas_por_inicio': demandas[ordem_inicios], 'folgas_por_inicio': folgas[ordem_inicios],
+            'largura_janelas': int((fins[1:] - inicios[1:]).max()) if len(nos) > 1 else 0
+        }
+
+    @property
+    def dict_referencias(self) -> Dict[str, Union[Deposito, Cliente]]:
+        # Rótulos textuais (repr) dos pontos, apenas para exibição e tabelas. A identidade de um ponto é o seu indice
+        return dict(zip(map(str, self.nos), self.nos))
 
-        return df_distancias, dict(zip(str_lista_referencia, lista_referencia))
+    @property
+    def matriz_de_distancias(self) -> ndarray:
+        # Matriz completa de distâncias. Em modos não densos, é materializada a cada acesso
+        return self.distancias.matriz_completa()
+
+    def matriz_de_tempos(self, velocidade: int) -> ndarray:
+        return self.distancias.matriz_de_tempos(velocidade)
+
+    def linha_distancias(self, origem: int) -> ndarray:
+        return self.distancias.linha(origem)
+
+    def linha_tempos(self, origem: int, velocidade: int) -> ndarray:
+        return self.distancias.linha_tempos(origem, velocidade)
+
+    def linhas_distancias(self, origens: ndarray, destinos: ndarray = None) -> ndarray:
+        return self.distancias.linhas(origens, destinos)
+
+    def linhas_tempos(self, origens: ndarray, velocidade: int, destinos: ndarray = None) -> ndarray:
+        return self.distancias.linhas_tempos(origens, velocidade, destinos)
+
+    def tempo_deslocamento(self, origem: int, destino: int, velocidade: int) -> int:
+        return self.distancias.tempo(origem, destino, velocidade)
+
+    def linha_tempos_por_fim(self, origem: int, velocidade: int) -> ndarray:
+        # Tempos da origem até os clientes, na ordem do indice de janelas. Com a matriz densa, as colunas são
+        # permutadas uma única vez por velocidade, e cada sufixo do indice é uma fatia contígua (sem cópia)
+        if not isinstance(self.distancias, DistanciasDensas):
+            return self.linha_tempos(origem, velocidade)[self.ordem_fins]
+        if velocidade not in self.tempos_por_fim:
+            self.tempos_por_fim[velocidade] = self.matriz_de_tempos(velocidade)[:, self.ordem_fins]
+        return self.tempos_por_fim[velocidade][origem]
+
+    def compartilhado(self, velocidades=()) -> 'Mapa':
+        # Cópia rasa do mapa com a matriz densa (e as matrizes de tempo das velocidades) em memória compartilhada
+        # O chamador libera os blocos ao final, com mapa.distancias.libera()
+        mapa = copy(self)
+        object.__setattr__(mapa, 'distancias', DistanciasCompartilhadas(self.distancias.matriz_completa(), velocidades))
+        return mapa
+
+    def com_clientes(self, clientes: List[Cliente]) -> 'Mapa':
+        # Novo mapa com os clientes informados acrescentados ao final, com os indices N+1..N+k. Os pontos existentes
+        # mantêm os seus indices (e objetos), e o provedor de distâncias só calcula as linhas e colunas dos novos
+        primeiro = len(self.nos)
+        novos = [replace(cliente, indice=primeiro + pos) for pos, cliente in enumerate(clientes)]
+        mapa = copy(self)
+        object.__setattr__(mapa, 'clientes', self.clientes + novos)
+        object.__setattr__(mapa, 'nos', self.nos + novos)
+        object.__setattr__(mapa, 'coordenadas', vstack([self.coordenadas, array([[c.x, c.y] for c in novos], dtype=float64).reshape(-1, 2)]))
+        object.__setattr__(mapa, 'distancias', self.distancias.estendido(mapa.coordenadas))
+        for nome_vetor, vetor in self.cria_vetores_de_nos(mapa.nos).items():
+            object.__setattr__(mapa, nome_vetor, vetor)
+        object.__setattr__(mapa, 'candidatos', {})
+        object.__setattr__(mapa, 'tempos_por_fim', {})
+        return mapa
+
+    def sub_mapa(self, indices: ndarray) -> 'Mapa':
+        # Novo mapa com o depósito e apenas os clientes informados (indices deste mapa), reindexados 1..k na mesma
+        # ordem: o cliente i do sub-mapa é o cliente indices[i-1] deste mapa
+        originais = concatenate([[0], asarray(indices, dtype=int64)])
+        nos = [replace(self.nos[original], indice=posicao) for posicao, original in enumerate(originais.tolist())]
+        mapa = copy(self)
+        object.__setattr__(mapa, 'deposito', nos[0])
+        object.__setattr__(mapa, 'clientes', nos[1:])
+        object.__setattr__(mapa, 'nos', nos)
+        object.__setattr__(mapa, 'coordenadas', self.coordenadas[originais])
+        object.__setattr__(mapa, 'distancias', self.distancias.restrito(originais))
+        for nome_vetor, vetor in self.cria_vetores_de_nos(nos).items():
+            object.__setattr__(mapa, nome_vetor, vetor)
+        object.__setattr__(mapa, 'candidatos', {})
+        object.__setattr__(mapa, 'tempos_por_fim', {})
+        return mapa
+
+    def lista_candidatos(self, k: int) -> ndarray:
+        # Matriz (N+1 x k) dos k clientes mais próximos de cada ponto, calculada (por indice espacial) uma única vez
+        if k not in self.candidatos:
+            self.candidatos[k] = vizinhos_mais_proximos(self.coordenadas, k)
+        return self.candidatos[k]
 
 
 # ######################################################################################################################
@@ -145,31 +295,71 @@ class Carro(object):
     velocidade: int
     capacidade: float
     carga:      float = 0.0
-    agenda:     List[Union[Cliente, Deposito]] = field(default_factory=list)
+    rota:       array_compacto = field(default=None, repr=False)
     fim:        int = 0
+    frota:      'Frota' = field(default=None, repr=False, compare=False)
+    nos:        List[Union[Cliente, Deposito]] = field(default=None, repr=False, compare=False)
+    cursor_janelas: int = field(default=0, repr=False, compare=False)
+    distancia:  float = field(default=0.0, repr=False, compare=False)
+    tempo_deslocamento_total: int = field(default=0, repr=False, compare=False)
+    qtd_clientes: int = field(default=0, repr=False, compare=False)
     _inicio = None
 
     def __post_init__(self):
-        self.agenda = [self.origem]
+        # A agenda é guardada apenas como os indices dos pontos visitados. Os objetos vêm da tabela de nós do mapa
+        # Sem frota nem tabela, o carro mantém a sua própria tabela, apenas com os pontos que visitou
+        # As métricas da agenda são acumuladas a cada atendimento/reabastecimento, sem refazer a agenda
+        if self.nos is None:
+            self.nos = self.frota.mapa.nos if self.frota is not None else {self.origem.indice: self.origem}
+        self.rota = array_compacto('i', [self.origem.indice])
         self.carga = self.capacidade
         self.fim = 0
+        self.distancia = 0.0
+        self.tempo_deslocamento_total = 0
+        self.qtd_clientes = 0
+        self._inicio = None
 
-    def __repr__(self): return f'Carro{self.id}(O+{len(self.agenda)}>>{self.posicao} |{self.carga}| [{self.inicio}, {self.fim}])'
+    def __repr__(self): return f'Carro{self.id}(O+{len(self.rota)}>>{self.posicao} |{self.carga}| [{self.inicio}, {self.fim}])'
     def __str__(self): return self.__repr__()
 
     @property
-    def posicao(self): return self.agenda[-1]
+    def posicao(self): return self.nos[self.rota[-1]]
+
+    @property
+    def agenda(self) -> 'AgendaCarro':
+        return AgendaCarro(self.rota, self.nos)
 
     @property
     def inicio(self):
-        return 0 if len(self.agenda) == 0 else max([
-            0,
-            self.agenda[1].inicio - self.tempo_deslocamento(origem=self.agenda[0], destino=self.agenda[1])
-        ])
+        # Depende apenas dos dois primeiros itens da agenda: calculado uma única vez
+        if len(self.rota) < 2: return 0  # Ainda no depósito: não é guardado, pois a agenda vai crescer
+        if self._inicio is None:
+            primeiro, segundo = self.nos[self.rota[0]], self.nos[self.rota[1]]
+            self._inicio = max([0, segundo.inicio - self.tempo_deslocamento(origem=primeiro, destino=segundo)])
+        return self._inicio
+
+    @property
+    def fim_com_retorno(self) -> int:
+        # Fim da agenda fechada: rotas abertas (terminando em um cliente) ainda precisam voltar ao depósito
+        if self.posicao.tipo != 'Cliente': return self.fim
+        return self.fim + self.tempo_deslocamento(self.origem) + self.origem.servico
+
+    @property
+    def tempo_layover(self) -> int:
+        # Cada passo da agenda avança o fim em (deslocamento + layover). O layover total é o restante do fim
+        return self.fim - self.tempo_deslocamento_total
 
     @property
     def clientes_atendidos(self) -> set:
-        return set([str(cli) for cli in self.agenda if cli.tipo == 'Cliente'])
+        return set(indice for indice in self.rota if self.nos[indice].tipo == 'Cliente')
+
+    @property
+    def indices_visitados(self) -> List[int]:
+        return self.rota.tolist()
+
+    def registra_no(self, item: Union[Cliente, Deposito]):
+        self.rota.append(item.indice)
+        if type(self.nos) is dict: self.nos[item.indice] = item
 
     def tempo_deslocamento(self, destino:Union[Cliente, Deposito], distancia=None, origem=None) -> int:
         pos = self.posicao if origem is None else origem
@@ -181,8 +371,12 @@ class Carro(object):
         tempo_deslocamento = self.tempo_deslocamento(deposito, distancia=distancia)
         delta_fim = tempo_deslocamento + deposito.servico
         self.fim += delta_fim
-        self.agenda.append(deposito)
+        self.registra_no(deposito)
         self.carga = self.capacidade
+        self.distancia += distancia
+        self.tempo_deslocamento_total += tempo_deslocamento
+        if self.frota is not None and self.frota.instrumentacao is not None:
+            self.frota.instrumentacao.conta('frota.reabastecimentos')
         return distancia, tempo_deslocamento, delta_fim-tempo_deslocamento
 
     def atendimento(self, cliente: Cliente) -> (float, int, int):
@@ -191,20 +385,37 @@ class Carro(object):
         delta_fim = max([self.fim + tempo_deslocamento + cliente.servico, cliente.inicio + cliente.servico]) - self.fim
         assert delta_fim > 0, f'ABASTECIMENTO INVALIDO {self} -> {cliente}'
         self.fim += delta_fim
-        self.agenda.append(cliente)
+        self.registra_no(cliente)
         self.carga = self.carga - cliente.demanda
+        self.distancia += distancia
+        self.tempo_deslocamento_total += tempo_deslocamento
+        self.qtd_clientes += 1
+        if self.frota is not None: self.frota.registra_atendimento(cliente)
         return distancia, tempo_deslocamento, delta_fim-tempo_deslocamento
 
     def resultado(self, display=True) -> Tuple[int, float, int, int, int]:
+        # Sem display, as métricas acumuladas são retornadas diretamente. Com display, a agenda é refeita e impressa
+        if not display:
+            return self.inicio, self.distancia, self.tempo_deslocamento_total, self.tempo_layover, self.fim
+        return self.refaz_resultado(display=display)
+
+    def refaz_resultado(self, display=True) -> Tuple[int, float, int, int, int]:
 
         if display: print(self)
-        dummy = Carro(id='DUMMY:'+self.id, origem=self.origem, velocidade=self.velocidade, capacidade=self.capacidade)
+        dummy = Carro(id='DUMMY:'+self.id, origem=self.origem, velocidade=self.velocidade, capacidade=self.capacidade,
+                      nos=self.nos)
         distancia_total = 0.0
         tempo_deslocamento_total = 0
         tempo_layover_total = 0
 
         for pos, item in enumerate(self.agenda):
             fim_anterior = dummy.fim
+
+            # O primeiro item é a origem, onde o carro já está: não há deslocamento até ele
+            if pos == 0:
+                if display: print('\t', item)
+                continue
+
             if item.tipo == 'Cliente':
                 distancia, tempo_deslocamento, tempo_layover = dummy.atendimento(item)
             else:
@@ -223,8 +434,31 @@ class Carro(object):
         return self.inicio, distancia_total, tempo_deslocamento_total, tempo_layover_total, self.fim
 
 
+class AgendaCarro(object):
+    """Visão (somente leitura) da agenda de um carro como os objetos do mapa. O carro guarda apenas os indices dos
+    pontos visitados (array('i')), e cada objeto é obtido da tabela de nós apenas quando acessado"""
+    __slots__ = ('rota', 'nos')
+
+    def __init__(self, rota: array_compacto, nos: List[Union[Cliente, Deposito]]):
+        self.rota = rota
+        self.nos = nos
+
+    def __repr__(self): return f'AgendaCarro({self.rota.tolist()})'
+    def __str__(self): return self.__repr__()
+    def __len__(self): return len(self.rota)
+
+    def __getitem__(self, posicao):
+        if isinstance(posicao, slice): return [self.nos[indice] for indice in self.rota[posicao]]
+        return self.nos[self.rota[posicao]]
+
+    def __iter__(self) -> Iterator[Union[Cliente, Deposito]]:
+        nos = self.nos
+        for indice in self.rota:
+            yield nos[indice]
+
+
 def copia_carro(og: Carro):
-    carro = Carro(id='COPY:' + og.id, origem=og.origem, velocidade=og.velocidade, capacidade=og.capacidade)
+    carro = Carro(id='COPY:' + og.id, origem=og.origem, velocidade=og.velocidade, capacidade=og.capacidade, nos=og.nos)
     for item in og.agenda[1:]:
         if item.tipo == 'Cliente':
             carro.atendimento(item)
@@ -233,22 +467,99 @@ def copia_carro(og: Carro):
     return carro
 
 
+class CarroSimulado(object):
+    """Estado de rota leve, usado na recursão de atratividade no lugar de uma cópia completa do carro.
+    Cada atendimento simulado gera um novo estado ligado ao anterior, em O(1). O carro real nunca é alterado"""
+    __slots__ = ('pai', 'posicao', 'velocidade', 'capacidade', 'carga', 'fim', 'frota', 'cursor_janelas')
+
+    def __init__(self, pai: Union[Carro, 'CarroSimulado'], cliente: Cliente, tempo_deslocamento: int):
+        self.pai = pai
+        self.posicao = cliente
+        self.velocidade = pai.velocidade
+        self.capacidade = pai.capacidade
+        self.carga = pai.carga - cliente.demanda
+        self.fim = max([pai.fim + tempo_deslocamento + cliente.servico, cliente.inicio + cliente.servico])
+        self.frota = None  # Um carro simulado nunca pertence à frota
+        self.cursor_janelas = pai.cursor_janelas  # O fim só avança: o cursor do pai continua válido
+        assert self.fim > pai.fim, f'ABASTECIMENTO INVALIDO {pai} -> {cliente}'
+
+    def __repr__(self): return f'CarroSimulado({self.carro_real.id}+{len(self.simulados)}>>{self.posicao} |{self.carga}| [{self.fim}])'
+    def __str__(self): return self.__repr__()
+
+    @property
+    def simulados(self) -> List[Cliente]:
+        simulados, estado = [], self
+        while isinstance(estado, CarroSimulado):
+            simulados.append(estado.posicao)
+            estado = estado.pai
+        return simulados[::-1]
+
+    @property
+    def carro_real(self) -> Carro:
+        estado = self.pai
+        while isinstance(estado, CarroSimulado):
+            estado = estado.pai
+        return estado
+
+    @property
+    def agenda(self) -> List[Union[Cliente, Deposito]]:
+        return list(self.carro_real.agenda) + self.simulados
+
+    @property
+    def indices_visitados(self) -> List[int]:
+        # Os clientes de um carro real da frota já estão na mascara da frota. Só percorremos os estados simulados
+        carro_real = self.carro_real
+        indices = [cli.indice for cli in self.simulados]
+        return indices if carro_real.frota is not None else carro_real.indices_visitados + indices
+
+
+def simula_atendimento(mapa: Mapa, carro: Union[Carro, CarroSimulado], cliente: Cliente) -> CarroSimulado:
+    tempo_deslocamento = mapa.tempo_deslocamento(carro.posicao.indice, cliente.indice, carro.velocidade)
+    return CarroSimulado(carro, cliente, tempo_deslocamento)
+
+
 def unifica_agendas_carros(pri: Carro, seg: Carro):
     assert pri.id != seg.id, 'TENTATIVA DE UNIFICAR CARROS DE MESMO ID!'
-    assert len({str(pri.origem), pri.velocidade, pri.capacidade}.intersection(
-        {str(seg.origem), seg.velocidade, seg.capacidade})
-    ) == 3, 'TENTATIVA DE UNIFICAR CARROS DE CONFIGURAÇÕES DIFERENTES!'
-    carro = Carro(id=f'{pri.id}+{seg.id}', origem=pri.origem, velocidade=pri.velocidade, capacidade=pri.capacidade)
-    for item in pri.agenda[1:]:
+    assert (pri.origem.indice, pri.velocidade, pri.capacidade) == (seg.origem.indice, seg.velocidade, seg.capacidade), \
+        'TENTATIVA DE UNIFICAR CARROS DE CONFIGURAÇÕES DIFERENTES!'
+    carro = Carro(id=f'{pri.id}+{seg.id}', origem=pri.origem, velocidade=pri.velocidade, capacidade=pri.capacidade,
+                  nos=pri.nos)
+    for item in pri.agenda[1:] + seg.agenda[1:]:
         if item.tipo == 'Cliente':
-            carro.atendimento(deepcopy(item))
-        else:
-            carro.reabastecimento(deepcopy(item))
-    for item in seg.agenda[1:]:
-        if item.tipo == 'Cliente':
-            carro.atendimento(deepcopy(item))
+            carro.atendimento(item)
         else:
-            carro.reabastecimento(deepcopy(item))
+            carro.reabastecimento(item)
+    return carro
+
+
+def encadeia_carros(carros: List[Carro]) -> Carro:
+    """Une as agendas de carros compatíveis (cada um volta ao depósito antes do inicio do próximo) em um único carro.
+    Rotas abertas (terminando em um cliente, p.ex. da rota coletiva) recebem o retorno ao depósito antes do próximo
+    carro. Como cada carro sai do depósito somente no seu inicio, os horários das agendas não mudam na união: as
+    agendas são apenas concatenadas (como indices), sem cópias e sem refazer os atendimentos"""
+    pri = carros[0]
+    carro = Carro(id='+'.join(c.id for c in carros), origem=pri.origem, velocidade=pri.velocidade,
+                  capacidade=pri.capacidade, nos=pri.nos)
+    for anterior, seguinte in zip(carros[:-1], carros[1:]):
+        assert (anterior.origem.indice, anterior.velocidade, anterior.capacidade) == \
+               (seguinte.origem.indice, seguinte.velocidade, seguinte.capacidade), \
+            'TENTATIVA DE UNIFICAR CARROS DE CONFIGURAÇÕES DIFERENTES!'
+        assert anterior.fim_com_retorno <= seguinte.inicio, \
+            f'TENTATIVA DE UNIFICAR CARROS SOBREPOSTOS! {anterior} {seguinte}'
+    carro.rota = array_compacto('i', pri.rota)
+    retornos = 0
+    for anterior, seguinte in zip(carros[:-1], carros[1:]):
+        if anterior.posicao.tipo == 'Cliente':
+            retornos += anterior.tempo_deslocamento(anterior.origem)
+            carro.rota.append(anterior.origem.indice)
+        carro.rota.extend(seguinte.rota[1:])
+    carro.fim = carros[-1].fim
+    carro.carga = carros[-1].carga
+    carro.distancia = pri.distancia
+    for anterior, item in zip(carro.agenda[len(pri.rota)-1:-1], carro.agenda[len(pri.rota):]):
+        carro.distancia += anterior.distancia(item)  # Mesma ordem de soma de atendimento/reabastecimento
+    carro.tempo_deslocamento_total = sum(c.tempo_deslocamento_total for c in carros) + retornos
+    carro.qtd_clientes = sum(c.qtd_clientes for c in carros)
     return carro
 
 
@@ -260,8 +571,20 @@ class Frota(object):
     velocidade_carro: int
     carros: Dict
     deposito: Deposito
-
-    def __init__(self, mapa: Mapa, velocidade_carro: int):
+    atendidos: ndarray
+    atendidos_por_fim: ndarray
+    atendidos_por_inicio: ndarray
+    qtd_atendidos: int
+    instrumentacao: object
+    candidatos: ndarray
+    indice_janelas: bool
+    horizonte: int
+    largura_feixe: int
+    gerador: object = field(default=None)
+    prazo: float = field(default=None)
+
+    def __init__(self, mapa: Mapa, velocidade_carro: int, instrumentacao=None, qtd_candidatos: int = None,
+                 indice_janelas: bool = False, horizonte: int = None, gerador=None, largura_feixe: int = None):
         self.velocidade_carro = velocidade_carro
         self.mapa = mapa
         self.max_carros = mapa.max_carros
@@ -269,11 +592,43 @@ class Frota(object):
         self.deposito = mapa.deposito
         self.carros = {}
 
-    def __repr__(self): return f'Frota<{self.mapa.nome}>(|{len(self.carros)}/{self.mapa.max_carros}| x {len(self.clientes_atendidos)}/{len(self.mapa.clientes)}])'
+        # Mascara (por indice do mapa) dos clientes atendidos pela frota, mantida incrementalmente pelos carros
+        # O depósito é sempre marcado como atendido, mas não é contado
+        self.atendidos = zeros(len(mapa.nos), dtype=bool)
+        self.atendidos[mapa.deposito.indice] = True
+        self.atendidos_por_fim = zeros(len(mapa.clientes), dtype=bool)  # A mesma mascara, na ordem do indice de janelas
+        self.atendidos_por_inicio = zeros(len(mapa.clientes), dtype=bool)  # E na ordem do indice por inicio
+        self.qtd_atendidos = 0
+        self.instrumentacao = instrumentacao  # Opcional: two_step_vrptw.instrumentacao.Instrumentacao
+
+        # Opcional: listas de candidatos (k vizinhos mais próximos) avaliadas antes do conjunto completo de clientes
+        self.candidatos = None if qtd_candidatos is None else mapa.lista_candidatos(qtd_candidatos)
+
+        # Com o indice de janelas, apenas os clientes de janela ainda aberta para o carro são avaliados. Com um
+        # horizonte, clientes cuja janela só abre depois de (fim do carro + horizonte) são adiados, e apenas o trecho
+        # alcançável do indice por inicio é avaliado. Medido: não compensa na escala de Solomon (100 clientes), onde o
+        # custo fixo por chamada domina e a viabilidade fica 5-10% mais lenta que a avaliação completa. Só o horizonte
+        # reduz o trabalho em instâncias grandes de janelas estreitas (3000 clientes: cerca de 30% menos). Por isso,
+        # ambos são opcionais e desligados por padrão
+        self.indice_janelas = indice_janelas
+        self.horizonte = horizonte
+
+        # Opcional: numpy.random.Generator usado nos sorteios da construção. Sem ele, usamos o estado global de numpy
+        self.gerador = gerador
+
+        # Opcional: lookahead por busca em feixe (com esta largura), no lugar da recursão em profundidade
+        self.largura_feixe = largura_feixe
+
+        # Opcional: instante (perf_counter) a partir do qual as construções falham e a busca local é interrompida
+        self.prazo = None
+
+    def __repr__(self): return f'Frota<{self.mapa.nome}>(|{len(self.carros)}/{self.mapa.max_carros}| x {self.qtd_atendidos}/{len(self.mapa.clientes)}])'
     def __str__(self): return self.__repr__()
     def __len__(self): return len(self.carros)
 
-    def __getitem__(self, item): return self.mapa.dict_referencias[item]
+    def __getitem__(self, item):
+        if isinstance(item, str): return self.mapa.dict_referencias[item]
+        return self.mapa.nos[item]
 
     def __iter__(self) -> Iterator[Carro]:
         for carro in self.carros.values():
@@ -281,40 +636,176 @@ class Frota(object):
 
     @property
     def clientes_atendidos(self) -> set:
-        result = set()
-        for carro in self.carros.values():
-            result = result.union(carro.clientes_atendidos)
-        return result
+        return set(self.atendidos.nonzero()[0].tolist()) - {self.deposito.indice}
 
     @property
     def clientes_faltantes(self) -> set:
-        return set(map(str, self.mapa.clientes)) - self.clientes_atendidos
+        return set((~self.atendidos).nonzero()[0].tolist())
 
     @property
-    def sumario(self) -> DataFrame:
-        sumario = []
-        for carro in self.carros.values():
-            inicio, distancia, t_desloc, t_layover, fim = carro.resultado(display=False)
-            sumario.append({'carro': carro.id, 'inicio': inicio, 'fim': fim, 'distancia': distancia,
-                            'tempo_deslocamento': t_desloc, 'tempo_layover': t_layover,
-                            'qtd_clientes': len(carro.clientes_atendidos)})
-        sumario = DataFrame(sumario)
-        sumario.loc[:, 'tempo_atividade'] = sumario['fim'] - sumario['inicio']
-        return sumario
+    def qtd_clientes_faltantes(self) -> int:
+        return len(self.mapa.clientes) - self.qtd_atendidos
+
+    @property
+    def prazo_esgotado(self) -> bool:
+        return self.prazo is not None and perf_counter() > self.prazo
+
+    def registra_atendimento(self, cliente: Cliente):
+        if not self.atendidos[cliente.indice]:
+            self.atendidos[cliente.indice] = True
+            self.atendidos_por_fim[self.mapa.posicoes_por_fim[cliente.indice]] = True
+            self.atendidos_por_inicio[self.mapa.posicoes_por_inicio[cliente.indice]] = True
+            self.qtd_atendidos += 1
+        if self.instrumentacao is not None: self.instrumentacao.conta('frota.atendimentos')
+
+    def mascara_atendidos(self, carro: Carro = None) -> ndarray:
+        # Mascara booleana (por indice do mapa) dos pontos já visitados pela frota e pelo carro informado
+        # Carros da frota já estão na mascara incremental. Apenas carros simulados (cópias) precisam ser somados
+        # A mascara retornada pode ser a da própria frota, e não deve ser modificada
+        if carro is None or carro.frota is self: return self.atendidos
+        if self.instrumentacao is not None: self.instrumentacao.conta('frota.copias_mascara')
+        mascara = self.atendidos.copy()
+        mascara[carro.indices_visitados] = True
+        return mascara
+
+    def atendidos_em(self, indices: ndarray, carro: Carro = None) -> ndarray:
+        # Mesma mascara de mascara_atendidos, mas apenas nos indices informados e sem copiar a mascara da frota
+        mascara = self.atendidos[indices]
+        if carro is None or carro.frota is self: return mascara
+        for visitado in carro.indices_visitados:  # Poucos clientes simulados: comparações diretas superam isin
+            mascara |= (indices == visitado)
+        return mascara
+
+    def cursor_em_aberto(self, carro: Carro) -> int:
+        # Posição, no indice de janelas, do primeiro cliente cuja janela ainda não fechou para o carro
+        # O fim do carro só avança, e portanto o cursor também: a busca binária no indice inteiro (pelo método do
+        # ndarray, sem fatia e sem o envoltório de numpy.searchsorted) nunca recua aquém do cursor atual
+        cursor = int(self.mapa.fins_por_fim.searchsorted(carro.fim, side='right'))
+        carro.cursor_janelas = cursor
+        return cursor
+
+    @property
+    def colunas_sumario(self) -> Dict[str, ndarray]:
+        # Colunas do sumário (uma linha por carro), montadas de uma vez a partir das métricas acumuladas por carro
+        carros = list(self.carros.values())
+        inicios = array([carro.inicio for carro in carros], dtype=int64)
+        fins = array([carro.fim for carro in carros], dtype=int64)
+        tempos_deslocamento = array([carro.tempo_deslocamento_total for carro in carros], dtype=int64)
+        return {
+            'carro': array([carro.id for carro in carros], dtype=str), 'inicio': inicios, 'fim': fins,
+            'distancia': array([carro.distancia for carro in carros], dtype=float64),
+            'tempo_deslocamento': tempos_deslocamento, 'tempo_layover': fins - tempos_deslocamento,
+            'qtd_clientes': array([carro.qtd_clientes for carro in carros], dtype=int64),
+            'tempo_atividade': fins - inicios
+        }
+
+    @property
+    def sumario(self) -> 'DataFrame':
+        from pandas import DataFrame
+        return DataFrame(self.colunas_sumario)
+
+    def novo_id_carro(self) -> str:
+        # Carros removidos, unidos ou refeitos deixam ids não sequenciais: procuramos o primeiro id numérico livre,
+        # para que um novo carro nunca substitua um carro existente (e os seus clientes atendidos)
+        numero = len(self.carros)
+        while str(numero) in self.carros:
+            numero += 1
+        return str(numero)
 
     def novo_carro(self) -> Carro:
-        carro = Carro(str(len(self.carros)), self.deposito, self.velocidade_carro, self.capacidade_carro)
+        carro = Carro(self.novo_id_carro(), self.deposito, self.velocidade_carro, self.capacidade_carro, frota=self)
         self.carros[carro.id] = carro
         return carro
 
     def limpa_carros_sem_agenda(self):
+        # Carros sem agenda não atenderam clientes, então a mascara de atendidos não muda
         para_remover = []
         for id_carro, carro in self.carros.items():
-            if len(carro.agenda) < 2:
+            if len(carro.rota) < 2:
                 para_remover.append(id_carro)
         for id_carro in para_remover:
             self.carros.pop(id_carro)
         return para_remover
 
+    def substitui_mapa(self, mapa: Mapa):
+        # Troca o mapa por uma extensão sua (Mapa.com_clientes): os indices existentes são mantidos, os novos
+        # clientes ainda não foram atendidos e os cursores de janelas (posições no novo indice) são reiniciados
+        atendidos = zeros(len(mapa.nos), dtype=bool)
+        atendidos[:len(self.atendidos)] = self.atendidos
+        self.mapa = mapa
+        self.atendidos = atendidos
+        self.atendidos_por_fim = atendidos[mapa.ordem_fins]
+        self.atendidos_por_inicio = atendidos[mapa.ordem_inicios]
+        if self.candidatos is not None: self.candidatos = mapa.lista_candidatos(self.candidatos.shape[1])
+        for carro in self:
+            carro.nos = mapa.nos
+            carro.cursor_janelas = 0
+
     def substitui_carros(self, novos_carros: List[Carro]):
+        # A substituição (p.ex. unificação de agendas) preserva os clientes atendidos. Apenas vinculamos os carros
+        for carro in novos_carros:
+            carro.frota = self
         self.carros = {c.id: c for c in novos_carros}
+
+
+# ######################################################################################################################
+# ESTRUTURAS AUXILIARES
+
+
+class TabelaTransposicao(object):
+    """Cache LRU de atratividades já calculadas, indexado pelo estado de um carro (simulado ou não) e pela
+    profundidade de recursão restante. Diferentes ordens de visita que levam ao mesmo estado (posição, fim, carga e
+    clientes atendidos) compartilham o mesmo resultado. Válida para uma única combinação de Parametros e Frota.
+    Acertos e falhas contam estados (uma busca por nó da recursão). O reaproveitamento da atratividade imediata de
+    um estado que falhou na sua profundidade é contado à parte"""
+
+    def __init__(self, tamanho_maximo: int = 100000):
+        assert tamanho_maximo > 0, f'TAMANHO DE TABELA DE TRANSPOSICAO INVALIDO! {tamanho_maximo}'
+        self.tamanho_maximo = tamanho_maximo
+        self.entradas = OrderedDict()
+        self.acertos = 0
+        self.falhas = 0
+        self.reaproveitamentos = 0
+        self.descartes = 0
+
+    def __repr__(self): return f'TabelaTransposicao(|{len(self.entradas)}/{self.tamanho_maximo}| +{self.acertos} -{self.falhas} ~{self.reaproveitamentos} x{self.descartes})'
+    def __str__(self): return self.__repr__()
+    def __len__(self): return len(self.entradas)
+
+    @property
+    def taxa_acertos(self) -> float:
+        consultas = self.acertos + self.falhas
+        return 0.0 if consultas == 0 else self.acertos / consultas
+
+    @staticmethod
+    def estado(frota: Frota, carro: Union[Carro, CarroSimulado]) -> tuple:
+        return carro.posicao.indice, carro.fim, carro.carga, packbits(frota.mascara_atendidos(carro)).tobytes()
+
+    def busca(self, estado: tuple, profundidade: int):
+        chave = (estado, profundidade)
+        if chave in self.entradas:
+            self.entradas.move_to_end(chave)
+            self.acertos += 1
+            return self.entradas[chave]
+        self.falhas += 1
+        return None
+
+    def busca_imediata(self, estado: tuple):
+        # Atratividade imediata (profundidade 0) de um estado que já falhou na sua profundidade. Não altera acertos
+        # nem falhas, para que cada estado seja contado uma única vez
+        chave = (estado, 0)
+        if chave not in self.entradas: return None
+        self.entradas.move_to_end(chave)
+        self.reaproveitamentos += 1
+        return self.entradas[chave]
+
+    def armazena(self, estado: tuple, profundidade: int, atratividade: List[Tuple]):
+        chave = (estado, profundidade)
+        self.entradas[chave] = atratividade
+        self.entradas.move_to_end(chave)
+        if len(self.entradas) > self.tamanho_maximo:
+            self.entradas.popitem(last=False)  # Descartamos a entrada usada há mais tempo
+            self.descartes += 1
+
+    def limpa(self):
+        self.entradas.clear()
@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""vizinhanca.py: Indice espacial em grade uniforme e listas de candidatos (k vizinhos mais próximos) por ponto"""
+
+__copyright__ = "Copyright (c) 2021 Isabella Freitas & José Fonseca. MIT. See attached LICENSE.txt file"
+
+
+from math import ceil
+
+from numpy import ndarray, empty, concatenate, lexsort, argsort, searchsorted, arange, minimum, maximum, \
+    sqrt, float64, int64
+
+
+# ######################################################################################################################
+# GRADE UNIFORME
+
+
+class GradeEspacial(object):
+    """Grade uniforme de células quadradas sobre um conjunto de pontos. Cada célula guarda os pontos que contém,
+    e as consultas de vizinhos percorrem anéis de células ao redor da célula consultada, do mais próximo ao mais
+    distante, até que nenhum ponto ainda não visitado possa estar mais próximo que os k já encontrados"""
+
+    def __init__(self, coordenadas: ndarray, pontos_por_celula: int = 2):
+        self.coordenadas = coordenadas.astype(float64)
+        self.minimo = self.coordenadas.min(axis=0)
+        extensao = float((self.coordenadas.max(axis=0) - self.minimo).max())
+        self.dimensao = max([1, int(ceil((len(self.coordenadas) / pontos_por_celula) ** 0.5))])
+        self.lado = (extensao / self.dimensao) if extensao > 0 else 1.0
+
+        # Os pontos são ordenados por célula. Os pontos da célula c estão em ordem[limites[c]:limites[c+1]]
+        celulas = self.celula(self.coordenadas)
+        ids = celulas[:, 0] * self.dimensao + celulas[:, 1]
+        self.ordem = argsort(ids, kind='stable')
+        self.limites = searchsorted(ids[self.ordem], arange(self.dimensao**2 + 1))
+
+    def __repr__(self): return f'GradeEspacial({len(self.coordenadas)} em {self.dimensao}x{self.dimensao} /{round(self.lado, 3)})'
+    def __str__(self): return self.__repr__()
+
+    def celula(self, coordenadas: ndarray) -> ndarray:
+        # Pontos fora da grade (p.ex. o depósito) são atribuídos à célula de borda mais próxima
+        celulas = ((coordenadas - self.minimo) / self.lado).astype(int64)
+        return minimum(maximum(celulas, 0), self.dimensao - 1)
+
+    def pontos_no_anel(self, cx: int, cy: int, raio: int) -> ndarray:
+        # Pontos das células a distância de Chebyshev 'raio' da célula (cx, cy)
+        if raio == 0:
+            celulas = [(cx, cy)]
+        else:
+            celulas = [(x, y) for x in (cx - raio, cx + raio) for y in range(cy - raio, cy + raio + 1)]
+            celulas += [(x, y) for x in range(cx - raio + 1, cx + raio) for y in (cy - raio, cy + raio)]
+        fatias = [self.ordem[self.limites[c]:self.limites[c+1]]
+                  for c in (x * self.dimensao + y for x, y in celulas
+                            if 0 <= x < self.dimensao and 0 <= y < self.dimensao)]
+        return concatenate(fatias) if len(fatias) > 0 else empty(0, dtype=int64)
+
+    def vizinhos(self, ponto: ndarray, k: int, excluido: int = -1) -> ndarray:
+        """Posições (nas coordenadas da grade) dos k pontos mais próximos do ponto informado, em ordem crescente de
+        distância (arredondada em 3 casas, como no mapa), com desempate pela posição. 'excluido' nunca é retornado"""
+        if k <= 0: return empty(0, dtype=int64)
+        cx, cy = self.celula(ponto[None, :])[0].tolist()
+        encontrados = []
+        for raio in range(self.dimensao + 1):
+            novos = self.pontos_no_anel(cx, cy, raio)
+            encontrados.append(novos[novos != excluido])
+            qtd = sum(len(e) for e in encontrados)
+            if qtd < k: continue
+
+            # Pontos dos anéis ainda não visitados estão a pelo menos raio*lado do ponto consultado
+            # A comparação estrita garante também o desempate por posição em distâncias iguais ao limite
+            indices = concatenate(encontrados)
+            delta = self.coordenadas[indices] - ponto
+            distancias = sqrt((delta * delta).sum(axis=1)).round(3)
+            ordem = lexsort((indices, distancias))[:k]
+            if distancias[ordem[-1]] < raio * self.lado: return indices[ordem]
+
+        # Grade inteira visitada: retornamos todos os pontos (até k) em ordem de distância
+        indices = concatenate(encontrados)
+        delta = self.coordenadas[indices] - ponto
+        distancias = sqrt((delta * delta).sum(axis=1)).round(3)
+        return indices[lexsort((indices, distancias))[:k]]
+
+
+# ######################################################################################################################
+# LISTAS DE CANDIDATOS
+
+
+def vizinhos_mais_proximos(coordenadas: ndarray, k: int, pontos_por_celula: int = 2) -> ndarray:
+    """Matriz (N+1 x k) com, para cada ponto do mapa (depósito na linha 0), os indices dos k clientes mais próximos,
+    sem o próprio ponto. Os candidatos são sempre clientes (indices 1..N). k é limitado a N-1"""
+    qtd_clientes = len(coordenadas) - 1
+    k = max([0, min([k, qtd_clientes - 1])])
+    grade = GradeEspacial(coordenadas[1:], pontos_por_celula=pontos_por_celula)
+    coordenadas = coordenadas.astype(float64)
+    candidatos = empty((len(coordenadas), k), dtype=int64)
+    for indice in range(len(coordenadas)):
+        # Na grade, o cliente de indice i está na posição i-1. O depósito (-1) não está na grade
+        candidatos[indice] = grade.vizinhos(coordenadas[indice], k, excluido=indice - 1) + 1
+    return candidatos
@@ -7,14 +7,73 @@ __copyright__ = "Copyright (c) 2021 Isabella Freitas & José Fonseca. MIT. See a
 
 
 import sys
+import glob
 import timeit
+import pickle
+from dataclasses import replace
 from pprint import pprint
-from two_step_vrptw.utils import Frota, Parametros, Mapa
-from two_step_vrptw import algorithms
+from pandas import DataFrame
+from numpy import random, float32, concatenate, ix_
+from two_step_vrptw.utils import Frota, Parametros, Mapa, Cliente, TabelaTransposicao, copia_carro, simula_atendimento
+from two_step_vrptw import algorithms, busca_local, multipartida, insercao, decomposicao
+from two_step_vrptw.distancias import cria_provedor, DistanciasSobDemanda
+from two_step_vrptw.instrumentacao import Instrumentacao
+
+
+# Provedores de distâncias exatos (mesmas distâncias da matriz densa). O orçamento força descartes no cache LRU
+PROVEDORES_EXATOS = [('densa', {}), ('quantizada', {}), ('sob_demanda', {'orcamento_memoria': 20 * 101 * 8})]
 
 
 def time_it(nome, qtd_repeticoes, funcao):
-    print(nome, '\t', round(timeit.timeit(funcao, number=qtd_repeticoes) / qtd_repeticoes * 1000, 3), f'(ms) |{qtd_repeticoes}|')
+    tempo = timeit.timeit(funcao, number=qtd_repeticoes) / qtd_repeticoes * 1000
+    print(nome, '\t', round(tempo, 3), f'(ms) |{qtd_repeticoes}|')
+    return tempo
+
+
+def primeiro_mapa_valido_por_classe(diretorio='data/solomon_1987'):
+    # Algumas instâncias possuem clientes com janela de serviço inválida. Usamos a primeira válida de cada classe
+    mapas = {}
+    for arquivo in sorted(glob.glob(f'{diretorio}/*/*.txt')):
+        classe = arquivo.split('/')[-2]
+        if classe in mapas: continue
+        try:
+            mapas[classe] = Mapa(arquivo)
+        except AssertionError:
+            continue
+    return mapas
+
+
+def identifica_clientes_viaveis_dataframe(frota, carro, df_distancias):
+    # Implementação de referência (por rótulos de DataFrame), usada apenas para medir o ganho do kernel vetorizado
+    clientes_atendidos = set(str(frota[i]) for i in frota.clientes_atendidos)
+    clientes_atendidos = clientes_atendidos.union(str(c) for c in carro.agenda if c.tipo == 'Cliente')
+    clientes_viaveis = {c: frota[c] for c in set(map(str, frota.mapa.clientes)).difference(clientes_atendidos)}
+    clientes_viaveis = {c: v for c, v in clientes_viaveis.items() if v.demanda <= carro.carga and v.fim > carro.fim}
+    if len(clientes_viaveis) == 0: return {}
+    str_clientes_viaveis = list(clientes_viaveis.keys())
+    posicao_atual = str(carro.agenda[-1])
+    clientes_viaveis = (
+        (df_distancias[str_clientes_viaveis].loc[posicao_atual] / carro.velocidade).astype(int) + 1
+      + DataFrame([[frota[c].inicio + frota[c].servico - frota[c].fim for c in str_clientes_viaveis]],
+                  columns=str_clientes_viaveis, index=[posicao_atual])
+    ).iloc[0].to_dict()
+    return {c: v for c, v in clientes_viaveis.items() if v <= 0}
+
+
+def atratividade_feixe_exaustiva(parametros, frota, carro):
+    # Implementação de referência (enumeração completa, sem poda) da busca em feixe: cada raiz recebe o maior valor
+    # entre as sequências mais profundas que partem dela, pelas mesmas regras de viabilidade dos carros simulados
+    def melhor_sequencia(carro_simulado, nivel):
+        filhos = algorithms.atratividade_imediata(
+            parametros, frota, algorithms.identifica_clientes_viaveis(frota, carro_simulado), carro_simulado
+        ) if nivel <= parametros.limite_recursoes else []
+        if len(filhos) == 0: return (nivel, 0.0)
+        return max((lambda p, v: (p, (parametros.peso_recursoes ** nivel) * valor + v))(
+            *melhor_sequencia(simula_atendimento(frota.mapa, carro_simulado, frota[cliente]), nivel + 1)
+        ) for cliente, valor in filhos)
+    raizes = algorithms.atratividade_imediata(parametros, frota, algorithms.identifica_clientes_viaveis(frota, carro), carro)
+    return {cliente: valor + melhor_sequencia(simula_atendimento(frota.mapa, carro, frota[cliente]), 1)[1]
+            for cliente, valor in raizes}
 
 
 if __name__ == '__main__':
@@ -87,6 +146,24 @@ if __name__ == '__main__':
             carro = frota.novo_carro()
             pprint(algorithms.identifica_clientes_viaveis(frota, carro))
 
+    if ('viabilidade' in sys.argv):
+        for classe, mapa in primeiro_mapa_valido_por_classe().items():
+            frota = Frota(mapa, 1)
+            carro = frota.novo_carro()
+            rotulos = list(map(str, mapa.nos))
+            df_distancias = DataFrame(mapa.matriz_de_distancias, index=rotulos, columns=rotulos)
+            kernel = algorithms.identifica_clientes_viaveis(frota, carro)
+            referencia = identifica_clientes_viaveis_dataframe(frota, carro, df_distancias)
+            assert {str(frota[c]): v for c, v in kernel.items()} == referencia, f'KERNEL DIVERGENTE EM {mapa}'
+            if TO_TIME:
+                t_ref = time_it(f'VIABILIDADE DATAFRAME {classe}', 200,
+                                lambda: identifica_clientes_viaveis_dataframe(frota, carro, df_distancias))
+                t_ker = time_it(f'VIABILIDADE KERNEL    {classe}', 200,
+                                lambda: algorithms.identifica_clientes_viaveis(frota, carro))
+                print(mapa, '\t', f'SPEEDUP {round(t_ref / t_ker, 1)}x')
+            else:
+                print(mapa, len(kernel), 'clientes viaveis')
+
     if ('calcula_atratividade' in sys.argv):
         if TO_TIME:
             mapa = Mapa('data/solomon_1987/r2/r201.txt')
@@ -101,6 +178,468 @@ if __name__ == '__main__':
             clientes_viaveis = algorithms.identifica_clientes_viaveis(frota, carro)
             pprint(algorithms.calcula_atratividade(parametros, frota, clientes_viaveis, carro))
 
+    if ('transposicao' in sys.argv):
+        parametros_profundos = Parametros(peso_distancia=5.0, peso_urgencia=0.165, peso_recursoes=2.0,
+                                          limite_recursoes=4, clientes_recursao=4, limite_iteracoes=1000)
+        mapa = Mapa('data/solomon_1987/r2/r201.txt')
+        resultados = {}
+        for nome, tabela in [('SEM TABELA', None), ('COM TABELA', TabelaTransposicao(tamanho_maximo=200000))]:
+            random.seed(0)
+            frota = Frota(mapa, 1)
+            funcao = lambda: algorithms.gera_solucao(parametros_profundos, frota, tipo='rota_independente', tabela=tabela)
+            if TO_TIME:
+                time_it(f'ROTA INDEPENDENTE (recursao 4) {nome}', 1, funcao)
+            else:
+                funcao()
+            resultados[nome] = [[item.indice for item in carro.agenda] for carro in frota]
+            print(frota, tabela)
+        assert resultados['SEM TABELA'] == resultados['COM TABELA'], 'TABELA DE TRANSPOSICAO ALTEROU A SOLUCAO!'
+
+        # Cada nó da recursão é uma única busca na tabela: acertos + falhas contam estados, não consultas
+        random.seed(0)
+        tabela, instrumentacao = TabelaTransposicao(tamanho_maximo=200000), Instrumentacao()
+        frota = Frota(mapa, 1, instrumentacao=instrumentacao)
+        algorithms.gera_solucao(parametros_profundos, frota, tabela=tabela)
+        assert tabela.acertos + tabela.falhas == instrumentacao.contadores['lookahead.nos'], f'ESTADOS CONTADOS DUAS VEZES! {tabela}'
+        print(tabela, round(tabela.taxa_acertos, 3), '(taxa de acertos por estado)')
+
+    if ('instrumentacao' in sys.argv):
+        mapa = Mapa('data/solomon_1987/r2/r201.txt')
+        if TO_TIME:
+            frota = Frota(mapa, 1)
+            time_it('SOLUCAO SEM INSTRUMENTACAO', 10, lambda: algorithms.gera_solucao(parametros, frota))
+            frota = Frota(mapa, 1)
+            time_it('SOLUCAO COM INSTRUMENTACAO', 10,
+                    lambda: algorithms.gera_solucao(parametros, frota, instrumentacao=Instrumentacao()))
+        else:
+            eventos = {}
+            instrumentacao = Instrumentacao()
+            instrumentacao.inscreve(lambda tipo, nome, valor: eventos.update({tipo: eventos.get(tipo, 0) + 1}))
+            frota = Frota(mapa, 1)
+            resultado = algorithms.gera_solucao(parametros, frota, tabela=TabelaTransposicao(),
+                                                instrumentacao=instrumentacao)
+            validade, iteracoes = resultado
+            print(frota, validade, iteracoes, eventos)
+            algorithms.otimizacao_termino_mais_cedo(frota)
+            pprint(resultado.estatisticas)
+            pprint(instrumentacao.estatisticas)
+
+    if ('distancias' in sys.argv):
+        # Os modos exatos (todos, exceto float32) devem gerar exatamente a mesma solução
+        resultados = {}
+        for modo, kwargs in [('densa', {}), ('densa', {'dtype': float32}), ('quantizada', {}),
+                             ('sob_demanda', {'orcamento_memoria': 20 * 101 * 8})]:
+            mapa = Mapa('data/solomon_1987/r2/r201.txt', distancias=modo, **kwargs)
+            random.seed(0)
+            frota = Frota(mapa, 1)
+            funcao = lambda: algorithms.gera_solucao(parametros, frota, tipo='rota_independente')
+            nome = f'{modo} {kwargs}'
+            if TO_TIME:
+                time_it(f'ROTA INDEPENDENTE {nome}', 1, funcao)
+            else:
+                funcao()
+            if kwargs.get('dtype') is None: resultados[nome] = [[item.indice for item in carro.agenda] for carro in frota]
+            print(frota, mapa.distancias, mapa.distancias.nbytes, '(bytes)')
+        assert len(set(map(str, resultados.values()))) == 1, 'PROVEDOR DE DISTANCIAS ALTEROU A SOLUCAO!'
+
+        # Consultas de pares isolados devem ser idênticas às da matriz densa, sem calcular (nem guardar) linhas inteiras
+        mapa = Mapa('data/solomon_1987/r2/r201.txt')
+        for modo, kwargs in [('quantizada', {}), ('sob_demanda', {'orcamento_memoria': 20 * 101 * 8})]:
+            provedor = cria_provedor(modo, mapa.coordenadas, **kwargs)
+            for velocidade in (1, 3):
+                tempos = mapa.matriz_de_tempos(velocidade)
+                assert all(provedor.tempo(origem, destino, velocidade) == tempos[origem, destino]
+                           for origem in range(len(mapa.nos)) for destino in range(len(mapa.nos))), f'TEMPO DIVERGENTE! {provedor}'
+            assert all(provedor.distancia(origem, destino) == mapa.matriz_de_distancias[origem, destino]
+                       for origem in range(len(mapa.nos)) for destino in range(len(mapa.nos))), f'DISTANCIA DIVERGENTE! {provedor}'
+            if modo == 'sob_demanda':
+                assert provedor.falhas == 0 and len(provedor.cache_linhas) == 0, f'LINHAS CALCULADAS EM PARES! {provedor}'
+            print(provedor, '(pares)')
+
+    if ('candidatos' in sys.argv):
+        # As listas do indice espacial devem ser idênticas às de uma ordenação completa de cada linha da matriz
+        for arquivo in sorted(glob.glob('data/solomon_1987/*/*.txt')):
+            try:
+                mapa = Mapa(arquivo)
+            except AssertionError:
+                continue
+            matriz = mapa.matriz_de_distancias.copy()
+            matriz[:, 0] = float('inf')
+            for indice in range(len(mapa.nos)): matriz[indice, indice] = float('inf')
+            referencia = [sorted(range(len(mapa.nos)), key=lambda j: (linha[j], j))[:10] for linha in matriz.tolist()]
+            assert mapa.lista_candidatos(10).tolist() == referencia, f'LISTA DE CANDIDATOS INCORRETA! {mapa}'
+        print('LISTAS DE CANDIDATOS CORRETAS')
+
+        for classe, mapa in primeiro_mapa_valido_por_classe().items():
+            for qtd_candidatos in (None, 10, 20):
+                random.seed(0)
+                frota = Frota(mapa, 1)
+                instrumentacao = Instrumentacao()
+                funcao = lambda: algorithms.gera_solucao(parametros, frota, instrumentacao=instrumentacao,
+                                                         qtd_candidatos=qtd_candidatos)
+                if TO_TIME:
+                    time_it(f'ROTA INDEPENDENTE {classe} k={qtd_candidatos}', 1, funcao)
+                else:
+                    funcao()
+                print(frota, instrumentacao.contadores.get('candidatos.consultas', 0),
+                      instrumentacao.contadores.get('candidatos.buscas_completas', 0))
+
+    if ('janelas' in sys.argv):
+        # Sem horizonte, o indice de janelas apenas evita avaliar clientes de janela fechada: a solução é a mesma
+        for classe, mapa in primeiro_mapa_valido_por_classe().items():
+            resultados = {}
+            for indice_janelas in (False, True):
+                random.seed(0)
+                frota = Frota(mapa, 1, indice_janelas=indice_janelas)
+                instrumentacao = Instrumentacao()
+                funcao = lambda: algorithms.gera_solucao(parametros, frota, instrumentacao=instrumentacao)
+                if TO_TIME:
+                    time_it(f'ROTA INDEPENDENTE {classe} indice_janelas={indice_janelas}', 1, funcao)
+                else:
+                    funcao()
+                resultados[indice_janelas] = [[item.indice for item in carro.agenda] for carro in frota]
+                print(frota, round(instrumentacao.tempos.get('viabilidade', 0.0) * 1000, 3), '(ms viabilidade)',
+                      instrumentacao.contadores.get('janelas.clientes_descartados', 0), '(descartados)')
+                if indice_janelas:  # Cada cliente descartado é contado uma única vez por carro
+                    descartados = instrumentacao.contadores.get('janelas.clientes_descartados', 0)
+                    assert descartados == sum(carro.cursor_janelas for carro in frota), 'CONTADOR DE DESCARTADOS!'
+            assert resultados[False] == resultados[True], 'INDICE DE JANELAS ALTEROU A SOLUCAO!'
+            # Com horizonte, o trecho avaliado do indice por inicio deve conter exatamente os viáveis do sufixo aberto
+            # que abrem dentro do horizonte, e as agendas devem continuar válidas
+            no_horizonte = algorithms._viaveis_no_horizonte
+            def confere_horizonte(frota, carro):
+                viaveis, folgas = no_horizonte(frota, carro)
+                sufixo, _ = algorithms._viaveis_no_sufixo(frota, carro, frota.cursor_em_aberto(carro))
+                referencia = sorted(c for c in sufixo.tolist() if mapa.inicios[c] <= carro.fim + frota.horizonte)
+                assert sorted(viaveis.tolist()) == referencia, f'TRECHO DO HORIZONTE DIVERGENTE! {carro}'
+                return viaveis, folgas
+            algorithms._viaveis_no_horizonte = confere_horizonte
+            try:
+                random.seed(0)
+                instrumentacao = Instrumentacao()
+                frota = Frota(mapa, 1, indice_janelas=True, horizonte=100, instrumentacao=instrumentacao)
+                validade = algorithms.gera_solucao(parametros, frota)
+            finally:
+                algorithms._viaveis_no_horizonte = no_horizonte
+            for carro in [carro for carro in frota if len(carro.agenda) > 1]:
+                assert carro.resultado(display=False) == copia_carro(carro).resultado(display=False), f'AGENDA INVALIDA! {carro}'
+            print(frota, validade, '(horizonte 100)', instrumentacao.contadores.get('janelas.avaliados_no_horizonte', 0),
+                  '(avaliados no horizonte)', instrumentacao.contadores.get('viabilidade.chamadas', 0), '(chamadas)')
+
+    if ('otimizacao' in sys.argv):
+        # A união de rotas não pode alterar horários nem clientes: refazemos cada agenda unida e comparamos
+        for classe, mapa in primeiro_mapa_valido_por_classe().items():
+            random.seed(0)
+            frota = Frota(mapa, 1)
+            validade, _ = algorithms.gera_solucao(parametros, frota)
+            if not validade: continue
+            qtd_carros = len(frota)
+            if TO_TIME:
+                time_it(f'OTIMIZACAO {classe}', 1, lambda: algorithms.otimizacao_termino_mais_cedo(frota))
+            else:
+                algorithms.otimizacao_termino_mais_cedo(frota)
+            for carro in frota:
+                refeito = copia_carro(carro)
+                assert (refeito.fim, refeito.carga) == (carro.fim, carro.carga), f'UNIAO INVALIDA! {carro} {refeito}'
+            atendidos = sorted(item.indice for carro in frota for item in carro.agenda if item.tipo == 'Cliente')
+            assert atendidos == list(range(1, len(mapa.nos))), 'UNIAO PERDEU OU DUPLICOU CLIENTES!'
+            print(frota, qtd_carros, '>>', len(frota), '(carros)')
+
+
+        # Depois de remover carros os ids não são sequenciais: um novo carro não pode substituir um carro existente
+        frota = Frota(Mapa('data/solomon_1987/r2/r201.txt'), 1)
+        carros = [frota.novo_carro() for _ in range(3)]
+        carros[0].atendimento(frota[1])
+        carros[2].atendimento(frota[2])
+        frota.limpa_carros_sem_agenda()
+        novo = frota.novo_carro()
+        assert frota.carros[carros[2].id] is carros[2] and len(frota) == 3, f'CARRO SUBSTITUIDO! {novo}'
+        assert frota.qtd_atendidos == sum(len(carro.clientes_atendidos) for carro in frota), 'ATENDIDOS SEM CARRO!'
+
+        # A rota coletiva termina com rotas abertas (em um cliente): a união deve incluir o retorno ao depósito, e as
+        # métricas acumuladas e as janelas de tempo devem ser as da agenda refeita
+        for classe, mapa in primeiro_mapa_valido_por_classe().items():
+            random.seed(0)
+            frota = Frota(mapa, 1)
+            validade, _ = algorithms.gera_solucao(parametros, frota, tipo='rota_coletiva')
+            abertas = sum(carro.posicao.tipo == 'Cliente' for carro in frota)
+            qtd_carros = len(frota)
+            algorithms.otimizacao_termino_mais_cedo(frota)
+            avaliador = busca_local.Avaliador(mapa, frota.velocidade_carro, frota.capacidade_carro)
+            for carro in frota:
+                assert carro.resultado(display=False) == copia_carro(carro).resultado(display=False), \
+                    f'UNIAO DE ROTAS ABERTAS INVALIDA! {carro}'
+                nos = carro.rota.tolist() + ([avaliador.deposito] if carro.posicao.tipo == 'Cliente' else [])
+                assert busca_local.Rota(avaliador, nos).segmento.rota_viavel, f'JANELAS VIOLADAS NA UNIAO! {carro}'
+            print(frota, validade, abertas, '(abertas)', qtd_carros, '>>', len(frota), '(carros)')
+
+    if ('busca_local' in sys.argv):
+        # Os segmentos de cada rota devem reproduzir exatamente os horários, cargas e distâncias dos carros refeitos
+        for classe, mapa in primeiro_mapa_valido_por_classe().items():
+            random.seed(0)
+            frota = Frota(mapa, 1)
+            validade, _ = algorithms.gera_solucao(parametros, frota)
+            if not validade: continue
+            algorithms.otimizacao_termino_mais_cedo(frota)
+            antes = frota.sumario
+            if TO_TIME:
+                time_it(f'BUSCA LOCAL {classe}', 1, lambda: busca_local.busca_local(frota))
+            else:
+                pprint(busca_local.busca_local(frota))
+            avaliador = busca_local.Avaliador(mapa, frota.velocidade_carro, frota.capacidade_carro)
+            for carro in frota:
+                rota = busca_local.Rota(avaliador, [item.indice for item in carro.agenda])
+                inicio, distancia, _, _, fim = copia_carro(carro).resultado(display=False)
+                assert rota.segmento.rota_viavel, f'ROTA INVIAVEL! {carro}'
+                assert (rota.segmento.fim, round(rota.segmento.distancia, 3)) == (fim, round(distancia, 3)), \
+                    f'SEGMENTO DIVERGENTE! {rota} {carro}'
+            atendidos = sorted(item.indice for carro in frota for item in carro.agenda if item.tipo == 'Cliente')
+            assert atendidos == list(range(1, len(mapa.nos))), 'BUSCA LOCAL PERDEU OU DUPLICOU CLIENTES!'
+            depois = frota.sumario
+            print(frota, len(antes), round(antes['distancia'].sum(), 3), '>>', len(depois),
+                  round(depois['distancia'].sum(), 3), '(carros, distancia)')
+
+    if ('sumario' in sys.argv):
+        # As métricas acumuladas devem ser idênticas às de refazer a agenda de cada carro, antes e depois das melhorias
+        for classe, mapa in primeiro_mapa_valido_por_classe().items():
+            random.seed(0)
+            frota = Frota(mapa, 1)
+            validade, _ = algorithms.gera_solucao(parametros, frota)
+            etapas = [('construcao', lambda: None), ('otimizacao', lambda: algorithms.otimizacao_termino_mais_cedo(frota)),
+                      ('busca_local', lambda: busca_local.busca_local(frota))]
+            for etapa, funcao in (etapas if validade else etapas[:1]):
+                funcao()
+                for carro in frota:
+                    assert carro.resultado(display=False) == carro.refaz_resultado(display=False), \
+                        f'METRICAS ACUMULADAS DIVERGENTES! {etapa} {carro}'
+                print(frota, etapa, round(frota.sumario['distancia'].sum(), 3))
+            if TO_TIME:
+                time_it(f'SUMARIO {classe}', 100, lambda: frota.sumario)
+
+    if ('lote' in sys.argv):
+        # A rota coletiva em lote deve atender cada cliente uma única vez, com agendas válidas
+        for classe, mapa in primeiro_mapa_valido_por_classe().items():
+            random.seed(0)
+            frota = Frota(mapa, 1)
+            instrumentacao = Instrumentacao()
+            funcao = lambda: algorithms.gera_solucao(parametros, frota, tipo='rota_coletiva_lote',
+                                                     instrumentacao=instrumentacao)
+            if TO_TIME:
+                time_it(f'ROTA COLETIVA EM LOTE {classe}', 1, funcao)
+            else:
+                funcao()
+            atendidos = [item.indice for carro in frota for item in carro.agenda if item.tipo == 'Cliente']
+            assert len(atendidos) == len(set(atendidos)) == frota.qtd_atendidos, 'CLIENTE ATENDIDO MAIS DE UMA VEZ!'
+            for carro in [carro for carro in frota if len(carro.agenda) > 1]:  # Em falhas, sobram carros sem agenda
+                assert carro.resultado(display=False) == copia_carro(carro).resultado(display=False), f'AGENDA INVALIDA! {carro}'
+            print(frota, instrumentacao.contadores.get('lote.iteracoes', 0), '(iteracoes)',
+                  instrumentacao.contadores.get('lote.conflitos', 0), '(conflitos)')
+
+        # Todos os provedores passam pelas consultas em lote (linhas_distancias, linhas_tempos), com a mesma solução
+        resultados = {}
+        for modo, kwargs in PROVEDORES_EXATOS:
+            random.seed(0)
+            frota = Frota(Mapa('data/solomon_1987/r2/r201.txt', distancias=modo, **kwargs), 1)
+            algorithms.gera_solucao(parametros, frota, tipo='rota_coletiva_lote')
+            resultados[modo] = [carro.rota.tolist() for carro in frota]
+            print(modo, frota)
+        assert len(set(map(str, resultados.values()))) == 1, 'PROVEDOR DE DISTANCIAS ALTEROU A ROTA COLETIVA EM LOTE!'
+
+        # Clientes em pontos coincidentes (distância nula) não podem dividir por zero em nenhum cálculo de atratividade
+        mapa = Mapa('data/solomon_1987/r2/r201.txt')
+        mapa = mapa.com_clientes([Cliente(x=cliente.x, y=cliente.y, demanda=cliente.demanda, inicio=cliente.inicio,
+                                          fim=cliente.fim, servico=cliente.servico) for cliente in mapa.clientes[:5]])
+        for tipo in ('rota_independente', 'rota_coletiva', 'rota_coletiva_lote'):
+            random.seed(0)
+            frota = Frota(mapa, 1)
+            print(tipo, frota, algorithms.gera_solucao(parametros, frota, tipo=tipo), '(pontos coincidentes)')
+
+    if ('multipartida' in sys.argv):
+        # Com um número fixo de partidas, as estatísticas e a melhor frota não dependem do número de processos
+        mapa = Mapa('data/solomon_1987/r2/r201.txt')
+        compartilhado = mapa.compartilhado(velocidades=(1, ))
+        copia = pickle.loads(pickle.dumps(compartilhado))
+        assert (copia.matriz_de_distancias == mapa.matriz_de_distancias).all(), 'MATRIZ COMPARTILHADA DIVERGENTE!'
+        assert (copia.matriz_de_tempos(1) == mapa.matriz_de_tempos(1)).all(), 'TEMPOS COMPARTILHADOS DIVERGENTES!'
+        copia.distancias.libera()
+        compartilhado.distancias.libera()
+        referencia = None
+        for processos in (1, 2, 4):
+            inicio = timeit.default_timer()
+            frota, partidas = multipartida.multipartida(mapa, parametros, qtd_partidas=8, processos=processos, semente=7)
+            duracao = timeit.default_timer() - inicio
+            resumo = [(p['partida'], p['validade'], p['iteracoes'], p['qtd_carros'], p['distancia']) for p in partidas]
+            rotas = [[item.indice for item in carro.agenda] for carro in frota]
+            if referencia is None: referencia = (resumo, rotas)
+            assert (resumo, rotas) == referencia, f'MULTIPARTIDA DEPENDE DO NUMERO DE PROCESSOS! {processos}'
+            print(frota, processos, '(processos)', round(duracao, 3), '(s)', round(sum(c.distancia for c in frota), 3))
+        frota, partidas = multipartida.multipartida(mapa, parametros, tempo_limite=1.0, processos=2)
+        print(frota, len(partidas), '(partidas em 1s)')
+
+        # Com distâncias sob demanda, os processos recebem o próprio provedor: a matriz completa nunca é materializada
+        mapa = Mapa('data/solomon_1987/r2/r201.txt', distancias='sob_demanda', orcamento_memoria=20 * 101 * 8)
+        def matriz_proibida(provedor): raise AssertionError(f'MATRIZ COMPLETA MATERIALIZADA! {provedor}')
+        original, DistanciasSobDemanda.matriz_completa = DistanciasSobDemanda.matriz_completa, matriz_proibida
+        try:
+            resultados = {}
+            for processos in (1, 2):
+                frota, partidas = multipartida.multipartida(mapa, parametros, qtd_partidas=4, processos=processos,
+                                                            semente=7)
+                resultados[processos] = ([(p['partida'], p['qtd_carros'], p['distancia']) for p in partidas],
+                                         [carro.rota.tolist() for carro in frota])
+                print(frota, processos, '(processos, sob demanda)', mapa.distancias)
+            assert resultados[1] == resultados[2], 'MULTIPARTIDA SOB DEMANDA DEPENDE DO NUMERO DE PROCESSOS!'
+        finally:
+            DistanciasSobDemanda.matriz_completa = original
+
+    if ('prazo' in sys.argv):
+        # Os incumbentes devem melhorar a cada solução fornecida, e a busca deve terminar logo após o prazo
+        mapa = Mapa('data/solomon_1987/r2/r201.txt')
+        for tempo_limite, melhora in [(0.05, False), (2.0, False), (2.0, True)]:
+            inicio = timeit.default_timer()
+            geracao = multipartida.incumbentes(mapa, parametros, tempo_limite, semente=3, melhora=melhora)
+            anteriores = []
+            while True:
+                try:
+                    incumbente = next(geracao)
+                except StopIteration as fim:
+                    melhor = fim.value
+                    break
+                chave = multipartida.chave_objetivo('carros', incumbente.estatisticas)
+                assert all(chave < anterior for anterior in anteriores), 'INCUMBENTE NAO MELHOROU!'
+                anteriores.append(chave)
+                print('\t', incumbente, incumbente.iteracoes_totais, '(iteracoes)', len(incumbente.sumario['carro']), '(carros)')
+            duracao = timeit.default_timer() - inicio
+            assert duracao < tempo_limite + 0.5, f'PRAZO NAO RESPEITADO! {duracao}'
+            assert melhor is None or melhor.frota.qtd_clientes_faltantes == 0, 'INCUMBENTE INCOMPLETO!'
+            print(tempo_limite, melhora, round(duracao, 3), '(s)', melhor)
+
+    if ('servidor' in sys.argv):
+        # Requisições repetidas (por caminho ou por conteúdo) devem reaproveitar o mapa já lido, com o mesmo resultado
+        import asyncio, tempfile, threading
+        from two_step_vrptw.servidor import ServidorSolucoes, ClienteServidor
+        laco = asyncio.new_event_loop()
+        servico = ServidorSolucoes(porta=0, processos=2, diretorio_cache=tempfile.mkdtemp())
+        laco.run_until_complete(servico.inicia())
+        threading.Thread(target=laco.run_forever, daemon=True).start()
+        arquivo = 'data/solomon_1987/r2/r201.txt'
+        with open(arquivo, 'rb') as fin:
+            conteudo = fin.read().decode('utf-8')
+        with ClienteServidor(porta=servico.porta) as cliente:
+            respostas = [cliente.resolve(parametros, arquivo=arquivo, semente=3),
+                         cliente.resolve(parametros, arquivo=arquivo, semente=3),
+                         cliente.resolve(parametros, conteudo=conteudo, semente=3, qtd_partidas=2)]
+            for resposta in respostas:
+                print(resposta['nome'], resposta['aquecido'], resposta['qtd_carros'], round(resposta['distancia'], 3),
+                      round(resposta['latencia'] * 1000, 1), '(ms)')
+            assert [r['aquecido'] for r in respostas] == [False, True, True], 'CACHE DE MAPAS NAO REAPROVEITADO!'
+            assert respostas[0]['rotas'] == respostas[1]['rotas'], 'RESULTADO NAO REPRODUTIVEL!'
+            try:
+                cliente.resolve(parametros, arquivo='data/solomon_1987/c1/c103.txt')
+            except RuntimeError as erro:
+                print('ERRO ESPERADO:', erro)
+            metricas = cliente.metricas()
+            pprint(metricas)
+            assert metricas['requisicoes'] == 4 and metricas['erros'] == 1 and metricas['profundidade_fila'] == 0
+        asyncio.run_coroutine_threadsafe(servico.encerra(), laco).result()
+        laco.call_soon_threadsafe(laco.stop)
+
+    if ('insercao' in sys.argv):
+        # Os novos clientes devem ser atendidos uma única vez, em agendas válidas, e as distâncias estendidas devem ser
+        # idênticas às recalculadas do zero, para todos os provedores
+        for modo, kwargs in [('densa', {}), ('quantizada', {}), ('sob_demanda', {'orcamento_memoria': 20 * 101 * 8})]:
+            mapa = Mapa('data/solomon_1987/r2/r201.txt', distancias=modo, **kwargs)
+            random.seed(0)
+            frota = Frota(mapa, 1)
+            validade, _ = algorithms.gera_solucao(parametros, frota)
+            algorithms.otimizacao_termino_mais_cedo(frota)
+            gerador = random.default_rng(1)
+            novos = [Cliente(x=cliente.x + 1, y=cliente.y - 1, demanda=cliente.demanda, inicio=cliente.inicio,
+                             fim=cliente.fim, servico=cliente.servico)
+                     for cliente in [mapa.clientes[i] for i in gerador.choice(len(mapa.clientes), 5, replace=False)]]
+            antes = len(frota)
+            funcao = lambda: insercao.insere_clientes(frota, novos, qtd_candidatos=10)
+            if TO_TIME:
+                time_it(f'INSERCAO {modo}', 1, funcao)
+                resultado = None
+            else:
+                resultado = funcao()
+            estendido = frota.mapa
+            referencia = cria_provedor(modo, estendido.coordenadas, **kwargs)
+            for no in range(len(estendido.nos)):
+                assert (estendido.linha_distancias(no) == referencia.linha(no)).all(), f'DISTANCIAS DIVERGENTES! {no}'
+            atendidos = [item.indice for carro in frota for item in carro.agenda if item.tipo == 'Cliente']
+            assert len(atendidos) == len(set(atendidos)) == frota.qtd_atendidos, 'CLIENTE ATENDIDO MAIS DE UMA VEZ!'
+            assert len(frota) <= frota.max_carros, 'MAX_CARROS NAO RESPEITADO!'
+            for carro in frota:
+                assert carro.resultado(display=False) == copia_carro(carro).resultado(display=False), f'AGENDA INVALIDA! {carro}'
+            print(modo, validade, antes, '>>', frota, resultado)
+
+    if ('decomposicao' in sys.argv):
+        # Os sub-mapas devem reproduzir as distâncias do mapa original, e a frota unida deve atender cada cliente uma
+        # única vez, com agendas válidas e o mesmo resultado para qualquer número de processos
+        mapa = Mapa('data/solomon_1987/r2/r201.txt')
+        for metodo, kwargs in [('varredura', {}), ('kmeans', {}), ('kmeans', {'peso_janelas': 1.0})]:
+            setores = decomposicao.decompoe(mapa, 4, metodo=metodo, **kwargs)
+            assert sorted(concatenate(setores).tolist()) == list(range(1, len(mapa.nos))), 'SETORES NAO PARTICIONAM O MAPA!'
+            for indices in setores:
+                originais = concatenate([[0], indices])
+                assert (mapa.sub_mapa(indices).matriz_de_distancias == mapa.matriz_de_distancias[ix_(originais, originais)]).all(), \
+                    'SUB-MAPA DIVERGENTE!'
+            referencia = None
+            for processos in (1, 2):
+                inicio = timeit.default_timer()
+                frota, validade, setores = decomposicao.resolve_por_setores(
+                    mapa, parametros, qtd_setores=4, metodo=metodo, processos=processos, **kwargs
+                )
+                duracao = timeit.default_timer() - inicio
+                atendidos = [item.indice for carro in frota for item in carro.agenda if item.tipo == 'Cliente']
+                assert len(atendidos) == len(set(atendidos)) == frota.qtd_atendidos, 'CLIENTE ATENDIDO MAIS DE UMA VEZ!'
+                for carro in frota:
+                    assert carro.resultado(display=False) == copia_carro(carro).resultado(display=False), f'AGENDA INVALIDA! {carro}'
+                rotas = [carro.rota.tolist() for carro in frota]
+                if referencia is None: referencia = rotas
+                assert rotas == referencia, f'DECOMPOSICAO DEPENDE DO NUMERO DE PROCESSOS! {processos}'
+                print(metodo, kwargs, processos, '(processos)', validade, frota, round(sum(c.distancia for c in frota), 3),
+                      [(s['qtd_clientes'], s['qtd_carros']) for s in setores], round(duracao, 3), '(s)')
+
+    if ('feixe' in sys.argv):
+        # Sem poda (largura >= clientes_recursao ** (limite_recursoes + 1)), a busca em feixe deve reproduzir a
+        # enumeração completa das sequências. Com poda, o custo por passo deve crescer linearmente com a profundidade
+        mapa = Mapa('data/solomon_1987/r2/r201.txt')
+        exatos = replace(parametros, limite_recursoes=3)
+        random.seed(0)
+        frota = Frota(mapa, 1, largura_feixe=exatos.clientes_recursao ** (exatos.limite_recursoes + 1))
+        carro = frota.novo_carro()
+        for _ in range(5):
+            atratividade = algorithms.calcula_atratividade(exatos, frota, None, carro)
+            referencia = atratividade_feixe_exaustiva(exatos, frota, carro)
+            assert all(abs(valor - referencia[cliente]) < 1e-9 for cliente, valor in atratividade), \
+                f'FEIXE DIVERGENTE DA ENUMERACAO! {atratividade} {referencia}'
+            carro.atendimento(frota[atratividade[0][0]])
+        for profundidade in (1, 2, 3, 4, 6, 8):
+            for largura_feixe in ((None, 8) if profundidade <= 4 else (8, )):
+                random.seed(0)
+                frota = Frota(mapa, 1)
+                instrumentacao = Instrumentacao()
+                validade, _ = algorithms.gera_solucao(replace(parametros, limite_recursoes=profundidade), frota,
+                                                      instrumentacao=instrumentacao, largura_feixe=largura_feixe)
+                for carro in frota:
+                    assert carro.resultado(display=False) == copia_carro(carro).resultado(display=False), f'AGENDA INVALIDA! {carro}'
+                passos = instrumentacao.contadores['roleta.selecoes']
+                print(profundidade, largura_feixe, validade, frota, round(sum(c.distancia for c in frota), 3),
+                      round(instrumentacao.tempos['atratividade'] / passos * 1000, 3), '(ms/passo)')
+
+        # Todos os provedores passam pelas consultas em lote do feixe, com a mesma solução
+        resultados = {}
+        for modo, kwargs in PROVEDORES_EXATOS:
+            random.seed(0)
+            frota = Frota(Mapa('data/solomon_1987/r2/r201.txt', distancias=modo, **kwargs), 1)
+            algorithms.gera_solucao(parametros, frota, largura_feixe=8)
+            resultados[modo] = [carro.rota.tolist() for carro in frota]
+            print(modo, frota)
+        assert len(set(map(str, resultados.values()))) == 1, 'PROVEDOR DE DISTANCIAS ALTEROU A BUSCA EM FEIXE!'
+
     if ('rota_independente' in sys.argv):
         if TO_TIME:
             mapa = Mapa('data/solomon_1987/r2/r201.txt')